@@ -0,0 +1,48 @@
+# how many compiles the name independent compile cache saves: the kernels of some training steps, the ones with the same body and another name
+import time
+from testgrad import Tensor, Device, nn
+from testgrad.uop.ops import Ops
+from testgrad.engine.realize import get_program
+from testgrad.helpers import getenv
+
+class MNIST:
+  def __init__(self):
+    self.layers = [nn.Conv2d(1, 32, 5), Tensor.relu, nn.Conv2d(32, 32, 5), Tensor.relu, nn.BatchNorm(32), Tensor.max_pool2d,
+                   nn.Conv2d(32, 64, 3), Tensor.relu, nn.Conv2d(64, 64, 3), Tensor.relu, nn.BatchNorm(64), Tensor.max_pool2d,
+                   lambda x: x.flatten(1), nn.Linear(576, 10)]
+  def __call__(self, x:Tensor) -> Tensor: return x.sequential(self.layers)
+
+class MLP:
+  def __init__(self, *dims:int): self.layers = [nn.Linear(a, b) for a,b in zip(dims, dims[1:])]
+  def __call__(self, x:Tensor) -> Tensor:
+    for l in self.layers[:-1]: x = l(x).relu()
+    return self.layers[-1](x)
+
+def step_kernels(model, x:Tensor, y:Tensor) -> list:
+  params = nn.state.get_parameters(model)
+  for p in params: p.requires_grad_()
+  with Tensor.train():
+    loss = model(x).sparse_categorical_crossentropy(y)
+    loss.backward()
+    return [si.ast for si in Tensor.schedule(loss, *[p.grad for p in params if p.grad is not None]) if si.ast.op is Ops.SINK]
+
+MODELS = {
+  "mnist": lambda bs: (MNIST(), Tensor.rand(bs, 1, 28, 28), Tensor.randint(bs, high=10)),
+  "conv": lambda bs: ((lambda c, l: (lambda x: l(c(x).relu().flatten(1))))(nn.Conv2d(3, 8, 3), nn.Linear(8*30*30, 10)),
+                      Tensor.rand(bs, 3, 32, 32), Tensor.randint(bs, high=10)),
+  "mlp": lambda bs: (MLP(784, 256, 256, 10), Tensor.rand(bs, 784), Tensor.randint(bs, high=10)),
+}
+
+if __name__ == "__main__":
+  compiler, renderer = Device[Device.DEFAULT].compiler, Device[Device.DEFAULT].renderer
+  for name, make in MODELS.items():
+    # a model at some batch sizes, like a shape polymorphic model in a server
+    st, srcs, canonical, kernels = time.perf_counter(), set(), set(), 0
+    for bs in [int(x) for x in getenv("BS", "8,16,32").split(",")]:
+      for ast in step_kernels(*make(bs)):
+        prg = get_program(ast, renderer)
+        kernels += 1
+        srcs.add(prg.src)
+        canonical.add(compiler.canonicalize(prg.src, prg.function_name))
+    print(f"{name:6s} {kernels:4d} kernels, {len(srcs):4d} sources, {len(canonical):4d} canonical sources, "
+          f"{len(srcs)-len(canonical):4d} compiles saved ({(len(srcs)-len(canonical))/len(srcs)*100:4.1f}%) in {time.perf_counter()-st:6.2f} s")
@@ -0,0 +1,39 @@
+# DISK to CPU copies of a big checkpoint: the copy from the mmap, the io_uring reads of copy_from_disk and DISK_MMAP, with the page cache dropped
+import os, time, mmap
+from testgrad import Tensor, Device, dtypes
+from testgrad.device import Buffer
+from testgrad.helpers import getenv, temp, Context
+
+def drop_cache(fn:str):
+  # the pages mapped by the DISK device stay in the page cache until they're unmapped
+  Device[f"DISK:{fn}"].mem.madvise(mmap.MADV_DONTNEED)
+  fd = os.open(fn, os.O_RDONLY)
+  os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+  os.close(fd)
+
+if __name__ == "__main__":
+  size, fn = int(getenv("GB", 2) * 1024**3), getenv("FN", temp("external_benchmark_disk_copy"))
+  if not os.path.exists(fn) or os.path.getsize(fn) < size + 4096:
+    with open(fn, "wb") as f:
+      for _ in range(0, size + 4096, 1 << 26): f.write(os.urandom(1 << 26))
+  src, dest = Buffer(f"DISK:{fn}", size + 4096, dtypes.uint8).allocate(), Buffer("CPU", size, dtypes.uint8).allocate()
+  disk, cpu = src.allocator, dest.allocator
+  print(f"{size/1e9:.2f} GB, O_DIRECT {Device[src.device].direct}, io_uring {hasattr(Device[src.device], 'io_uring')}")
+  # a page aligned offset is read straight into dest, the other one is read through staging buffers with O_DIRECT
+  for off in [0, 551]:
+    buf = disk._offset(src._buf, size, off)
+    drop_cache(fn)
+    st = time.perf_counter()
+    disk._copyout(cpu._as_buffer(dest._buf), buf)
+    print(f"offset {off:4d} mmap                          {size/(time.perf_counter()-st)/1e9:6.2f} GB/s")
+    for depth in [int(x) for x in getenv("DEPTH", "4,16,64").split(",")]:
+      for seg in [int(x) for x in getenv("SEGMENT", str(1<<20)+","+str(1<<23)).split(",")]:
+        drop_cache(fn)
+        st = time.perf_counter()
+        with Context(DISK_READ_DEPTH=depth, DISK_READ_SEGMENT=seg): cpu.copy_from_disk(dest._buf, buf, size)
+        print(f"offset {off:4d} io_uring depth {depth:3d} seg {seg>>10:5d}K {size/(time.perf_counter()-st)/1e9:6.2f} GB/s")
+  # with DISK_MMAP the copy is a copy on write mapping of the file, the pages are read when they're used
+  drop_cache(fn)
+  st = time.perf_counter()
+  with Context(DISK_MMAP=1): t = Tensor.empty(size, device=f"disk:{fn}", dtype=dtypes.uint8).to("CPU").realize()
+  print(f"offset    0 DISK_MMAP                     {(time.perf_counter()-st)*1e3:6.2f} ms")
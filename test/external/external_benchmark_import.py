@@ -0,0 +1,33 @@
+# startup benchmark: the import time of each testgrad module, and the first codegen in a new process, where the pattern matchers are compiled
+import subprocess, sys, os
+from testgrad.helpers import getenv
+
+FIRST_CODEGEN = """
+import time
+from testgrad import Tensor, Device
+from testgrad.uop.ops import Ops
+from testgrad.engine.realize import get_program
+sched = (Tensor.ones(8, 32).contiguous() @ Tensor.ones(32, 32).contiguous()).relu().sum().schedule()
+st = time.perf_counter()
+for si in sched:
+  if si.ast.op is Ops.SINK: get_program(si.ast, Device["CPU"].renderer)
+print(f"{(time.perf_counter()-st)*1e3:.1f}")
+"""
+
+def import_times() -> dict[str, tuple[int, int]]:
+  ret = subprocess.run([sys.executable, "-X", "importtime", "-c", "import testgrad"], capture_output=True, text=True, check=True, env=os.environ)
+  times: dict[str, tuple[int, int]] = {}
+  for line in ret.stderr.splitlines():
+    if not line.startswith("import time:") or "|" not in line or "self [us]" in line: continue
+    self_us, cumulative_us, name = [x.strip() for x in line[len("import time:"):].split("|")]
+    times[name] = (int(self_us), int(cumulative_us))
+  return times
+
+if __name__ == "__main__":
+  cnt = getenv("CNT", 3)
+  runs = [import_times() for _ in range(cnt)]
+  mods = {k:(min(r[k][0] for r in runs), min(r[k][1] for r in runs)) for k in runs[0] if k.startswith("testgrad")}
+  print(f"{'module':40s} {'self ms':>8s} {'total ms':>9s}")
+  for k,(s,c) in sorted(mods.items(), key=lambda x: -x[1][1])[:getenv("TOP", 25)]: print(f"{k:40s} {s/1e3:8.1f} {c/1e3:9.1f}")
+  codegen = [float(subprocess.run([sys.executable, "-c", FIRST_CODEGEN], capture_output=True, text=True, check=True).stdout) for _ in range(cnt)]
+  print(f"first codegen in a new process: {min(codegen):.1f} ms (first run {codegen[0]:.1f} ms)")
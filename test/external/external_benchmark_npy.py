@@ -0,0 +1,26 @@
+# cold start: a small model step on NPY, where the kernel ASTs run on numpy, and on a compiled device with empty caches
+import time, sys, subprocess, os
+from testgrad.helpers import getenv
+
+STEP = """
+import time
+st = time.perf_counter()
+from testgrad import Tensor, nn
+Tensor.manual_seed(0)
+conv, lin = nn.Conv2d(3, 8, 3), nn.Linear(8*30*30, 10)
+for p in [conv.weight, conv.bias, lin.weight, lin.bias]: p.replace(p.to("{dev}")).requires_grad_()
+x, y = Tensor.rand(16, 3, 32, 32).to("{dev}"), Tensor([1]*16, device="{dev}")
+for i in range({steps}):
+  loss = lin(conv(x).relu().flatten(1)).sparse_categorical_crossentropy(y)
+  loss.backward()
+  loss.item()
+  if i == 0: first = time.perf_counter()
+print(f"{{(first-st)*1e3:.1f}} {{(time.perf_counter()-first)*1e3/max({steps}-1, 1):.1f}}")
+"""
+
+if __name__ == "__main__":
+  env = {**os.environ, "CACHELEVEL": "0"}
+  for dev in ["NPY", getenv("DEV", "CPU")]:
+    out = subprocess.run([sys.executable, "-c", STEP.format(dev=dev, steps=getenv("STEPS", 3))], capture_output=True, text=True, check=True, env=env)
+    first, rest = out.stdout.split()
+    print(f"{dev:6s} first step {float(first):9.1f} ms, next steps {float(rest):8.1f} ms")
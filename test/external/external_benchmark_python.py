@@ -0,0 +1,28 @@
+# the PYTHON emulator running a small model step, with the numpy engine and with the scalar interpreter
+import time
+from unittest.mock import patch
+import numpy as np
+from testgrad import Tensor, nn
+from testgrad.helpers import getenv
+from testgrad.runtime.ops_python import PythonProgram
+
+def step() -> np.ndarray:
+  Tensor.manual_seed(0)
+  conv, lin = nn.Conv2d(3, 4, 3), nn.Linear(4*6*6, 10)
+  conv.weight.requires_grad = lin.weight.requires_grad = True
+  loss = lin(conv(Tensor.rand(getenv("BS", 2), 3, 8, 8)).relu().flatten(1)).sparse_categorical_crossentropy(Tensor([1]*getenv("BS", 2)))
+  loss.backward()
+  return np.concatenate([loss.numpy().reshape(-1), conv.weight.grad.numpy().reshape(-1), lin.weight.grad.numpy().reshape(-1)])
+
+def timed() -> tuple[float, np.ndarray]:
+  st = time.perf_counter()
+  ret = step()
+  return time.perf_counter()-st, ret
+
+if __name__ == "__main__":
+  step()  # compile the kernels
+  tm, out = timed()
+  print(f"numpy engine      {tm*1e3:9.1f} ms")
+  with patch.object(PythonProgram, "_run_numpy", lambda *args: False): tm, ref = timed()
+  print(f"scalar interpreter {tm*1e3:8.1f} ms")
+  np.testing.assert_equal(out, ref)
@@ -0,0 +1,30 @@
+# safe_save of a big checkpoint, with some segment sizes and depths, through the page cache and with O_DIRECT,
+# and how long safe_save and safe_save_async block the caller
+import os, time
+from testgrad import Tensor
+from testgrad.nn.state import safe_save, safe_save_async
+from testgrad.helpers import getenv, temp, Context
+
+if __name__ == "__main__":
+  size, fn = int(getenv("GB", 1.0) * 1024**3), getenv("FN", temp("external_benchmark_safe_save"))
+  # many layers of a model, some of them big
+  tensors = {f"layer{i}": Tensor.rand(n//4).realize() for i,n in enumerate([size//2, size//4, size//8] + [size//8//64]*64)}
+  nbytes = sum(v.nbytes() for v in tensors.values())
+  print(f"{nbytes/1e9:.2f} GB in {len(tensors)} tensors")
+  for direct in [0, 1]:
+    for depth in [int(x) for x in getenv("DEPTH", "1,4").split(",")]:
+      for seg in [int(x) for x in getenv("SEGMENT", str(1<<20)+","+str(1<<24)).split(",")]:
+        st = time.perf_counter()
+        with Context(DISK_WRITE_DIRECT=direct, DISK_WRITE_DEPTH=depth, DISK_WRITE_SEGMENT=seg):
+          safe_save(tensors, fn)
+          os.sync()
+        print(f"direct {direct} depth {depth:2d} seg {seg>>10:6d}K {nbytes/(time.perf_counter()-st)/1e9:6.2f} GB/s")
+  # the training loop waits for the whole save, or for the copy to memory. the later async checkpoints copy to the memory of the earlier ones
+  for name, save in [("safe_save", lambda: safe_save(tensors, fn)), ("safe_save_async", lambda: safe_save_async(tensors, fn))]:
+    for i in range(3):
+      st = time.perf_counter()
+      ret = save()
+      blocked = time.perf_counter() - st
+      if ret is not None: ret.result()
+      os.sync()
+      print(f"{name:16s} {i} blocks {blocked*1e3:8.2f} ms of {(time.perf_counter()-st)*1e3:8.2f} ms")
@@ -0,0 +1,32 @@
+# torch_load of a big checkpoint and the copy of its tensors to CPU, against reading the file, with the page cache dropped
+import os, time
+from testgrad import Tensor
+from testgrad.nn.state import torch_load
+from testgrad.helpers import getenv, temp, Context
+
+def drop_cache(fn:str):
+  fd = os.open(fn, os.O_RDONLY)
+  os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+  os.close(fd)
+
+if __name__ == "__main__":
+  fn = getenv("FN", temp("external_benchmark_torch_load.pth"))
+  if not os.path.exists(fn):
+    import torch
+    size = int(getenv("GB", 1.0) * 1024**3)
+    torch.save({f"layer{i}": torch.rand(n//4) for i,n in enumerate([size//2, size//4, size//8] + [size//8//256]*256)}, fn)
+  drop_cache(fn)
+  st = time.perf_counter()
+  with open(fn, "rb") as f:
+    while f.read(1 << 24): pass
+  print(f"read the file           {os.path.getsize(fn)/(time.perf_counter()-st)/1e9:6.2f} GB/s")
+  # torch aligns the storages to 64 bytes, so with DISK_MMAP they are mapped
+  for mmap in [0, 1]:
+    drop_cache(fn)
+    st = time.perf_counter()
+    state_dict = torch_load(fn)
+    loaded = time.perf_counter()
+    with Context(DISK_MMAP=mmap): Tensor.realize(*[v.to("CPU") for v in state_dict.values()])
+    nbytes = sum(v.nbytes() for v in state_dict.values())
+    print(f"torch_load {len(state_dict):4d} tensors {(loaded-st)*1e3:8.2f} ms, "
+          f"to CPU with DISK_MMAP={mmap} {nbytes/(time.perf_counter()-st)/1e9:6.2f} GB/s")
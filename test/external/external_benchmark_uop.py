@@ -0,0 +1,45 @@
+# microbenchmark of the UOp graph: creation, lookup of existing nodes, toposort, teardown and the memory used by each node
+import gc, time, tracemalloc
+from testgrad.helpers import getenv
+from testgrad.uop.ops import UOp, UOpMetaClass, Ops
+from testgrad.dtype import dtypes
+
+def build(n:int) -> UOp:
+  # a deep graph like the ones a training step makes: every node is new and has up to two sources
+  a, b = UOp.variable("a", 0, 10), UOp.variable("b", 0, 10)
+  for i in range(n//3): a, b = UOp(Ops.ADD, dtypes.int, (a, b)), UOp(Ops.MUL, dtypes.int, (b, UOp(Ops.CONST, dtypes.int, arg=i)))
+  return UOp.sink(a, b)
+
+if __name__ == "__main__":
+  n, cnt = getenv("N", 100_000), getenv("CNT", 5)
+  gc.collect()
+  nodes = len(UOpMetaClass.ucache)
+  tracemalloc.start()
+  sink = build(n)
+  mem, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  nodes = len(UOpMetaClass.ucache)-nodes
+  print(f"{nodes} nodes, {mem/nodes:.0f} bytes/node")
+
+  tms: dict[str, float] = {}
+  def record(name:str, st:float): tms[name] = min(tms.get(name, float("inf")), time.perf_counter()-st)
+  for _ in range(cnt):
+    del sink
+    gc.collect()
+    st = time.perf_counter()
+    sink = build(n)
+    record("create", st)
+    st = time.perf_counter()
+    build(n)
+    record("lookup", st)
+    st = time.perf_counter()
+    sink.toposort()
+    record("toposort", st)
+    st = time.perf_counter()
+    sink.toposort()
+    record("toposort again", st)
+    st = time.perf_counter()
+    sink = None
+    record("teardown", st)
+    sink = build(n)
+  for k,v in tms.items(): print(f"{k:14s} {v*1e9/nodes:8.1f} ns/node")
@@ -0,0 +1,62 @@
+import unittest
+import numpy as np
+from testgrad import Tensor, TinyJit
+from testgrad.engine.jit import JitError
+
+class TestJit(unittest.TestCase):
+  def test_simple_jit(self):
+    @TinyJit
+    def add(a, b): return (a+b).realize()
+    for _ in range(5):
+      a, b = Tensor.randn(10, 10), Tensor.randn(10, 10)
+      c = add(a, b)
+      np.testing.assert_allclose(c.numpy(), a.numpy()+b.numpy(), atol=1e-6)
+    self.assertEqual(len(add.jit_cache), 1)
+
+  def test_jit_kwargs(self):
+    @TinyJit
+    def add_kw(a, b): return (a*2+b).realize()
+    for _ in range(5):
+      a, b = Tensor.randn(10), Tensor.randn(10)
+      c = add_kw(b=b, a=a)
+      np.testing.assert_allclose(c.numpy(), a.numpy()*2+b.numpy(), atol=1e-6)
+
+  def test_jit_multiple_kernels(self):
+    @TinyJit
+    def f(a): return ((a+1).contiguous().sum(axis=1)*2).realize()
+    for _ in range(4):
+      a = Tensor.randn(8, 8)
+      np.testing.assert_allclose(f(a).numpy(), (a.numpy()+1).sum(axis=1)*2, atol=1e-5)
+    self.assertGreater(len(f.jit_cache), 1)
+
+  def test_jit_method(self):
+    class Model:
+      def __init__(self): self.w = Tensor.ones(4).contiguous().realize()
+      @TinyJit
+      def __call__(self, x): return (x*self.w).realize()
+    m = Model()
+    for i in range(4): self.assertListEqual(m(Tensor([float(i)]*4)).tolist(), [float(i)]*4)
+
+  def test_jit_shape_mismatch(self):
+    @TinyJit
+    def add(a): return (a+1).realize()
+    for _ in range(3): add(Tensor.randn(10))
+    with self.assertRaises(JitError): add(Tensor.randn(20))
+
+  def test_jit_nothing_captured(self):
+    @TinyJit
+    def f(a): return a
+    f(Tensor([1]))
+    with self.assertRaises(JitError): f(Tensor([1]))
+
+  def test_nested_jit(self):
+    @TinyJit
+    def inner(a): return (a+1).realize()
+    @TinyJit
+    def outer(a): return inner(a)
+    for _ in range(2): inner(Tensor([1]))
+    outer(Tensor([1]))
+    with self.assertRaises(JitError): outer(Tensor([1]))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,67 @@
+import unittest, threading
+from unittest.mock import patch
+import numpy as np
+from testgrad import Tensor
+from testgrad.helpers import Context, GlobalCounters
+from testgrad.engine import realize
+from testgrad.engine.realize import run_schedule
+
+def _chain(n=6):
+  x = Tensor.ones(16, 16).contiguous().realize()
+  for i in range(n): x = (x*1.5+i).contiguous()
+  return x.sum(0)
+
+def _chain_np(n=6):
+  v = np.ones((16, 16), dtype=np.float32)
+  for i in range(n): v = v*np.float32(1.5)+i
+  return v.sum(0)
+
+class TestAsyncRun(unittest.TestCase):
+  def test_async_run(self):
+    with Context(ASYNC_RUN=2):
+      out = _chain()
+      run_schedule(out.schedule())
+    np.testing.assert_allclose(out.numpy(), _chain_np(), rtol=1e-6)
+
+  def test_lowered_in_thread(self):
+    threads = set()
+    def lower(si):
+      threads.add(threading.current_thread().name)
+      return lower_schedule_item(si)
+    lower_schedule_item, sched = realize.lower_schedule_item, _chain().schedule()
+    with Context(ASYNC_RUN=2), patch.object(realize, "lower_schedule_item", lower): run_schedule(sched)
+    self.assertEqual(threads, {"lower_schedule"})
+
+  def test_counters(self):
+    counts = []
+    for async_run in [0, 1]:
+      sched = _chain().schedule()
+      GlobalCounters.reset()
+      with Context(ASYNC_RUN=async_run): run_schedule(sched)
+      counts.append((GlobalCounters.kernel_count, GlobalCounters.global_ops, GlobalCounters.global_mem))
+    self.assertEqual(counts[0], counts[1])
+
+  def test_lowering_error(self):
+    sched = _chain().schedule()
+    lower_schedule_item = realize.lower_schedule_item
+    def lower(si):
+      if si is sched[3]: raise RuntimeError("lowering failed")
+      return lower_schedule_item(si)
+    GlobalCounters.reset()
+    with Context(ASYNC_RUN=1), patch.object(realize, "lower_schedule_item", lower):
+      with self.assertRaisesRegex(RuntimeError, "lowering failed"): run_schedule(sched[:])
+    # the items before the error ran, the ones after it didn't
+    self.assertEqual(GlobalCounters.kernel_count, 3)
+
+  def test_run_error(self):
+    run = realize.ExecItem.run
+    def fail(self, *args, **kwargs):
+      if GlobalCounters.kernel_count == 2: raise RuntimeError("run failed")
+      return run(self, *args, **kwargs)
+    sched = _chain().schedule()
+    GlobalCounters.reset()
+    with Context(ASYNC_RUN=1), patch.object(realize.ExecItem, "run", fail):
+      with self.assertRaisesRegex(RuntimeError, "run failed"): run_schedule(sched)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+from unittest.mock import patch
+import numpy as np
+from testgrad import Tensor, Device
+from testgrad.helpers import Context
+from testgrad.engine.realize import lower_schedule
+from testgrad.runtime.support.elf import BATCH_MAGIC, unpack_batch
+
+def _fresh_pair():
+  # a new constant every time, so nothing is cached. the (32,) and (8, 4) kernels have the same body and different names
+  c = float(np.random.uniform(1, 2))
+  x, y = Tensor.arange(32).float().realize(), Tensor.arange(32).float().reshape(8, 4).realize()
+  return (x+c).contiguous(), (y+c).contiguous(), np.arange(32, dtype=np.float32)+np.float32(c)
+
+class TestCompileDedup(unittest.TestCase):
+  def setUp(self):
+    self.compiler, self.srcs = Device["CPU"].compiler, []
+    def compile(src:str) -> bytes:
+      self.srcs.append(src)
+      return type(self.compiler).compile(self.compiler, src)
+    self.patch = patch.object(self.compiler, "compile", compile)
+    self.patch.start()
+  def tearDown(self): self.patch.stop()
+
+  def _run(self, *tensors:Tensor) -> list:
+    eis = [ei for _,ei in lower_schedule(Tensor.schedule(*tensors))]
+    for ei in eis: ei.run()
+    return eis
+
+  def test_canonical_source(self):
+    self.assertEqual(self.compiler.canonicalize("void k_32(float* k_32_0) { k_32(); }", "k_32"), "void kernel(float* k_32_0) { kernel(); }")
+
+  def test_diskcache(self):
+    a, b, ref = _fresh_pair()
+    eis = self._run(a) + self._run(b)
+    self.assertNotEqual(eis[0].prg.p.function_name, eis[1].prg.p.function_name)
+    # the second kernel is the first one's lib from the diskcache
+    self.assertEqual(len(self.srcs), 1)
+    self.assertEqual(eis[0].prg.lib, eis[1].prg.lib)
+    np.testing.assert_equal(a.numpy(), ref)
+    np.testing.assert_equal(b.numpy().reshape(-1), ref)
+
+  def test_schedule_shares_compile(self):
+    a, b, ref = _fresh_pair()
+    with patch.object(self.compiler, "cachekey", None): self._run(a, b)
+    self.assertEqual(len(self.srcs), 1)
+    np.testing.assert_equal(a.numpy(), ref)
+    np.testing.assert_equal(b.numpy().reshape(-1), ref)
+
+  def test_batch_relinks(self):
+    a, b, ref = _fresh_pair()
+    batches = []
+    def compile_batch(srcs:list[str], names:list[str]) -> list[bytes]:
+      batches.append(names)
+      return type(self.compiler).compile_batch(self.compiler, srcs, names)
+    with patch.object(self.compiler, "cachekey", None), patch.object(self.compiler, "compile_batch", compile_batch), Context(BATCH_COMPILE=8):
+      eis = self._run(a, b)
+    # one kernel is compiled, each lib has its own name as the entry point
+    self.assertEqual(batches, [[eis[0].prg.p.function_name]])
+    for ei in eis:
+      self.assertTrue(ei.prg.lib.startswith(BATCH_MAGIC))
+      self.assertEqual(list(unpack_batch(ei.prg.lib)[1]), [ei.prg.p.function_name])
+    np.testing.assert_equal(a.numpy(), ref)
+    np.testing.assert_equal(b.numpy().reshape(-1), ref)
+
+if __name__ == '__main__':
+  unittest.main()
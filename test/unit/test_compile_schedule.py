@@ -0,0 +1,60 @@
+import unittest, threading
+from unittest.mock import patch
+import numpy as np
+from testgrad import Tensor, Device
+from testgrad.helpers import Context
+from testgrad.engine.realize import lower_schedule, pending_compiles, method_cache, run_schedule
+from testgrad.runtime.support.elf import BATCH_MAGIC
+
+def _fresh_chain(n=4):
+  # new constants every time, so nothing is in the method cache
+  x = Tensor.ones(16).contiguous().realize()
+  consts = np.random.uniform(size=n).tolist()
+  for c in consts: x = (x*c+1).contiguous()
+  ref = np.ones(16)
+  for c in consts: ref = ref*np.float32(c)+1
+  return x, ref
+
+class TestCompileSchedule(unittest.TestCase):
+  def test_compiles_in_background(self):
+    compiler, threads = Device["CPU"].compiler, set()
+    def compile(src:str) -> bytes:
+      threads.add(threading.current_thread().name)
+      return type(compiler).compile(compiler, src)
+    x, _ = _fresh_chain()
+    with patch.object(compiler, "cachekey", None), patch.object(compiler, "compile", compile):
+      sched = x.schedule()
+      lowered = lower_schedule(sched)
+      next(lowered)
+      # after the first item is lowered, the rest are already compiling
+      self.assertEqual(len(pending_compiles), 3)
+      for _ in lowered: pass
+    self.assertEqual(len(pending_compiles), 0)
+    self.assertTrue(all(t.startswith("compile") for t in threads))
+
+  def test_run_schedule(self):
+    x, ref = _fresh_chain()
+    with patch.object(Device["CPU"].compiler, "cachekey", None): run_schedule(x.schedule())
+    np.testing.assert_allclose(x.numpy(), ref, rtol=1e-6)
+
+  def test_parallel_compile_off(self):
+    x, _ = _fresh_chain()
+    with Context(PARALLEL_COMPILE=0):
+      lowered = lower_schedule(x.schedule())
+      next(lowered)
+      self.assertEqual(len(pending_compiles), 0)
+      for _ in lowered: pass
+    self.assertGreater(len(method_cache), 0)
+  def test_batch_compile(self):
+    x, ref = _fresh_chain()
+    with patch.object(Device["CPU"].compiler, "cachekey", None), Context(BATCH_COMPILE=8):
+      eis = [ei for _,ei in lower_schedule(x.schedule())]
+      for ei in eis: ei.run()
+    # the kernels all have the same name, they are renamed in the batch and share one mapping
+    self.assertEqual(len({ei.prg.p.function_name for ei in eis}), 1)
+    self.assertTrue(all(ei.prg.lib.startswith(BATCH_MAGIC) for ei in eis))
+    self.assertEqual(len({id(ei.prg._prg.base) for ei in eis}), 1)
+    np.testing.assert_allclose(x.numpy(), ref, rtol=1e-6)
+
+if __name__ == '__main__':
+  unittest.main()
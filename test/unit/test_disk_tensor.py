@@ -1,9 +1,11 @@
-import os, pathlib, tempfile, unittest
+import os, sys, io, json, types, pickle, zipfile, pathlib, tempfile, threading, unittest
+from collections import OrderedDict
+from unittest.mock import patch
 import numpy as np
 from testgrad import Tensor, Device, dtypes
 from testgrad.dtype import DType
-from testgrad.nn.state import safe_load, safe_save, get_state_dict, torch_load
-from testgrad.helpers import Timing, fetch, temp, CI, OSX
+from testgrad.nn.state import safe_load, safe_save, safe_save_async, get_state_dict, torch_load
+from testgrad.helpers import Timing, fetch, temp, CI, OSX, Context
 from testgrad.device import is_dtype_supported
 
 def compare_weights_both(url):
@@ -41,6 +43,44 @@ def _test_bitcasted(t: Tensor, dt: DType, expected):
   np.testing.assert_allclose(t.bitcast(dt).numpy(), expected)
 
 # sudo su -c 'sync; echo 1 > /proc/sys/vm/drop_caches' && python3 test/unit/test_disk_tensor.py TestRawDiskBuffer.test_readinto_read_speed
+def _save_torch_zip(fn:str, tensors:dict[str, np.ndarray]):
+  # a .pth file like torch.save writes it, without torch: the pickle is written against a fake torch module
+  torch, utils = types.ModuleType("torch"), types.ModuleType("torch._utils")
+  class FloatStorage: pass
+  def _rebuild_tensor_v2(*args): pass
+  FloatStorage.__module__, FloatStorage.__qualname__, torch.FloatStorage = "torch", "FloatStorage", FloatStorage # type: ignore[attr-defined]
+  _rebuild_tensor_v2.__module__, _rebuild_tensor_v2.__qualname__ = "torch._utils", "_rebuild_tensor_v2"
+  utils._rebuild_tensor_v2 = _rebuild_tensor_v2 # type: ignore[attr-defined]
+  class Storage:
+    def __init__(self, key:str, a:np.ndarray): self.key, self.a = key, a
+  class FakeTensor:
+    def __init__(self, s:Storage): self.s = s
+    def __reduce__(self): return (_rebuild_tensor_v2, (self.s, 0, self.s.a.shape, tuple(x//4 for x in self.s.a.strides), False, OrderedDict()))
+  class Pickler(pickle.Pickler):
+    def persistent_id(self, obj): return ('storage', FloatStorage, obj.key, 'cpu', obj.a.size) if isinstance(obj, Storage) else None
+  storages, pkl = {k:Storage(str(i), a) for i,(k,a) in enumerate(tensors.items())}, io.BytesIO()
+  with patch.dict(sys.modules, {"torch": torch, "torch._utils": utils}):
+    Pickler(pkl, protocol=2).dump(OrderedDict((k, FakeTensor(s)) for k,s in storages.items()))
+  with zipfile.ZipFile(fn, "w") as z:
+    z.writestr("archive/data.pkl", pkl.getvalue())
+    for s in storages.values():
+      # torch aligns the storages to 64 bytes with padding in the extra field
+      pad = -(z.fp.tell() + 30 + len(name:=f"archive/data/{s.key}") + 4) % 64 # type: ignore[union-attr]
+      (zi:=zipfile.ZipInfo(name)).extra = b"FB" + pad.to_bytes(2, "little") + b"Z"*pad
+      z.writestr(zi, s.a.tobytes())
+
+class TestTorchLoadZip(unittest.TestCase):
+  def test_load(self):
+    tensors = {"w": np.random.rand(3, 4).astype(np.float32), "b": np.arange(5, dtype=np.float32), "s": np.array(2.5, dtype=np.float32)}
+    _save_torch_zip(fn:=temp("dt_torch_load_zip"), tensors)
+    # the zip and the pickle are read from the file in bulk, not with a copy for every read
+    with patch.object(Tensor, "data", side_effect=AssertionError("read with a copy")): state_dict = torch_load(fn)
+    self.assertEqual(list(state_dict.keys()), list(tensors.keys()))
+    for k,v in state_dict.items():
+      self.assertEqual(v.device, f"DISK:{fn}")
+      np.testing.assert_equal(v.to("CPU").numpy(), tensors[k])
+      with Context(DISK_MMAP=1): np.testing.assert_equal(v.to("CPU").numpy(), tensors[k])
+
 class TestRawDiskBuffer(unittest.TestCase):
   @unittest.skipIf(not test_fn.exists(), "download LLaMA weights for read in speed tests")
   def test_readinto_read_speed(self):
@@ -359,6 +399,112 @@ class TestDiskTensor(unittest.TestCase):
     x = Tensor.empty(size + len(test), dtype=dtypes.uint8, device=f"disk:{fn}").to("CPU").realize()
     assert x[size:].data().tobytes() == test
 
+class TestCopyFromDisk(unittest.TestCase):
+  def setUp(self):
+    self.data = np.random.randint(0, 256, size=16*4096+123, dtype=np.uint8)
+    pathlib.Path(fn:=temp("dt_copy_from_disk_io_uring")).write_bytes(self.data.tobytes())
+    self.device = f"disk:{fn}"
+    if not hasattr(Device[self.device.upper()], "io_uring"): self.skipTest("needs io_uring")
+
+  def _check(self, off:int, size:int):
+    t = Tensor.empty(len(self.data), device=self.device, dtype=dtypes.uint8)[off:off+size]
+    # many segments and few in flight
+    with Context(DISK_READ_SEGMENT=2*4096, DISK_READ_DEPTH=3): np.testing.assert_equal(t.to("CPU").numpy(), self.data[off:off+size])
+
+  def test_pages_into_dest(self):
+    from testgrad.runtime.ops_disk import DiskAllocator
+    with patch.object(DiskAllocator, "_copyout_sharded", side_effect=AssertionError("read to staging buffers")):
+      for off,size in [(0, 4096), (0, len(self.data)), (4096, 5*4096+7), (8192, len(self.data)-8192)]: self._check(off, size)
+
+  def test_unaligned(self):
+    for off,size in [(314, 3*4096), (991, len(self.data)-991), (4095, 4097)]: self._check(off, size)
+
+@unittest.skipIf(sys.platform == "win32", "needs MAP_PRIVATE")
+class TestDiskMmap(unittest.TestCase):
+  def setUp(self):
+    self.data = np.random.randint(0, 256, size=4*4096+123, dtype=np.uint8)
+    pathlib.Path(fn:=temp("dt_disk_mmap")).write_bytes(self.data.tobytes())
+    self.fn = fn
+
+  def _to_cpu(self, off:int, size:int) -> Tensor:
+    with Context(DISK_MMAP=1): return Tensor.empty(len(self.data), device=f"disk:{self.fn}", dtype=dtypes.uint8)[off:off+size].to("CPU").realize()
+
+  def test_maps_aligned(self):
+    for off in [0, 32, 4096, 4096+96]:
+      t = self._to_cpu(off, 5000)
+      self.assertIsNotNone(t.uop.base.buffer.options.external_ptr)
+      np.testing.assert_equal(t.numpy(), self.data[off:off+5000])
+
+  def test_copies_unaligned(self):
+    t = self._to_cpu(551, 5000)
+    self.assertIsNone(t.uop.base.buffer.options)
+    np.testing.assert_equal(t.numpy(), self.data[551:551+5000])
+
+  def test_write_doesnt_change_file(self):
+    t = self._to_cpu(4096, 8192)
+    t.assign(t+1).realize()
+    np.testing.assert_equal(t.numpy(), self.data[4096:4096+8192]+1)
+    self.assertEqual(pathlib.Path(self.fn).read_bytes(), self.data.tobytes())
+    # the next copy is the file again
+    np.testing.assert_equal(self._to_cpu(4096, 8192).numpy(), self.data[4096:4096+8192])
+
+class TestSafeSave(unittest.TestCase):
+  def _save(self, tensors:dict[str, Tensor], **kwargs) -> tuple[dict, bytes]:
+    # small segments, so the tensors are split over many writes
+    with Context(DISK_WRITE_SEGMENT=4096, DISK_WRITE_DEPTH=2, **kwargs): safe_save(tensors, fn:=temp("dt_safe_save"))
+    raw = pathlib.Path(fn).read_bytes()
+    return json.loads(raw[8:8+(n:=int.from_bytes(raw[:8], "little"))]), raw[8+n:]
+
+  def _check(self, tensors:dict[str, Tensor], **kwargs):
+    header, data = self._save(tensors, **kwargs)
+    for k,v in tensors.items():
+      self.assertEqual(header[k]["shape"], list(v.shape))
+      (st, en), ref = header[k]["data_offsets"], v.numpy()
+      np.testing.assert_equal(np.frombuffer(data[st:en], dtype=ref.dtype).reshape(ref.shape), ref)
+    self.assertEqual(len(data), sum(v.nbytes() for v in tensors.values()))
+
+  def test_streams_tensors(self):
+    a = Tensor(np.random.rand(60, 50).astype(np.float32))
+    self._check({"a": a, "t": a.T, "lazy": a[3:50:2]*2, "i": Tensor.arange(1000, dtype=dtypes.int16), "empty": Tensor.empty(0),
+                 "scalar": Tensor(3.0), "unallocated": Tensor.empty(10)})
+
+  def test_direct(self):
+    self._check({"a": Tensor(np.random.rand(3000).astype(np.float32)), "b": Tensor.arange(77, dtype=dtypes.uint8)}, DISK_WRITE_DIRECT=1)
+
+  def test_from_disk(self):
+    data = np.random.randint(0, 256, size=3*4096+5, dtype=np.uint8)
+    pathlib.Path(fn:=temp("dt_safe_save_src")).write_bytes(data.tobytes())
+    header, out = self._save({"d": Tensor.empty(len(data), device=f"disk:{fn}", dtype=dtypes.uint8)[5:]})
+    self.assertEqual(header["d"]["data_offsets"], [0, len(data)-5])
+    self.assertEqual(out, data[5:].tobytes())
+
+class TestSafeSaveAsync(unittest.TestCase):
+  def test_snapshot(self):
+    t = Tensor(np.arange(5000, dtype=np.float32)).realize()
+    fut = safe_save_async({"t": t, "empty": Tensor.empty(0)}, fn:=temp("dt_safe_save_async"), {"step": "1"})
+    # the checkpoint is the tensor when it was saved
+    t.assign(t+1).realize()
+    fut.result()
+    raw = pathlib.Path(fn).read_bytes()
+    header = json.loads(raw[8:8+(n:=int.from_bytes(raw[:8], "little"))])
+    self.assertEqual(header["__metadata__"], {"step": "1"})
+    np.testing.assert_equal(np.frombuffer(raw[8+n:], dtype=np.float32), np.arange(5000, dtype=np.float32))
+
+  def test_memory_cap(self):
+    saving, done = threading.Event(), threading.Event()
+    def slow_save(fn, srcs):
+      saving.set()
+      done.wait()
+    t = Tensor.ones(1000).contiguous().realize()
+    with patch("testgrad.nn.state._stream_save", slow_save), Context(DISK_WRITE_MEM=6000):
+      first = safe_save_async({"t": t}, temp("dt_safe_save_async_0"))
+      saving.wait()
+      # the second checkpoint doesn't fit next to the first one, it waits until the first one is saved
+      threading.Timer(0.1, done.set).start()
+      second = safe_save_async({"t": t}, temp("dt_safe_save_async_1"))
+      self.assertTrue(first.done())
+      second.result()
+
 class TestPathTensor(unittest.TestCase):
   def setUp(self):
     self.temp_dir = tempfile.TemporaryDirectory()
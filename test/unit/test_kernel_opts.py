@@ -0,0 +1,88 @@
+import unittest
+import numpy as np
+from testgrad import Tensor
+from testgrad.renderer import Opt, OptOps
+from testgrad.engine.realize import CompiledRunner, get_program
+from testgrad.opt.kernel import Kernel, KernelOptError
+from testgrad.opt.search import get_kernel_actions, bufs_from_lin
+from testgrad.opt.heuristic import hand_coded_optimizations
+from testgrad.helpers import Context
+from testgrad.device import Device
+
+def _run_with_opts(out:Tensor, opts:list[Opt]) -> np.ndarray:
+  si = out.schedule()[-1]
+  k = Kernel(si.ast).apply_opts(opts)
+  for b in si.bufs: b.ensure_allocated()
+  CompiledRunner(k.to_program())(list(si.bufs), {}, wait=True)
+  return si.bufs[0].numpy().reshape(out.shape)
+
+class TestKernelOpts(unittest.TestCase):
+  def setUp(self):
+    self.a, self.b = Tensor.rand(16, 32).realize(), Tensor.rand(32, 8).realize()
+
+  def test_matmul_opts(self):
+    expected = self.a.numpy() @ self.b.numpy()
+    for opts in [[], [Opt(OptOps.UPCAST, 1, 4)], [Opt(OptOps.UPCAST, 1, 0)], [Opt(OptOps.UNROLL, 0, 4)], [Opt(OptOps.SWAP, 0, 1)],
+                 [Opt(OptOps.UPCAST, 0, 4), Opt(OptOps.UPCAST, 1, 4), Opt(OptOps.UNROLL, 0, 2)]]:
+      np.testing.assert_allclose(_run_with_opts(self.a@self.b, opts), expected, rtol=1e-5, err_msg=str(opts))
+
+  def test_sum_opts(self):
+    np.testing.assert_allclose(_run_with_opts(self.a.sum(1), [Opt(OptOps.UNROLL, 0, 0)]), self.a.numpy().sum(1), rtol=1e-5)
+
+  def test_invalid_opts(self):
+    k = Kernel((self.a@self.b).schedule()[-1].ast)
+    with self.assertRaises(KernelOptError): k.apply_opt(Opt(OptOps.UPCAST, 0, 5))
+    with self.assertRaises(KernelOptError): k.apply_opt(Opt(OptOps.UNROLL, 0, 64))
+    with self.assertRaises(KernelOptError): k.apply_opt(Opt(OptOps.UPCAST, 2, 2))
+    self.assertEqual(k.applied_opts, [])
+
+  def test_kernel_actions(self):
+    k = Kernel((self.a@self.b).schedule()[-1].ast)
+    acted = get_kernel_actions(k)
+    self.assertIs(acted[0], k)
+    self.assertGreater(len(acted), 1)
+    for lin in acted.values(): self.assertEqual(len(lin.applied_opts), 0 if lin is k else 1)
+
+  def test_bufs_from_lin(self):
+    k = Kernel((self.a@self.b).schedule()[-1].ast)
+    self.assertEqual([b.size for b in bufs_from_lin(k, allocate=False)], [16*8, 16*32, 32*8])
+
+class TestHandCodedOpts(unittest.TestCase):
+  def test_matmul_upcasts_contiguous_axis(self):
+    a, b = Tensor.rand(64, 64).realize(), Tensor.rand(64, 64).realize()
+    opts = hand_coded_optimizations(Kernel((a@b).schedule()[-1].ast))
+    self.assertEqual(opts[0], Opt(OptOps.UPCAST, 1, 4))
+    self.assertIn(OptOps.UNROLL, [o.op for o in opts])
+    np.testing.assert_allclose((a@b).numpy(), a.numpy()@b.numpy(), rtol=1e-5)
+
+  def test_applied_opts_recorded(self):
+    a = Tensor.rand(32, 32).realize()
+    si = (a+1).schedule()[-1]
+    self.assertEqual(get_program(si.ast, Device[Device.DEFAULT].renderer).applied_opts, (Opt(OptOps.UPCAST, 1, 4),))
+    with Context(NOOPT=1): self.assertEqual(get_program(si.ast, Device[Device.DEFAULT].renderer).applied_opts, ())
+
+class TestThreads(unittest.TestCase):
+  def test_threaded_elementwise(self):
+    with Context(CPU_COUNT=4):
+      x = Tensor.rand(1024, 1024).realize()
+      p = get_program((x*2+1).schedule()[-1].ast, Device["CPU"].renderer)
+      self.assertEqual(p.applied_opts[-1].op, OptOps.THREAD)
+      self.assertEqual(p.global_size, [4, 1, 1])
+      np.testing.assert_allclose((x*2+1).numpy(), x.numpy()*2+1)
+
+  def test_threaded_opts(self):
+    a, b = Tensor.rand(16, 32).realize(), Tensor.rand(32, 8).realize()
+    with Context(CPU_COUNT=4):
+      for opts in [[Opt(OptOps.THREAD, 0, 4)], [Opt(OptOps.THREAD, 1, 2), Opt(OptOps.UPCAST, 1, 4)], [Opt(OptOps.UPCAST, 1, 4), Opt(OptOps.THREAD, 0, 4)]]:
+        np.testing.assert_allclose(_run_with_opts(a@b, opts), a.numpy()@b.numpy(), rtol=1e-5, err_msg=str(opts))
+
+  def test_too_many_threads(self):
+    k = Kernel((Tensor.rand(16, 32).realize()+1).schedule()[-1].ast)
+    with Context(CPU_COUNT=2):
+      with self.assertRaises(KernelOptError): k.apply_opt(Opt(OptOps.THREAD, 0, 4))
+      k.apply_opt(Opt(OptOps.THREAD, 0, 2))
+      with self.assertRaises(KernelOptError): k.apply_opt(Opt(OptOps.THREAD, 1, 2))
+      with self.assertRaises(KernelOptError): k.apply_opt(Opt(OptOps.UPCAST, 0, 2))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+import numpy as np
+from testgrad import Tensor
+from testgrad.helpers import Context
+from testgrad.engine.realize import run_schedule
+from testgrad.engine.memory import _ArenaPlanner
+
+def _chain(n=6):
+  x = Tensor.ones(64, 64).contiguous().realize()
+  for _ in range(n): x = (x*1.5+1).contiguous()
+  return x.sum(0)
+
+def _chain_np(n=6):
+  v = np.ones((64, 64))
+  for _ in range(n): v = v*1.5+1
+  return v.sum(0)
+
+class TestMemoryPlanner(unittest.TestCase):
+  def test_intermediates_share_arena(self):
+    out = _chain()
+    sched = out.schedule()
+    intermediates = [b for si in sched for b in si.bufs if b._base is not None]
+    self.assertGreater(len(intermediates), 0)
+    # the whole chain ping-pongs between two offsets in one arena
+    self.assertEqual(len({b._base for b in intermediates}), 1)
+    self.assertEqual(len({b.offset for b in intermediates}), 2)
+    run_schedule(sched)
+    np.testing.assert_allclose(out.numpy(), _chain_np(), rtol=1e-5)
+
+  def test_tensor_buffers_not_planned(self):
+    a = Tensor.ones(16, 16).contiguous().realize()
+    b = ((a+1).contiguous()*2).contiguous()
+    c = b.sum(0)
+    sched = c.schedule(b)
+    for si in sched:
+      for buf in si.bufs:
+        if buf.uop_refcount > 0: self.assertIsNone(buf._base)
+    run_schedule(sched)
+    np.testing.assert_equal(b.numpy(), np.full((16, 16), 4.0))
+    np.testing.assert_equal(c.numpy(), np.full((16,), 64.0))
+
+  def test_no_memory_planner(self):
+    with Context(NO_MEMORY_PLANNER=1): sched = _chain().schedule()
+    self.assertTrue(all(b._base is None for si in sched for b in si.bufs))
+
+  def test_arena_planner(self):
+    p = _ArenaPlanner(block_size=16)
+    a, b = p.alloc(16), p.alloc(32)
+    p.free(a, 16)
+    self.assertEqual(p.alloc(8), a)
+    p.free(b, 32)
+    self.assertEqual(p.alloc(40), 16)
+    self.assertEqual(p.size, 64)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+from unittest.mock import patch
+import numpy as np
+from testgrad import Tensor, dtypes
+from testgrad.engine import realize
+
+def _t(x, dtype=None) -> Tensor: return Tensor(np.array(x), device="NPY", dtype=dtype)
+X = np.linspace(-3, 3, 6*10, dtype=np.float32).reshape(6, 10)
+
+class TestNpyDevice(unittest.TestCase):
+  def setUp(self):
+    # the kernel ASTs run without codegen
+    self.patch = patch.object(realize, "get_program", side_effect=AssertionError("NPY rendered a kernel"))
+    self.patch.start()
+  def tearDown(self): self.patch.stop()
+
+  def test_elementwise(self):
+    x = _t(X)
+    np.testing.assert_allclose((x.exp() * 2 - x.abs().sqrt() / 3).numpy(), np.exp(X) * 2 - np.sqrt(np.abs(X)) / 3, rtol=1e-6, atol=1e-6)
+    np.testing.assert_equal((x > 0).where(x, -x).numpy(), np.abs(X))
+    np.testing.assert_allclose((x ** 2).numpy(), X ** 2, rtol=1e-6)
+
+  def test_int(self):
+    a, b = np.array([-7, -3, 3, 7, 1000], dtype=np.int32), np.array([2, -2, 3, -3, 7], dtype=np.int32)
+    # C division and remainder truncate toward zero
+    np.testing.assert_equal(_t(a).idiv(_t(b)).numpy(), np.trunc(a / b).astype(np.int32))
+    np.testing.assert_equal((_t(a).cast(dtypes.uint8) + 250).numpy(), (a.astype(np.uint8) + 250).astype(np.uint8))
+    np.testing.assert_equal(_t(X).bitcast(dtypes.uint32).numpy(), X.view(np.uint32))
+
+  def test_reduce(self):
+    x = _t(X)
+    np.testing.assert_allclose(x.sum(1).numpy(), X.sum(1), rtol=1e-6)
+    np.testing.assert_equal(x.max(0).numpy(), X.max(0))
+    np.testing.assert_equal(x.argmax(1).numpy(), X.argmax(1))
+    np.testing.assert_allclose((x @ x.T).numpy(), X @ X.T, rtol=1e-5)
+    np.testing.assert_allclose(x.softmax(1).numpy(), np.exp(X) / np.exp(X).sum(1, keepdims=True), rtol=1e-5)
+
+  def test_movement(self):
+    x = _t(X)
+    np.testing.assert_equal(x[::2, ::-3].contiguous().numpy(), X[::2, ::-3])
+    np.testing.assert_equal(x.pad(((1, 2), (3, 0)), value=-1).numpy(), np.pad(X, ((1, 2), (3, 0)), constant_values=-1))
+    np.testing.assert_allclose(x.cumsum(0).numpy(), X.cumsum(0), rtol=1e-5, atol=1e-6)
+    np.testing.assert_equal(x.T.reshape(5, 12)[1:4].flip(1).contiguous().numpy(), X.T.reshape(5, 12)[1:4, ::-1])
+
+  def test_inplace(self):
+    x = _t(np.arange(20, dtype=np.float32)).contiguous().realize()
+    x.assign(x * 2 + 1).realize()
+    x.assign(x[::-1] - x).realize()
+    np.testing.assert_equal(x.numpy(), (np.arange(20)*2+1)[::-1] - (np.arange(20)*2+1))
+
+  def test_multioutput(self):
+    x = _t(np.arange(12, dtype=np.float32))
+    a, b = (x + 1).contiguous(), (x * 2).contiguous()
+    Tensor.realize(a, b)
+    np.testing.assert_equal(a.numpy(), np.arange(12) + 1)
+    np.testing.assert_equal(b.numpy(), np.arange(12) * 2)
+
+  def test_backward(self):
+    w = _t(X, dtypes.float).requires_grad_()
+    (w.relu() * 3).sum().backward()
+    np.testing.assert_equal(w.grad.numpy(), (X > 0) * 3.0)
+
+  def test_rand_matches_cpu(self):
+    Tensor.manual_seed(3)
+    out = Tensor.rand(13, 7, device="NPY").numpy()
+    self.patch.stop()
+    Tensor.manual_seed(3)
+    np.testing.assert_equal(out, Tensor.rand(13, 7, device="CPU").numpy())
+    self.patch.start()
+
+if __name__ == '__main__':
+  unittest.main()
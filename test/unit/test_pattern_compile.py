@@ -0,0 +1,93 @@
+import unittest
+from unittest.mock import patch
+from testgrad.dtype import dtypes
+from testgrad.uop.ops import UOp, Ops, UPat, PatternMatcher, graph_rewrite
+from testgrad.uop.symbolic import symbolic
+from testgrad.uop import upat
+from testgrad.uop.upat import _get_paths, pm_compile
+
+def _rewrite(u:UOp, pm:PatternMatcher) -> UOp|None: return pm.rewrite(u)
+
+class TestPatternCompile(unittest.TestCase):
+  def test_same_as_interpreted(self):
+    interpreted = PatternMatcher(symbolic.patterns, compiled=False)
+    a, b = UOp.variable("a", 0, 10), UOp.variable("b", 1, 8)
+    for u in [(a+0)*1, (a*2+4)//2, (a+b)-(a+b), (a<b).where(a, a), (a*4)%2, -(-a), a*b+a*3, (a+b)//b, a.cast(dtypes.int).cast(dtypes.int)]:
+      self.assertIs(graph_rewrite(u, symbolic), graph_rewrite(u, interpreted, name="interpreted"))
+
+  def test_one_function_per_op(self):
+    pm = PatternMatcher([(UPat(Ops.ADD, src=(UPat.var("x"), UPat.cvar("c"))), lambda x,c: x if c.arg == 0 else None),
+                         (UPat(Ops.MUL, src=(UPat.var("x"), UPat.cvar("c"))), lambda x,c: x if c.arg == 1 else None)], compiled=True)
+    a = UOp.variable("a", 0, 10)
+    self.assertIs(_rewrite(a+0, pm), a)
+    self.assertEqual(list(pm.dispatch), [Ops.ADD])
+    self.assertIsNone(_rewrite(a*2, pm))
+    self.assertEqual(list(pm.dispatch), [Ops.ADD, Ops.MUL])
+
+  def test_first_match_wins(self):
+    pm = PatternMatcher([(UPat(Ops.ADD, src=(UPat.var("x"), UPat.cvar("c"))), lambda x,c: x.const_like(1)),
+                         (UPat(Ops.ADD, src=(UPat.var("x"), UPat.var("y"))), lambda x,y: x.const_like(2))])
+    a = UOp.variable("a", 0, 10)
+    self.assertEqual(_rewrite(a+3, pm).arg, 1)
+    self.assertEqual(_rewrite(a+a, pm).arg, 2)
+
+  def test_none_and_self_fall_through(self):
+    pm = PatternMatcher([(UPat(Ops.ADD, name="x"), lambda x: None), (UPat(Ops.ADD, name="x"), lambda x: x),
+                         (UPat(Ops.ADD, name="x"), lambda x: x.const_like(7))])
+    self.assertEqual(_rewrite(UOp.variable("a", 0, 10)+1, pm).arg, 7)
+
+  def test_many_ors(self):
+    # commutative patterns inside a commutative pattern fork into more paths than the old single UPat compiler allowed
+    p = UPat(Ops.ADD, src=[UPat(Ops.MUL, src=[UPat.var("x"), UPat.cvar("c1")]), UPat(Ops.MUL, src=[UPat.var("x"), UPat.cvar("c2")])])
+    self.assertEqual(len(_get_paths(p)), 8)
+    pm = PatternMatcher([(p, lambda x,c1,c2: x*(c1+c2))])
+    a = UOp.variable("a", 0, 10)
+    self.assertIs(_rewrite(a*2+3*a, pm), a*(a.const_like(2)+3))
+    self.assertIsNone(_rewrite(a*2+3*UOp.variable("b", 0, 10), pm))
+
+  def test_custom_early_reject(self):
+    pm = PatternMatcher([(UPat(Ops.ADD, name="x", custom_early_reject={Ops.MUL}), lambda x: x.const_like(0))])
+    a = UOp.variable("a", 0, 10)
+    self.assertIsNone(_rewrite(a+1, pm))
+    self.assertEqual(_rewrite(a*2+1, pm).arg, 0)
+
+  def test_uncompilable_interpreted(self):
+    # a UPat that matches all the sources of the uop isn't compiled, it's interpreted in its place in the order
+    p = UPat(Ops.VECTORIZE, src=UPat(Ops.CONST, name="c"), name="v")
+    self.assertIsNone(_get_paths(p))
+    pm = PatternMatcher([(UPat(Ops.VECTORIZE, src=(UPat.var("x"),)), lambda x: x), (p, lambda v,c: v.src[0]),
+                         (UPat(Ops.VECTORIZE, name="v"), lambda v: v.src[-1])])
+    c, a = UOp.const(dtypes.int, 1), UOp.variable("a", 0, 10)
+    self.assertIs(_rewrite(UOp(Ops.VECTORIZE, dtypes.int.vec(2), (c, c+0)), pm), c+0)
+    self.assertIs(_rewrite(UOp(Ops.VECTORIZE, dtypes.int.vec(2), (c, c)), pm), c)
+    self.assertIs(_rewrite(UOp(Ops.VECTORIZE, dtypes.int.vec(2), (c, c.const_like(2))), pm), c.const_like(2))
+    self.assertIs(_rewrite(UOp(Ops.VECTORIZE, dtypes.int.vec(2), (c, a)), pm), a)
+
+class TestPatternCompileCache(unittest.TestCase):
+  def test_loaded_from_disk(self):
+    pats = [(UPat(Ops.ADD, src=(UPat.var("x"), UPat.cvar("c", dtypes.int))), lambda x,c: x if c.arg == 0 else None),
+            (UPat(Ops.ADD, dtype=dtypes.float, name="x"), lambda x: x.src[0])]
+    pm_compile(pats, "match_cached")
+    with patch.object(upat, "_render_matcher", side_effect=AssertionError("compiled again")): fxn = pm_compile(pats, "match_cached")
+    a = UOp.variable("a", 0, 10)
+    self.assertIs(fxn(a+0, None), a)
+    self.assertIsNone(fxn(a+1, None))
+    self.assertIs(fxn(UOp.const(dtypes.float, 1.0)+2.0, None), UOp.const(dtypes.float, 1.0))
+
+  def test_key_has_location(self):
+    # the same UPat in another place has its own entry
+    p1 = UPat(Ops.MUL, name="x")
+    p2 = UPat(Ops.MUL, name="x")
+    pm_compile([(p1, lambda x: None)], "match_location")
+    with patch.object(upat, "_render_matcher", side_effect=AssertionError("compiled again")):
+      with self.assertRaises(AssertionError): pm_compile([(p2, lambda x: None)], "match_location")
+
+  def test_unpicklable_arg(self):
+    class Arg: pass
+    arg = Arg()
+    fxn = pm_compile([(UPat(Ops.NOOP, arg=arg, name="x"), lambda x: x.replace(arg=None))], "match_unpicklable")
+    self.assertIs(fxn(UOp(Ops.NOOP, arg=arg), None), UOp(Ops.NOOP))
+    self.assertIsNone(fxn(UOp(Ops.NOOP, arg=1), None))
+
+if __name__ == '__main__':
+  unittest.main()
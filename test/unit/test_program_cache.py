@@ -0,0 +1,52 @@
+import unittest
+from unittest.mock import patch
+import numpy as np
+from testgrad import Tensor, Device
+from testgrad.helpers import Context
+from testgrad.uop.ops import Ops
+from testgrad.engine import realize
+from testgrad.engine.realize import method_cache, run_schedule, program_cache_get
+
+def _fresh(c:float):
+  a = Tensor.ones(8, 8).contiguous().realize()
+  return ((a*c).relu() @ a).sum(1)
+
+class TestProgramCache(unittest.TestCase):
+  def test_warm_skips_codegen(self):
+    c = float(np.random.uniform(1, 2))
+    sched = _fresh(c).schedule()
+    run_schedule(sched[:])
+    asts = [si.ast for si in sched if si.ast.op is Ops.SINK]
+    self.assertTrue(all(program_cache_get("CPU", ast) is not None for ast in asts))
+    # a new process has an empty method cache, nothing is rendered again
+    method_cache.clear()
+    with patch.object(realize, "get_program", side_effect=AssertionError("codegen ran")):
+      out = _fresh(c)
+      np.testing.assert_allclose(out.numpy(), np.full(8, 8*8*c, dtype=np.float32), rtol=1e-6)
+
+  def test_estimates_kept(self):
+    c = float(np.random.uniform(1, 2))
+    sched = _fresh(c).schedule()
+    run_schedule(sched[:])
+    ast = next(si.ast for si in sched if si.ast.op is Ops.SINK)
+    prg, _ = program_cache_get("CPU", ast)
+    self.assertIsNone(prg.uops)
+    self.assertGreater(prg.estimates.ops, 0)
+
+  def test_context_in_key(self):
+    c = float(np.random.uniform(1, 2))
+    sched = _fresh(c).schedule()
+    run_schedule(sched[:])
+    ast = next(si.ast for si in sched if si.ast.op is Ops.SINK)
+    with Context(NOOPT=1): self.assertIsNone(program_cache_get("CPU", ast))
+
+  def test_disabled_without_compiler_cache(self):
+    c = float(np.random.uniform(1, 2))
+    with patch.object(Device["CPU"].compiler, "cachekey", None):
+      sched = _fresh(c).schedule()
+      run_schedule(sched[:])
+    ast = next(si.ast for si in sched if si.ast.op is Ops.SINK)
+    self.assertIsNone(program_cache_get("CPU", ast))
+
+if __name__ == '__main__':
+  unittest.main()
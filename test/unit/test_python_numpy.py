@@ -0,0 +1,96 @@
+import unittest, sys
+from unittest.mock import patch
+import numpy as np
+from testgrad import Tensor, dtypes
+from testgrad.runtime import ops_python
+from testgrad.runtime.ops_python import PythonProgram
+
+def _run(fxn, vectorized:bool) -> tuple[np.ndarray, list[bool]]:
+  ran: list[bool] = []
+  run_numpy = PythonProgram._run_numpy
+  def spy(self, *args):
+    ran.append(ret:=run_numpy(self, *args) if vectorized else False)
+    return ret
+  with patch.object(PythonProgram, "_run_numpy", spy): return fxn().numpy(), ran
+
+def _t(x, dtype=dtypes.float) -> Tensor: return Tensor(np.array(x), device="PYTHON", dtype=dtype)
+FLOATS = [-3.5, -1.0, -0.0, 0.0, 0.1, 0.5, 1.0, 2.5, 100.0, 1e30, float("inf"), -float("inf"), float("nan")]
+INTS = [-2**31, -1000, -7, -3, -1, 0, 1, 2, 3, 7, 1000, 2**31-1]
+
+class TestPythonNumpy(unittest.TestCase):
+  def _check(self, fxn):
+    # the numpy engine gives the same bits as the scalar interpreter
+    ref, _ = _run(fxn, False)
+    out, ran = _run(fxn, True)
+    np.testing.assert_equal(out, ref)
+    self.assertTrue(len(ran) and all(ran), "a kernel ran in the scalar interpreter")
+
+  def test_unary(self):
+    for op in [Tensor.exp2, Tensor.log2, Tensor.sqrt, Tensor.sin, Tensor.reciprocal, Tensor.neg, Tensor.exp, Tensor.relu, Tensor.sigmoid]:
+      with self.subTest(op=op.__name__): self._check(lambda: op(_t(FLOATS)))
+
+  def test_binary(self):
+    for op in [Tensor.add, Tensor.sub, Tensor.mul, Tensor.div, Tensor.maximum, Tensor.__lt__, Tensor.__eq__]:
+      with self.subTest(op=op.__name__): self._check(lambda: op(_t(FLOATS).reshape(-1, 1), _t(FLOATS)))
+    # pow casts to int, the scalar interpreter can't cast inf
+    self._check(lambda: _t(FLOATS[:-3]).reshape(-1, 1).pow(_t(FLOATS[:-3])))
+
+  def test_int(self):
+    a, b = _t(INTS, dtypes.int).reshape(-1, 1), _t([-3, -2, 1, 2, 7], dtypes.int)
+    for op in [Tensor.add, Tensor.mul, Tensor.__floordiv__, Tensor.__mod__, Tensor.__xor__, Tensor.maximum, Tensor.__lt__]:
+      with self.subTest(op=op.__name__): self._check(lambda: op(a, b))
+    self._check(lambda: (a.cast(dtypes.uint32) << 3) + (a.cast(dtypes.uint32) >> 2))
+    self._check(lambda: _t(INTS, dtypes.int).cast(dtypes.uint8) + 200)
+
+  def test_casts(self):
+    for dt in [dtypes.int8, dtypes.uint8, dtypes.int32, dtypes.uint32, dtypes.bool, dtypes.float64]:
+      with self.subTest(dtype=dt): self._check(lambda: _t(FLOATS[:-3]).cast(dt))
+    self._check(lambda: _t(FLOATS).bitcast(dtypes.uint32))
+
+  @unittest.skipIf(sys.version_info < (3, 12), "the scalar interpreter needs memoryview half support")
+  def test_half(self):
+    self._check(lambda: (_t(FLOATS).cast(dtypes.half) * 3 + 65000).cast(dtypes.float))
+
+  def test_reduce(self):
+    x = _t(np.linspace(-3, 3, 24*17, dtype=np.float32).reshape(24, 17))
+    self._check(lambda: x.sum(1))
+    self._check(lambda: x.max(0))
+    self._check(lambda: x.argmax(1))
+    self._check(lambda: x.softmax(1))
+    self._check(lambda: x @ x.T)
+
+  def test_gated(self):
+    x = _t(np.arange(60, dtype=np.float32).reshape(6, 10))
+    self._check(lambda: x.pad(((1, 2), (3, 0)), value=-1).cumsum(0))
+    self._check(lambda: x[::2, 1:9:3].contiguous())
+    self._check(lambda: (x > 20).where(x, x.flip(1)))
+
+  def test_rand(self):
+    def rand():
+      Tensor.manual_seed(3)
+      return Tensor.rand(13, 7, device="PYTHON")
+    self._check(rand)
+
+  def test_inplace(self):
+    def assign():
+      (x:=_t(np.arange(20, dtype=np.float32))).realize()
+      x.assign(x*2+1).realize()
+      x[3:7] = 5
+      return x
+    self._check(assign)
+
+  def test_fallback_restores_buffers(self):
+    store = ops_python._np_store
+    def store_then_fall_back(*args):
+      store(*args)
+      raise ops_python._Fallback
+    (x:=_t(np.arange(20, dtype=np.float32))).realize()
+    with patch.object(ops_python, "_np_store", store_then_fall_back): x.assign(x*2+1).realize()
+    np.testing.assert_equal(x.numpy(), np.arange(20)*2+1)
+
+  def test_sequential_past_max_lanes(self):
+    x = _t(np.arange(64*8, dtype=np.float32).reshape(64, 8))
+    with patch.object(ops_python, "MAX_LANES", 16): self._check(lambda: (x*2).sum(1) + x[:, 0])
+
+if __name__ == '__main__':
+  unittest.main()
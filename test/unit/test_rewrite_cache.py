@@ -0,0 +1,61 @@
+import unittest, gc, weakref
+from testgrad import Tensor
+from testgrad.dtype import dtypes
+from testgrad.helpers import Context
+from testgrad.uop.ops import UOp, Ops, UPat, PatternMatcher, graph_rewrite, rewrite_cache_stats
+from testgrad.uop.symbolic import symbolic
+
+def _expr(n:int) -> UOp: return ((UOp.variable("a", 0, 10)+n)*2+0)//2
+
+class TestRewriteCache(unittest.TestCase):
+  def setUp(self): rewrite_cache_stats.update(hits=0, misses=0)
+
+  def test_second_rewrite_hits(self):
+    ret = graph_rewrite(_expr(1), symbolic)
+    misses = rewrite_cache_stats["misses"]
+    self.assertGreater(misses, 0)
+    self.assertIs(graph_rewrite(_expr(1), symbolic), ret)
+    self.assertEqual(rewrite_cache_stats["misses"], misses)
+    self.assertGreater(rewrite_cache_stats["hits"], 0)
+
+  def test_subgraph_hits(self):
+    graph_rewrite(_expr(2), symbolic)
+    # the variable and the add are shared, they aren't rewritten again
+    graph_rewrite(_expr(2)+3, symbolic)
+    self.assertGreater(rewrite_cache_stats["hits"], 0)
+
+  def test_same_as_uncached(self):
+    with Context(REWRITE_CACHE=0): ref = graph_rewrite(_expr(3)*4, symbolic)
+    self.assertEqual(rewrite_cache_stats, {"hits": 0, "misses": 0})
+    self.assertIs(graph_rewrite(_expr(3)*4, symbolic), ref)
+    self.assertIs(graph_rewrite(_expr(3)*4, symbolic), ref)
+
+  def test_ctx_not_cached(self):
+    pm = PatternMatcher([(UPat(Ops.CONST, name="x"), lambda ctx,x: ctx.get(x))])
+    a, b = UOp.const(dtypes.int, 1), UOp.const(dtypes.int, 2)
+    self.assertIs(graph_rewrite(a+3, pm, {a:b}), b+3)
+    self.assertIs(graph_rewrite(a+3, pm, {}), a+3)
+    self.assertEqual(pm.rewrite_caches, {})
+
+  def test_memoize_false(self):
+    pm = PatternMatcher([(UPat(Ops.DEFINE_VAR, name="x"), lambda x: UOp.unique().cast(dtypes.int) if x.arg[0] == "u" else None)], memoize=False)
+    self.assertIsNot(graph_rewrite(UOp.variable("u", 0, 4)+1, pm), graph_rewrite(UOp.variable("u", 0, 4)+1, pm))
+    self.assertEqual(pm.rewrite_caches, {})
+    self.assertFalse((pm+symbolic).memoize)
+
+  def test_tensor_graph_not_kept(self):
+    # rewriting a Tensor graph doesn't keep it, or the BUFFERs in it, alive
+    t = Tensor.ones(4).contiguous().realize()+2
+    graph_rewrite(t.uop, symbolic)
+    ref = weakref.ref(t.uop.base.src[0].base)
+    del t
+    gc.collect()
+    self.assertIsNone(ref())
+
+  def test_bounded(self):
+    with Context(REWRITE_CACHE=8):
+      for i in range(20): graph_rewrite(_expr(100+i), symbolic)
+      self.assertLessEqual(len(symbolic.rewrite_cache(False).kept), 8)
+
+if __name__ == '__main__':
+  unittest.main()
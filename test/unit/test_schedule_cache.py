@@ -0,0 +1,79 @@
+import unittest
+from unittest.mock import patch
+import numpy as np
+from testgrad import Tensor, tensor
+from testgrad.helpers import Context
+from testgrad.engine.schedule import schedule_cache
+
+def _step(x:Tensor, w:Tensor) -> Tensor: return ((x @ w).relu() * 0.5).sum(1)
+
+class TestScheduleCache(unittest.TestCase):
+  def setUp(self): schedule_cache.clear()
+
+  def test_hit_skips_kernelize(self):
+    w = Tensor.ones(8, 8).contiguous().realize()
+    _step(Tensor(np.full((2, 8), 1.0, np.float32)), w).numpy()
+    # only the input buffer is different
+    with patch.object(tensor, "get_kernelize_map", side_effect=AssertionError("kernelize ran")):
+      for i in range(2, 4):
+        out = _step(Tensor(np.full((2, 8), i, np.float32)), w)
+        np.testing.assert_equal(out.numpy(), np.full(2, 32.0*i))
+
+  def test_new_buffers_on_hit(self):
+    w = Tensor.ones(8, 8).contiguous().realize()
+    a = _step(Tensor.full((2, 8), 1.0).contiguous().realize(), w).realize()
+    b = _step(Tensor.full((2, 8), 2.0).contiguous().realize(), w).realize()
+    self.assertIsNot(a.uop.base.buffer, b.uop.base.buffer)
+    np.testing.assert_equal(a.numpy(), np.full(2, 32.0))
+    np.testing.assert_equal(b.numpy(), np.full(2, 64.0))
+
+  def test_different_structure_misses(self):
+    w = Tensor.ones(8, 8).contiguous().realize()
+    _step(Tensor.ones(2, 8).contiguous().realize(), w).realize()
+    n = len(schedule_cache)
+    (_step(Tensor.ones(2, 8).contiguous().realize(), w) + 1).realize()
+    self.assertEqual(len(schedule_cache), n+1)
+
+  def test_assign(self):
+    w = Tensor.zeros(4).contiguous().realize()
+    for i in range(4): w.assign(w + Tensor.full((4,), float(i)).contiguous().realize()).realize()
+    np.testing.assert_equal(w.numpy(), np.full(4, 6.0))
+
+  def test_unrealized_tensor_in_graph(self):
+    w = Tensor.ones(8, 8).contiguous().realize()
+    for i in range(3):
+      # h is rewritten by kernelize, it's rebound with the sum
+      h = (Tensor(np.full((2, 8), i, np.float32)) @ w).relu()
+      np.testing.assert_equal(h.sum(1).numpy(), np.full(2, 64.0*i))
+      np.testing.assert_equal(h.numpy(), np.full((2, 8), 8.0*i))
+
+  def test_tensor_built_on_graph(self):
+    w = Tensor.ones(8, 8).contiguous().realize()
+    x = Tensor.ones(2, 8).contiguous().realize()
+    n = len(schedule_cache)
+    # d isn't in the graph of the sum, this isn't cached
+    h = (x @ w).relu()
+    d = h + 1
+    h.sum(1).realize()
+    self.assertEqual(len(schedule_cache), n)
+    np.testing.assert_equal(d.numpy(), np.full((2, 8), 9.0))
+
+  def test_unrelated_tensor(self):
+    # an unrealized Tensor that only shares the device with the graph doesn't stop caching
+    u = Tensor.full((4,), 2.0).contiguous().realize() + 1
+    w, x = Tensor.ones(8, 8).contiguous().realize(), Tensor.ones(2, 8).contiguous().realize()
+    n = len(schedule_cache)
+    _step(x, w).realize()
+    self.assertEqual(len(schedule_cache), n+1)
+    np.testing.assert_equal(u.numpy(), np.full(4, 3.0))
+
+  def test_disabled(self):
+    with Context(SCHEDULE_CACHE=0): _step(Tensor.ones(2, 8).contiguous().realize(), Tensor.ones(8, 8).contiguous().realize()).realize()
+    self.assertEqual(len(schedule_cache), 0)
+  def test_size(self):
+    with Context(SCHEDULE_CACHE=2):
+      for i in range(4): (Tensor.ones(4).contiguous().realize() + i).realize()
+    self.assertEqual(len(schedule_cache), 2)
+
+if __name__ == '__main__':
+  unittest.main()
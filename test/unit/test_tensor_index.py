@@ -0,0 +1,51 @@
+import unittest, gc
+from unittest.mock import patch
+import numpy as np
+from testgrad import Tensor, tensor
+from testgrad.helpers import Context
+from testgrad.tensor import uop_tensors, _find_all_tensors_for_uops
+
+class TestTensorIndex(unittest.TestCase):
+  def test_indexed(self):
+    a = Tensor.ones(4).contiguous()
+    self.assertEqual(_find_all_tensors_for_uops([a.uop]), [a])
+    b = Tensor(a.uop)
+    self.assertCountEqual(_find_all_tensors_for_uops([a.uop]), [a, b])
+
+  def test_reassigned(self):
+    a, b = Tensor.ones(4).contiguous(), Tensor.zeros(4).contiguous()
+    old = a.uop
+    a.replace(b)
+    self.assertEqual(_find_all_tensors_for_uops([old]), [])
+    self.assertCountEqual(_find_all_tensors_for_uops([b.uop]), [a, b])
+
+  def test_collected(self):
+    u = (a:=Tensor.ones(4).contiguous()+3).uop
+    del a
+    gc.collect()
+    self.assertNotIn(u, uop_tensors)
+
+  def test_realize_updates_index(self):
+    a = Tensor.ones(4).contiguous()+1
+    a.realize()
+    self.assertEqual(_find_all_tensors_for_uops([a.uop]), [a])
+    np.testing.assert_equal(a.numpy(), np.full(4, 2.0))
+
+  def test_unrelated_tensors_not_visited(self):
+    # Tensors on the same device that kernelize doesn't change aren't in the map that's applied
+    others = [Tensor.empty(4) for _ in range(100)]
+    x = Tensor.ones(4).contiguous().realize()
+    found: list[int] = []
+    def find(uops):
+      found.append(len(ret:=_find_all_tensors_for_uops(uops)))
+      return ret
+    with Context(SCHEDULE_CACHE=0), patch.object(tensor, "_find_all_tensors_for_uops", find): (x+2).realize()
+    self.assertLess(max(found), len(others))
+
+  def test_backward(self):
+    w = Tensor.ones(4, requires_grad=True)
+    (w*3).sum().backward()
+    np.testing.assert_equal(w.grad.numpy(), np.full(4, 3.0))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+from unittest.mock import patch
+import numpy as np
+from testgrad import Tensor, Device
+from testgrad.helpers import Context
+from testgrad.uop.ops import Ops
+from testgrad.engine.realize import lower_schedule_item, program_cache_get, TieredRunner, CompiledRunner, ExecItem
+
+def _fresh_matmul() -> tuple[ExecItem, np.ndarray]:
+  # a new constant every time, so nothing is in the method or program cache
+  c = float(np.random.uniform(1, 2))
+  x = Tensor(np.arange(32*32, dtype=np.float32).reshape(32, 32) / 1024).realize()
+  si = next(si for si in ((x @ x) * c).schedule() if si.ast.op is Ops.SINK)
+  return lower_schedule_item(si), (x.numpy() @ x.numpy()) * np.float32(c)
+
+def _tier_up(ei:ExecItem):
+  ei.prg.pending[1].result()
+  ei.run()
+
+class TestTieredCompile(unittest.TestCase):
+  def test_off_by_default(self):
+    ei, _ = _fresh_matmul()
+    self.assertNotIsInstance(ei.prg, TieredRunner)
+
+  def test_tier_up(self):
+    with Context(TIER_UP=3):
+      ei, ref = _fresh_matmul()
+      self.assertIsInstance(ei.prg, TieredRunner)
+      # the fast tier has no opts and comes from the fast compiler
+      self.assertEqual(ei.prg.p.applied_opts, ())
+      for _ in range(2): ei.run()
+      self.assertIsNone(ei.prg.pending)
+      ei.run()
+      self.assertIsNotNone(ei.prg.pending)
+      np.testing.assert_allclose(ei.bufs[0].numpy().reshape(32, 32), ref, rtol=1e-5)
+      _tier_up(ei)
+      self.assertIsNone(ei.prg.pending)
+      self.assertNotEqual(ei.prg.p.applied_opts, ())
+      ei.run()
+      np.testing.assert_allclose(ei.bufs[0].numpy().reshape(32, 32), ref, rtol=1e-5)
+      # the optimized program is in the program cache for the next process
+      self.assertEqual(program_cache_get("CPU", ei.prg.ast)[0].src, ei.prg.p.src)
+
+  def test_fast_compile(self):
+    compilers = []
+    fast = Device["CPU"].fast_compiler
+    def compile(src:str) -> bytes:
+      compilers.append(fast)
+      return type(fast).compile(fast, src)
+    with Context(TIER_UP=1), patch.object(fast, "cachekey", None), patch.object(fast, "compile", compile):
+      ei, _ = _fresh_matmul()
+    self.assertEqual(compilers, [fast])
+    self.assertEqual(fast.opt_level, 0)
+
+  def test_failed_compile_keeps_fast_tier(self):
+    compiler = Device["CPU"].compiler
+    with Context(TIER_UP=1), patch.object(compiler, "cachekey", None), patch.object(compiler, "compile", side_effect=RuntimeError("no")):
+      ei, ref = _fresh_matmul()
+      ei.run()
+      with self.assertRaises(RuntimeError): ei.prg.pending[1].result()
+      ei.run()
+    self.assertIsNone(ei.prg.pending)
+    self.assertEqual(ei.prg.p.applied_opts, ())
+    np.testing.assert_allclose(ei.bufs[0].numpy().reshape(32, 32), ref, rtol=1e-5)
+
+  def test_pickles_current_tier(self):
+    import pickle
+    with Context(TIER_UP=1):
+      ei, _ = _fresh_matmul()
+      ei.run()
+      _tier_up(ei)
+    prg = pickle.loads(pickle.dumps(ei.prg))
+    self.assertIs(type(prg), CompiledRunner)
+    self.assertEqual(prg.lib, ei.prg.lib)
+
+if __name__ == '__main__':
+  unittest.main()
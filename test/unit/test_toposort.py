@@ -0,0 +1,55 @@
+import unittest, gc, weakref
+from testgrad.helpers import Context
+from testgrad.uop.ops import UOp, Ops, parents_cache
+from testgrad.dtype import dtypes
+
+def _graph(n:int, name="a") -> UOp:
+  a, b = UOp.variable(name, 0, 10), UOp.variable(name+"b", 0, 10)
+  for i in range(n): a, b = a*i+b, b+(a if i % 3 == 0 else i)
+  return UOp.sink(a, b)
+
+class TestToposort(unittest.TestCase):
+  def test_same_order_with_cached_parents(self):
+    sink = _graph(20)
+    ref = list(sink._toposort())
+    # cache the parents of some of the nodes, the toposort splices them in
+    for u in ref[::7]: u.parents
+    self.assertEqual(list(sink.toposort()), ref)
+    self.assertEqual(list(sink.toposort()), ref)
+    self.assertEqual(list(sink.parents), ref[:-1])
+
+  def test_gate_not_cached(self):
+    sink = _graph(5, "g")
+    sink.toposort()
+    gated = sink.toposort(gate=lambda u: u.op is not Ops.MUL)
+    self.assertFalse(any(u.op is Ops.MUL for u in gated))
+    self.assertLess(len(gated), len(sink.toposort()))
+
+  def test_returns_copy(self):
+    sink = _graph(5, "c")
+    sink.toposort().clear()
+    self.assertEqual(len(sink.toposort()), len(sink._toposort()))
+
+  def test_deep(self):
+    a = UOp.variable("d", 0, 10)
+    for i in range(20000): a = a+UOp.const(dtypes.int, i)
+    self.assertEqual(len(a.parents), 40000)
+
+  def test_bounded(self):
+    with Context(TOPO_CACHE=1000):
+      sinks = [_graph(100, f"b{i}") for i in range(10)]
+      for s in sinks: s.toposort()
+      self.assertLessEqual(parents_cache.size, 1000)
+      self.assertIsNotNone(sinks[-1]._parents)
+      self.assertIsNone(sinks[0]._parents)
+
+  def test_not_kept_alive(self):
+    sink = _graph(10, "k")
+    sink.toposort()
+    ref = weakref.ref(sink)
+    del sink
+    gc.collect()
+    self.assertIsNone(ref())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,45 @@
+import unittest, gc
+from testgrad.uop.ops import UOp, UOpMetaClass
+from testgrad.dtype import dtypes
+
+def _children(u:UOp) -> set[UOp]: return {c() for c in u.children}
+
+class TestUOpChildren(unittest.TestCase):
+  def test_no_children(self):
+    a = UOp.variable("c0", 0, 10)
+    self.assertIsNone(a._children)
+    self.assertEqual(a.children, set())
+
+  def test_one_child(self):
+    a = UOp.variable("c1", 0, 10)
+    b = a+1
+    self.assertEqual(_children(a), {b})
+    del b
+    self.assertEqual(a.children, set())
+
+  def test_many_children(self):
+    a = UOp.variable("c2", 0, 10)
+    b, c, d = a+1, a*2, a+a
+    self.assertEqual(_children(a), {b, c, d})
+    del c, d
+    self.assertEqual(_children(a), {b})
+    del b
+    self.assertEqual(a.children, set())
+    e = a-1
+    self.assertEqual(_children(a), {e})
+
+  def test_removed_from_ucache(self):
+    key = (b:=UOp.variable("c3", 0, 10)+3)._key
+    self.assertIs(UOpMetaClass.ucache[key](), b)
+    del b
+    gc.collect()
+    self.assertNotIn(key, UOpMetaClass.ucache)
+
+  def test_same_node(self):
+    a = UOp.variable("c4", 0, 10)
+    b = a+1
+    self.assertIs(a+UOp.const(dtypes.int, 1), b)
+    self.assertEqual(len(a.children), 1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -230,8 +230,9 @@ def split_load_store(ctx:Renderer|None, ls:UOp, idx:UOp):
       global_offset += fold_length
       break
 
-  # if it wasn't split, we return None. otherwise we CAT them
-  return UOp(Ops.CAT, ls.dtype, tuple(ret)) if len(ret) > 1 else None
+  # if it wasn't split, we return None. otherwise we CAT them (stores are grouped in a SINK like cat_after_store)
+  if len(ret) <= 1: return None
+  return UOp.sink(*ret) if ls.op is Ops.STORE else UOp(Ops.CAT, ls.dtype, tuple(ret))
 
 def image_fixup(ls:UOp):
   # normal image load or store, with the CAST from expand_index
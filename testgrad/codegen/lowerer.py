@@ -1,28 +1,44 @@
+from __future__ import annotations
 from dataclasses import dataclass, field
 from testgrad.dtype import dtypes
-from testgrad.uop.ops import PatternMatcher, UPat, Ops, UOp, graph_rewrite
+from testgrad.helpers import prod
+from testgrad.uop.ops import PatternMatcher, UPat, Ops, UOp, graph_rewrite, KernelInfo
 
 @dataclass
 class LowererContext:
   current_range: list[UOp]=field(default_factory=list)
   range_number: int = 0
+  upcasted: int = 0
+  unrolled: int = 0
+  threads: int = 0
+  @staticmethod
+  def from_sink(sink:UOp) -> LowererContext:
+    if not isinstance(sink.arg, KernelInfo): return LowererContext()
+    return LowererContext(upcasted=sink.arg.upcasted, unrolled=sink.arg.unrolled, threads=sink.arg.threads)
+
+def get_range(s:int, axis:int, unroll:bool) -> UOp:
+  return UOp(Ops.UNROLL, dtypes.int, (UOp.const(dtypes.int.vec(s), tuple(range(s))),), ((axis,s),)) if unroll else UOp.range(dtypes.int, s, axis)
 
 def add_store_indexing(ctx:LowererContext, store:UOp, buf:UOp, view:UOp):
   assert store.src[1].shape == view.shape, f"shape mismatch on store {store.src[1].shape} != {view.shape}"
-  # create the output range
-  ctx.current_range = [UOp.range(dtypes.int, s, i) for i,s in enumerate(view.st.shape)]
+  # create the output range, the last upcasted axes are UNROLLs and the first axis of a threaded kernel is the core_id
+  ctx.current_range = [get_range(s, i, i >= len(view.st.shape)-ctx.upcasted) for i,s in enumerate(view.st.shape)]
+  if ctx.threads: ctx.current_range[0] = UOp(Ops.SPECIAL, dtypes.int, (), ("gidx0", ctx.threads))
   ctx.range_number = len(ctx.current_range)
   idx, valid = view.st.to_indexed_uops(ctx.current_range)
   return store.replace(src=(buf.index(idx, valid),)+store.src[1:])
 
 def add_reduce_indexing(ctx:LowererContext, red:UOp):
   more_shape = red.src[0].shape[len(ctx.current_range):]
-  reduce_range = [UOp.range(dtypes.int, s, ctx.range_number+i) for i,s in enumerate(more_shape)]
+  # the last unrolled reduce axes are UNROLLs, they are CONTRACTed into the REDUCE
+  reduce_range = [get_range(s, ctx.range_number+i, i >= len(more_shape)-ctx.unrolled) for i,s in enumerate(more_shape)]
   lc = LowererContext(ctx.current_range+reduce_range, ctx.range_number+len(more_shape))
   from testgrad.codegen.lowerer import pm_lowerer  # TODO: better way to do this?
   ret = graph_rewrite(red.src[0], pm_lowerer, lc, name="subreduce", bottom_up=True)
   ctx.range_number = lc.range_number
-  return ret.reduce(*reduce_range, arg=red.arg[0])
+  if len(contract_axis:=[x.arg[0] for x in reduce_range if x.op is Ops.UNROLL]):
+    ret = UOp(Ops.CONTRACT, ret.dtype.vec(prod(x[1] for x in contract_axis)), (ret,), tuple(contract_axis))
+  return ret.reduce(*[x for x in reduce_range if x.op is Ops.RANGE], arg=red.arg[0], dtype=red.dtype)
 
 def view_const(ctx:LowererContext, view:UOp, c:UOp):
   if all(x.mask is None for x in view.arg.views): return c
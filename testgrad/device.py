@@ -3,8 +3,11 @@ from dataclasses import dataclass, replace, field
 from collections import defaultdict
 from typing import Optional, Any, Generic, TypeVar, Iterator, Generator
 import importlib, inspect, functools, pathlib, os, ctypes, ctypes.util, platform, contextlib, sys, re, atexit, pickle, decimal, time
+import weakref, mmap
+from concurrent.futures import ThreadPoolExecutor
 from testgrad.helpers import CI, OSX, LRU, getenv, diskcache_get, diskcache_put, DEBUG, GlobalCounters, flat_mv, from_mv, PROFILE, temp, mv_address, \
-                             cpu_time_execution, colored, Context, round_up, DISABLE_COMPILER_CACHE, ALLOW_DEVICE_USAGE
+                             cpu_time_execution, colored, Context, round_up, round_down, ceildiv, DISABLE_COMPILER_CACHE, ALLOW_DEVICE_USAGE, \
+                             CPU_COUNT, DISK_READ_DEPTH, DISK_READ_SEGMENT
 from testgrad.dtype import DType, ImageDType, PtrDType, dtypes, _to_np_dtype
 from testgrad.renderer import Renderer
 
@@ -153,7 +156,8 @@ class Buffer:
       self._buf: Any = self.allocator._offset(self.base._buf, self.nbytes, self.offset)
     else:
       self._buf = opaque if opaque is not None else self.allocator.alloc(self.nbytes, self.options)
-      if not self.device.startswith("DISK"): GlobalCounters.mem_used += self.nbytes
+      # NOTE: an external buffer isn't freed, it isn't counted either
+      if not self.device.startswith("DISK") and (self.options is None or self.options.external_ptr is None): GlobalCounters.mem_used += self.nbytes
       if PROFILE:
         self._prof_num = num = len(Buffer.profile_events)
         ts = decimal.Decimal(time.perf_counter_ns())/1000
@@ -273,6 +277,21 @@ class _MallocAllocator(LRUAllocator['Compiled']):
   def _copyin(self, dest, src:memoryview): ctypes.memmove(dest, from_mv(src), len(src))
   def _copyout(self, dest:memoryview, src): ctypes.memmove(from_mv(dest), src, len(dest))
   def _offset(self, buf, size:int, offset:int): return from_mv(self._as_buffer(buf)[offset:offset+size])
+  def copy_from_disk(self, dest, src, size:int):
+    disk, head = src.device.allocator, min(size, -src.offset % mmap.PAGESIZE)
+    body = round_down(size - head, mmap.PAGESIZE)
+    if not src.device.direct or (ctypes.addressof(dest) + head) % mmap.PAGESIZE == 0:
+      # the whole pages of the file are read straight into dest with io_uring, the unaligned head and tail are copied from the mmap
+      if body: disk._copyout_direct(ctypes.addressof(dest) + head, disk._offset(src, body, src.offset + head), body)
+      (mv:=self._as_buffer(dest))[:head], mv[head+body:size] = src._buf()[:head], src._buf()[head+body:size]
+      return
+    # O_DIRECT only reads to page aligned addresses, the pages are read to staging buffers and copied from there
+    seg_len = round_up(DISK_READ_SEGMENT.value, mmap.PAGESIZE)
+    free = [self._alloc_aligned(seg_len, mmap.PAGESIZE) for _ in range(min(DISK_READ_DEPTH.value, ceildiv(size, seg_len) + 1))]
+    def get_free_buf(): return (ctypes.addressof(b:=free.pop()), b) if len(free) else None
+    for (addr, buf), copied_in, minor_offset, copy_size in disk._copyout_sharded(src, size, get_free_buf, seg_len):
+      ctypes.memmove(ctypes.addressof(dest) + copied_in, addr + minor_offset, copy_size)
+      free.append(buf)
 
 MallocAllocator = _MallocAllocator(None) # type: ignore
 
@@ -280,10 +299,24 @@ MallocAllocator = _MallocAllocator(None) # type: ignore
 MAP_JIT = 0x0800
 
 # CPUProgram is a jit/shellcode program that can be just mmapped and jumped to
+# NOTE: ctypes releases the GIL while a kernel runs, so python threads are enough to run the chunks of a kernel in parallel
+@functools.cache
+def cpu_thread_pool(threads:int) -> ThreadPoolExecutor: return ThreadPoolExecutor(threads, thread_name_prefix="cpu")
+
 class CPUProgram:
   rt_lib = ctypes.CDLL(ctypes.util.find_library('System' if OSX else 'kernel32') if OSX or sys.platform == "win32" else 'libgcc_s.so.1')
+  # batched libs are mapped once, every kernel in them is an entry point into the shared mapping
+  batch_images: weakref.WeakValueDictionary[bytes, CPUProgram] = weakref.WeakValueDictionary()
 
   def __init__(self, name:str, lib:bytes):
+    from testgrad.runtime.support.elf import BATCH_MAGIC, unpack_batch
+    self.base: Optional[CPUProgram] = None
+    if lib.startswith(BATCH_MAGIC):
+      image, entries = unpack_batch(lib)
+      if (base:=CPUProgram.batch_images.get(image:=bytes(image))) is None: CPUProgram.batch_images[image] = base = CPUProgram(name, image)
+      self.base, self.mem = base, base.mem
+      self.fxn = ctypes.CFUNCTYPE(None)(base.addr + entries[name])
+      return
     if sys.platform == "win32":
       PAGE_EXECUTE_READWRITE = 0x40
       MEM_COMMIT =  0x1000
@@ -294,7 +327,8 @@ class CPUProgram:
       ctypes.windll.kernel32.GetCurrentProcess.restype = ctypes.c_void_p
       proc = ctypes.windll.kernel32.GetCurrentProcess()
       ctypes.windll.kernel32.FlushInstructionCache(ctypes.c_void_p(proc), ctypes.c_void_p(self.mem), ctypes.c_size_t(len(lib)))
-      self.fxn = ctypes.CFUNCTYPE(None)(self.mem)
+      self.addr = self.mem
+      self.fxn = ctypes.CFUNCTYPE(None)(self.addr)
     else:
       from mmap import mmap, PROT_READ, PROT_WRITE, PROT_EXEC, MAP_ANON, MAP_PRIVATE
       # On apple silicon with SPRR enabled (it always is in macos) RWX pages are unrepresentable: https://blog.svenpeter.dev/posts/m1_sprr_gxf/
@@ -311,20 +345,26 @@ class CPUProgram:
       # Using ["name"] instead of .name because otherwise name is getting mangled: https://docs.python.org/3.12/reference/expressions.html#index-5
       CPUProgram.rt_lib["__clear_cache"](ctypes.c_void_p(mv_address(self.mem)), ctypes.c_void_p(mv_address(self.mem) + len(lib)))
 
-      self.fxn = ctypes.CFUNCTYPE(None)(mv_address(self.mem))
+      self.addr = mv_address(self.mem)
+      self.fxn = ctypes.CFUNCTYPE(None)(self.addr)
 
-  def __call__(self, *bufs, vals=(), wait=False):
+  def __call__(self, *bufs, vals=(), global_size:Optional[tuple[int,int,int]]=None, wait=False):
+    # threaded kernels take the core_id as the last argument, each core runs one chunk of the first global axis
+    cores = [] if global_size is None else list(range(global_size[0]))
     args = list(bufs) + list(vals)
     # NOTE: replace this by --target={host's triple}-elf in clang args once we only support macos sequoia and later.
     # Apple relaxes abi requirement for stack arguments to always be at least 8 byte aligned on arm64
     # https://developer.apple.com/documentation/xcode/writing-arm64-code-for-apple-platforms
     # This hack is required because clang/llvm bug doesn't allow us to just use {host's triple}+'-elf' (relocation failures)
     # The bug was fixed in https://github.com/llvm/llvm-project/commit/454cc36630296262cdb6360b60f90a64a97f7f1a but was only backported to xcode 16+
-    if platform.machine() == "arm64" and OSX: args = args[:8] + [ctypes.c_int64(a) if isinstance(a, int) else a for a in args[8:]]
-    return cpu_time_execution(lambda: self.fxn(*args), enable=wait)
+    def fix_args(args:list) -> list: return args[:8] + [ctypes.c_int64(a) if isinstance(a, int) else a for a in args[8:]] \
+      if platform.machine() == "arm64" and OSX else args
+    if len(cores) <= 1: return cpu_time_execution(lambda: self.fxn(*fix_args(args + cores)), enable=wait)
+    core_args = [fix_args(args + [core_id]) for core_id in cores]
+    return cpu_time_execution(lambda: list(cpu_thread_pool(CPU_COUNT.value).map(lambda a: self.fxn(*a), core_args)), enable=wait)
 
   def __del__(self):
-    if sys.platform == 'win32': ctypes.windll.kernel32.VirtualFree(ctypes.c_void_p(self.mem), ctypes.c_size_t(0), 0x8000) #0x8000 - MEM_RELEASE
+    if sys.platform == 'win32' and self.base is None: ctypes.windll.kernel32.VirtualFree(ctypes.c_void_p(self.mem), ctypes.c_size_t(0), 0x8000) #0x8000 - MEM_RELEASE
 
 # **************** for Compiled Devices ****************
 
@@ -333,12 +373,17 @@ class CompileError(Exception): pass
 class Compiler:
   def __init__(self, cachekey:Optional[str]=None): self.cachekey = None if DISABLE_COMPILER_CACHE else cachekey
   def compile(self, src:str) -> bytes: return src.encode()   # NOTE: empty compiler is the default
-  def compile_cached(self, src:str) -> bytes:
+  def compile_cached(self, src:str, name:Optional[str]=None) -> bytes:
+    # with the kernel name, the source is compiled and cached under a canonical name and the lib is relinked to the name
+    if name is not None and (canonical:=self.canonicalize(src, name)) != src: return self.relink(self.compile_cached(canonical), name)
     if self.cachekey is None or (lib := diskcache_get(self.cachekey, src)) is None:
       assert not getenv("ASSERT_COMPILE"), f"tried to compile with ASSERT_COMPILE set\n{src}"
       lib = self.compile(src)
       if self.cachekey is not None: diskcache_put(self.cachekey, src, lib)
     return lib
+  # a compiler that can relink a lib to another kernel name renames the kernel, kernels that only differ in name share a compile
+  def canonicalize(self, src:str, name:str) -> str: return src
+  def relink(self, lib:bytes, name:str) -> bytes: return lib
   def disassemble(self, lib:bytes): pass
 
 class Compiled:
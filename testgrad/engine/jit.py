@@ -1 +1,145 @@
-def TinyJit(x): return x
\ No newline at end of file
+from typing import TypeVar, Generic, Callable, Union, cast, Optional, Any
+import functools
+from dataclasses import dataclass
+from testgrad.tensor import Tensor
+from testgrad.helpers import flatten, merge_dicts, DEBUG, Context, BEAM, getenv, JIT, unwrap
+from testgrad.device import Buffer, MultiBuffer
+from testgrad.dtype import DType
+from testgrad.uop.ops import UOp, Variable, Ops
+from testgrad.shape.shapetracker import ShapeTracker
+from testgrad.engine.realize import ExecItem, capturing
+from testgrad.nn.state import get_parameters
+
+class JitError(Exception): pass
+
+def get_input_replace(jit_cache:list[ExecItem], input_rawbuffers:list[Buffer]) -> dict[tuple[int, int], int]:
+  input_replace: dict[tuple[int, int], int] = {}
+  for j,ji in enumerate(jit_cache):
+    for i,a in enumerate(ji.bufs):
+      if a in input_rawbuffers:
+        input_replace[(j,i)] = input_rawbuffers.index(a)
+  return input_replace
+
+ReturnType = TypeVar('ReturnType')
+@dataclass
+class CapturedJit(Generic[ReturnType]):
+  ret: Any  # includes the Tensors or any other returned object
+  jit_cache: list[ExecItem]
+  input_replace: dict[tuple[int, int], int]
+  extra_view_inputs: list[tuple[int, int, str, int, DType]]
+  expected_names: list[Union[int, str]]
+  expected_st_vars_dtype_device: list[tuple[ShapeTracker, tuple[Variable, ...], DType, str]]
+
+  def __reduce__(self):
+    return self.__class__, (self.ret, self.jit_cache, self.input_replace, self.extra_view_inputs,
+                            self.expected_names, self.expected_st_vars_dtype_device)
+
+  def __post_init__(self): self._clear_inputs()
+
+  # NOTE: the input buffers are only referenced while the jit is running
+  def _clear_inputs(self):
+    for (j,i) in self.input_replace.keys(): self.jit_cache[j].bufs[i] = None
+
+  # jit exec
+  def __call__(self, input_buffers:list[Buffer], var_vals:dict[Variable, int]) -> ReturnType:
+    # assign inputs
+    for idx, offset, device, size, dtype in self.extra_view_inputs:
+      input_buffers.append(Buffer(device, size, dtype, base=input_buffers[idx], offset=offset).ensure_allocated())
+    for (j,i),input_idx in self.input_replace.items(): self.jit_cache[j].bufs[i] = input_buffers[input_idx]
+
+    # allocate intermediates if freed
+    for ji in self.jit_cache:
+      for b in ji.bufs:
+        if b is not None: b.ensure_allocated()
+
+    if DEBUG >= 1 and len(self.jit_cache) >= 10: print(f"jit execs {len(self.jit_cache)} kernels")
+    for ei in self.jit_cache: ei.run(var_vals, jit=True)
+    self._clear_inputs()
+    return self.ret
+
+def _prepare_jit_inputs(args, kwargs):
+  input_tensors: list[tuple[int|str, Tensor]] = [(name,t) for name,t in list(enumerate(args))+sorted(kwargs.items()) if t.__class__ is Tensor]
+  names, tensors = [name for name,_ in input_tensors], [t for _,t in input_tensors]
+  if len(unrealized_tensors := [x for x in tensors if not x.uop.is_realized]): Tensor.realize(*unrealized_tensors)
+  lbs: list[UOp] = flatten([t.uop.src if t.uop.op is Ops.MULTI else [t.uop] for t in tensors])
+  input_buffers: list[Buffer] = flatten([rb.bufs if isinstance(rb:=lb.base.realized, MultiBuffer) else [rb]
+                                         for lb in lbs if lb.base.realized is not None])
+  if len(set(input_buffers)) != len(input_buffers): raise JitError("duplicate inputs to JIT")
+  st_varval_dtype_device = [(*unwrap(lb.st).unbind(), lb.dtype, lb.device) for lb in lbs]
+  var_vals = merge_dicts([x[1] for x in st_varval_dtype_device] + [dict(v.unbind() for v in (args + tuple(kwargs.values())) if isinstance(v, UOp))])
+  expected_input_info = [(x[0], tuple(sorted(x[1].keys(), key=lambda v: v.expr)), x[2], x[3]) for x in st_varval_dtype_device]
+  return input_buffers, var_vals, names, expected_input_info
+
+class TinyJit(Generic[ReturnType]):
+  def __init__(self, fxn:Optional[Callable[..., ReturnType]], captured:Optional[CapturedJit]=None):
+    assert fxn or captured, "need either a function or a CapturedJit"
+    self.fxn = fxn
+    self.captured: Optional[CapturedJit] = captured
+    self.cnt: int = 2 if self.fxn is None else 0
+
+  def add(self, ei:ExecItem): self._jit_cache.append(ExecItem(ei.prg, list(ei.bufs), ei.metadata, ei.fixedvars))
+
+  def reset(self):
+    assert self.fxn is not None, "can't reset without function"
+    self.cnt = 0
+    self.captured = None
+
+  def __reduce__(self):
+    assert self.captured is not None, "can't pickle an uncaptured JIT"
+    return self.__class__, (None, self.captured)
+
+  # keep legacy code working
+  @property
+  def jit_cache(self) -> list[ExecItem]: return self.captured.jit_cache if self.captured is not None else []
+  @property
+  def input_replace(self) -> dict[tuple[int, int], int]: return self.captured.input_replace if self.captured is not None else {}
+
+  def __get__(self, obj, objtype): return functools.partial(self.__call__, obj) # add support for instance methods
+
+  def __call__(self, *args, **kwargs) -> ReturnType:
+    input_buffers, var_vals, names, st_vars_dtype_device = _prepare_jit_inputs(args, kwargs)
+    if not JIT or self.cnt == 0:
+      # jit ignore
+      assert self.fxn is not None
+      with Context(BEAM=0 if getenv("IGNORE_JIT_FIRST_BEAM") else BEAM.value):
+        ret = self.fxn(*args, **kwargs)
+        if len(params:=get_parameters(ret)): Tensor.realize(params[0], *params[1:])
+    elif self.cnt == 1:
+      # jit capture
+      assert self.fxn is not None
+      if capturing: raise JitError(f"having TinyJit inside another TinyJit is not supported {len(capturing)=} {capturing=}")
+      self._jit_cache: list[ExecItem] = []
+      with Context(BEAM=getenv("JITBEAM", BEAM.value)):
+        capturing.append(self)
+        try:
+          ret = self.fxn(*args, **kwargs)
+          if len(params:=get_parameters(ret)): Tensor.realize(params[0], *params[1:])
+        finally: capturing.clear()
+      jit_cache = self._jit_cache
+      del self._jit_cache
+      if not len(jit_cache): raise JitError("didn't JIT anything!")
+      if DEBUG >= 1: print(f"JIT captured {len(jit_cache)} kernels with {len(input_buffers)} inputs")
+
+      # track inputs that are views of buffers
+      extra_view_inputs: list[tuple[int, int, str, int, DType]] = []
+      for item in jit_cache:
+        for b in item.bufs:
+          if b is not None and b._base is not None and b._base in input_buffers:
+            input_buffers.append(b)
+            extra_view_inputs.append((input_buffers.index(b.base), b.offset, b.device, b.size, b.dtype))
+
+      input_replace = get_input_replace(jit_cache, input_buffers)
+      if DEBUG >= 1 and len(set(input_replace.values())) != len(input_buffers): print("WARNING: some input tensors not found")
+
+      # set this for next run
+      self.captured = CapturedJit(ret, jit_cache, input_replace, extra_view_inputs, names, st_vars_dtype_device)
+    elif self.cnt >= 2:
+      # jit exec
+      assert self.captured is not None
+      if self.captured.expected_names != names: raise JitError(f"args mismatch in JIT: {self.captured.expected_names=} != {names}")
+      if self.captured.expected_st_vars_dtype_device != st_vars_dtype_device:
+        raise JitError(f"args mismatch in JIT: {self.captured.expected_st_vars_dtype_device=} != {st_vars_dtype_device=}")
+      ret = self.captured(input_buffers, var_vals)
+
+    self.cnt += 1
+    return cast(ReturnType, ret)
@@ -1 +1,88 @@
-def memory_planner(x): return x
\ No newline at end of file
+from typing import cast
+import bisect
+from collections import defaultdict
+from testgrad.engine.schedule import ScheduleItem
+from testgrad.device import Device, Buffer
+from testgrad.helpers import NO_MEMORY_PLANNER, DEBUG, round_up
+from testgrad.uop.ops import Ops
+from testgrad.dtype import dtypes, ImageDType
+
+# **************** offset planning ****************
+
+class _ArenaPlanner:
+  """Best-fit suballocator over a growing arena. Only offsets are planned here, nothing is allocated."""
+  def __init__(self, block_size:int=0x1000): self.block_size, self.size, self.free_blocks = block_size, 0, cast(list[tuple[int, int]], [])
+  def alloc(self, sz:int) -> int:
+    sz = round_up(sz, self.block_size)
+    fits = [(bsz, i) for i,(_,bsz) in enumerate(self.free_blocks) if bsz >= sz]
+    if len(fits):
+      bsz, i = min(fits)
+      off = self.free_blocks[i][0]
+      if bsz == sz: self.free_blocks.pop(i)
+      else: self.free_blocks[i] = (off+sz, bsz-sz)
+      return off
+    # grow the arena, extending a free block at the end if there is one
+    off = self.free_blocks.pop()[0] if len(self.free_blocks) and sum(self.free_blocks[-1]) == self.size else self.size
+    self.size = off + sz
+    return off
+  def free(self, off:int, sz:int):
+    sz = round_up(sz, self.block_size)
+    i = bisect.bisect(self.free_blocks, (off, sz))
+    self.free_blocks.insert(i, (off, sz))
+    # merge with the neighbours
+    if i+1 < len(self.free_blocks) and off+sz == self.free_blocks[i+1][0]: self.free_blocks[i:i+2] = [(off, sz+self.free_blocks[i+1][1])]
+    if i > 0 and sum(self.free_blocks[i-1]) == off: self.free_blocks[i-1:i+1] = [(self.free_blocks[i-1][0], self.free_blocks[i-1][1]+self.free_blocks[i][1])]
+
+# **************** memory planner ****************
+
+def _internal_memory_planner(buffers:list[list[Buffer]], noopt_buffers=None, debug_prefix="") -> dict[Buffer, Buffer]:
+  if NO_MEMORY_PLANNER: return {}
+  first_appearance, last_appearance, buf_to_opt = {}, {}, set()
+  for i,u in enumerate(buffers):
+    for buf in u:
+      if buf.is_allocated() or buf.base.is_allocated() or buf.uop_refcount > 0 or (noopt_buffers is not None and buf.base in noopt_buffers): continue
+      if buf.base not in first_appearance: first_appearance[buf.base] = i
+      last_appearance[buf.base] = i
+      buf_to_opt.add(buf)
+
+  # sort buffer operations in timeline order. two events: buffer is allocated or buffer is freed
+  buffer_requests = sorted([((first_appearance[buf], True), buf) for buf in first_appearance.keys()] + \
+                           [((last_appearance[buf] + 1, False), buf) for buf in first_appearance.keys()], key=lambda x: x[0])
+
+  # suballocate from one arena per device if the allocator supports offsets, else reuse whole buffers of the same size
+  buffer_replace: dict[Buffer, tuple[Buffer|None, int|None]] = {}
+  reuse_buffers: defaultdict[tuple, list[Buffer]] = defaultdict(list)
+  arenas: defaultdict[str, _ArenaPlanner] = defaultdict(_ArenaPlanner)
+  for (_, is_open_ev), buf in buffer_requests:
+    if hasattr(Device[buf.device].allocator, "_offset") and not isinstance(buf.dtype, ImageDType) and not buf.device.startswith("DISK"):
+      if is_open_ev: buffer_replace[buf] = (None, arenas[buf.device].alloc(buf.nbytes))
+      else: arenas[buf.device].free(cast(int, buffer_replace[buf][1]), buf.nbytes)
+    else:
+      key = (buf.device, buf.dtype, buf.options, buf.nbytes)
+      if is_open_ev: buffer_replace[buf] = (reuse_buffers[key].pop(), None) if len(reuse_buffers[key]) > 0 else (buf, None)
+      else: reuse_buffers[key].append(cast(Buffer, buffer_replace[buf][0]))
+
+  # the arenas are plain int8 buffers, everything planned into them is a view
+  arena_buffers = {dev: Buffer(dev, arena.size, dtypes.int8) for dev, arena in arenas.items() if arena.size > 0}
+  assigned: dict[Buffer, Buffer] = {}
+  for buf, (base, off) in buffer_replace.items():
+    if off is not None: assigned[buf] = Buffer(buf.device, buf.size, buf.dtype, base=arena_buffers[buf.device], offset=off)
+    elif base is not buf: assigned[buf] = cast(Buffer, base)
+
+  # views of planned buffers move with their base
+  for buf in buf_to_opt:
+    if buf._base is not None:
+      assigned[buf] = Buffer(buf.device, buf.size, buf.dtype, base=(pbuf:=assigned.get(buf.base, buf.base)).base, offset=pbuf.offset+buf.offset)
+
+  if DEBUG >= 1:
+    kept = [buf for buf,(base,_) in buffer_replace.items() if base is buf]
+    naive, planned = sum(x.nbytes for x in first_appearance), sum(x.nbytes for x in kept) + sum(x.nbytes for x in arena_buffers.values())
+    if naive != planned:
+      print(f"{debug_prefix}memory reduced from {naive/1e6:.2f} MB -> {planned/1e6:.2f} MB, {len(first_appearance)} -> {len(kept)+len(arena_buffers)} bufs")
+  return assigned
+
+def memory_planner(schedule:list[ScheduleItem]) -> list[ScheduleItem]:
+  # exclude buffers involved in copies and views, only kernel intermediates are planned
+  assigned = _internal_memory_planner([list(si.bufs) for si in schedule],
+                                      noopt_buffers={b.base for si in schedule if si.ast.op is not Ops.SINK for b in si.bufs})
+  return [ScheduleItem(si.ast, tuple(assigned.get(x, x) for x in si.bufs), si.metadata, si.fixedvars) for si in schedule]
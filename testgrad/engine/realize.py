@@ -1,10 +1,12 @@
 from typing import Optional, cast, Generator
-import time, pprint
+import ctypes, sys, time, pprint, functools, copy, hashlib, pathlib, threading, queue
+from concurrent.futures import ThreadPoolExecutor, Future
 from dataclasses import dataclass, replace, field
 from testgrad.helpers import all_same, colored, DEBUG, GlobalCounters, ansilen, BEAM, NOOPT, all_int, CAPTURING, Metadata, TRACEMETA
-from testgrad.helpers import DEVECTORIZE, time_to_str, VALIDATE_WITH_CPU, getenv
-from testgrad.uop.ops import Ops, PatternMatcher, UOp, UPat, Variable, sym_infer, graph_rewrite, print_uops, track_rewrites
-from testgrad.device import Device, Buffer
+from testgrad.helpers import DEVECTORIZE, time_to_str, VALIDATE_WITH_CPU, getenv, diskcache_get, diskcache_put, CPU_COUNT
+from testgrad.helpers import PARALLEL_COMPILE, BATCH_COMPILE, ASYNC_RUN, TIER_UP, DISK_MMAP
+from testgrad.uop.ops import Ops, PatternMatcher, UOp, UPat, Variable, sym_infer, graph_rewrite, print_uops, track_rewrites, KernelInfo
+from testgrad.device import Device, Buffer, Compiler
 from testgrad.renderer import Renderer, ProgramSpec, Estimates
 from testgrad.engine.schedule import ScheduleItem
 from testgrad.opt import get_optimized_ast
@@ -27,7 +29,8 @@ def get_program(ast:UOp, renderer:Renderer) -> ProgramSpec:
   """
 
   if getenv("VIZ"): graph_rewrite(ast, PatternMatcher([]), name="View Base AST")
-  modified_ast = get_optimized_ast(ast, renderer) if ast.arg is None or ast.arg.opts_to_apply is not None else ast
+  # NOTE: an AST is optimized if it doesn't have applied_opts yet. if no opts are applied, optimizing again is the same result
+  modified_ast = get_optimized_ast(ast, renderer) if ast.arg is None or ast.arg.opts_to_apply is not None or not ast.arg.applied_opts else ast
   if __debug__: type_verify(list(modified_ast.toposort()))
 
   # linearize
@@ -45,7 +48,17 @@ def get_program(ast:UOp, renderer:Renderer) -> ProgramSpec:
   src = renderer.render(uops)
 
   return ProgramSpec(uops[-1].arg.name, src, renderer.device, ast, uops,
-                     global_size=[1,1,1] if renderer.has_local else None, local_size=[1,1,1] if renderer.has_local else None)
+                     global_size=[1,1,1] if renderer.has_local or renderer.has_threads else None, local_size=[1,1,1] if renderer.has_local else None)
+
+def get_ast_program(ast:UOp, device:str) -> ProgramSpec:
+  # a device with an ast_runtime runs the kernel AST itself, the buffers and vars come from the AST and there are no uops
+  toposort = ast.toposort()
+  return ProgramSpec(ast.arg.name if isinstance(ast.arg, KernelInfo) else "test", "", device, ast,
+                     vars=sorted(set(u for u in toposort if u.op is Ops.DEFINE_VAR).union(*[u.arg.vars() for u in toposort if u.op is Ops.VIEW]),
+                                 key=lambda v: v.arg),
+                     globals=sorted([u.arg for u in toposort if u.op is Ops.DEFINE_GLOBAL]),
+                     outs=sorted({u.src[0].base.arg for u in toposort if u.op is Ops.STORE}),
+                     ins=sorted({u.src[0].base.arg for u in toposort if u.op is Ops.LOAD}))
 
 # **************** Runners ****************
 
@@ -63,7 +76,7 @@ class CompiledRunner(Runner):
   def __init__(self, p:ProgramSpec, precompiled:Optional[bytes]=None, prg=None):
     if DEBUG >= 4: print(p.src)
     self.p:ProgramSpec = p
-    self.lib:bytes = precompiled if precompiled is not None else Device[p.device].compiler.compile_cached(p.src)
+    self.lib:bytes = precompiled if precompiled is not None else Device[p.device].compiler.compile_cached(p.src, p.function_name)
     if DEBUG >= 7: Device[p.device].compiler.disassemble(self.lib)
     self._prg = Device[p.device].runtime(p.function_name, self.lib) if prg is None else prg
     super().__init__(p.name, p.device, p.estimates)
@@ -72,7 +85,7 @@ class CompiledRunner(Runner):
 
   def __call__(self, rawbufs:list[Buffer], var_vals:dict[Variable, int], wait=False) -> Optional[float]:
     global_size, local_size = self.p.launch_dims(var_vals)
-    if global_size is not None and local_size is None and all_int(self.p.global_size): # type: ignore[arg-type]
+    if global_size is not None and local_size is None and self.dev.renderer.has_local and all_int(self.p.global_size): # type: ignore[arg-type]
       # TODO: this is copied from get_program
       from testgrad.opt.search import optimize_local_size
       local_size = optimize_local_size(self._prg, global_size, rawbufs)
@@ -87,6 +100,37 @@ class CompiledRunner(Runner):
       assert len(local_size) == 3, "local size must have len 3"
     return self._prg(*[x._buf for x in rawbufs], **lra, vals=tuple(var_vals[k] for k in self.p.vars), wait=wait)
 
+class TieredRunner(CompiledRunner):
+  # the fast tier runs the AST without opts from a fast compile. after TIER_UP runs, the optimized program is compiled in the background
+  def __init__(self, p:ProgramSpec, ast:UOp):
+    super().__init__(p, Device[p.device].fast_compiler.compile_cached(p.src, p.function_name))
+    self.ast, self.runs, self.pending = ast, 0, None
+
+  def __reduce__(self): return CompiledRunner, (self.p, self.lib)
+
+  def tier_up(self):
+    prg, fut = self.pending
+    self.pending, self.runs = None, -1
+    # if the optimized compile failed, the fast tier keeps running
+    try: lib = fut.result()
+    except Exception: return
+    program_cache_put(self.device, self.ast, prg, lib)
+    # the program and its launch dims are replaced together
+    self.p, self.lib, self._prg = (p:=replace(prg, device=self.device)), lib, Device[self.device].runtime(p.function_name, lib)
+    self.estimates = p.estimates
+
+  def __call__(self, rawbufs:list[Buffer], var_vals:dict[Variable, int], wait=False) -> Optional[float]:
+    if self.pending is not None:
+      if self.pending[1].done(): self.tier_up()
+    elif self.runs >= 0:
+      self.runs += 1
+      if self.runs >= TIER_UP.value: self.pending = compile_async(self.device, self.ast)
+    return super().__call__(rawbufs, var_vals, wait)
+
+class ASTRunner(CompiledRunner):
+  def __init__(self, p:ProgramSpec): super().__init__(p, b"", Device[p.device].ast_runtime(p.function_name, p.ast))
+  def __reduce__(self): return self.__class__, (self.p,)
+
 class ViewOp(Runner):
   def __init__(self, buf:Buffer): super().__init__(colored(f"view {buf.nbytes:8d} @ {buf.offset:<10d}", "yellow"), buf.device)
   def __call__(self, rawbufs:list[Buffer], var_vals:dict[Variable, int], wait=False):
@@ -116,25 +160,150 @@ class BufferCopy(Runner):
       Device[dest.device].synchronize()
       return time.perf_counter() - st
 
+class BufferMap(BufferCopy):
+  # with DISK_MMAP, the CPU buffer copied from an aligned DISK buffer is a copy on write mapping of the file. its pages are shared until written
+  # NOTE: the file can't change while the buffer is alive, the pages that aren't written yet would change with it
+  def __init__(self, dest:Buffer, src:Buffer):
+    super().__init__(dest.nbytes, dest.device, src.device)
+    mem, offset = src.allocator._map_private(src._buf)
+    self.mapped = (ctypes.c_uint8 * dest.nbytes).from_buffer(mem, offset)
+    dest.allocate(self.mapped, external_ptr=ctypes.addressof(self.mapped))
+  @staticmethod
+  def can_map(dest:Buffer, src:Buffer) -> bool:
+    if sys.platform == "win32" or not src.device.startswith("DISK") or not hasattr(Device[dest.device].allocator, 'copy_from_disk'): return False
+    if dest.is_allocated() or dest._base is not None or dest.options is not None or src.ensure_allocated().allocator.dev.fd is None: return False
+    # CPU buffers are aligned to 0x20 for 256-bit ymm registers
+    return src._buf.offset % 0x20 == 0
+  def copy(self, dest, src):
+    if dest._buf is not self.mapped: super().copy(dest, src)
+
 class BufferXfer(BufferCopy):
   def copy(self, dest, src): dest.allocator._transfer(dest._buf, src._buf, dest.nbytes, src_dev=src.allocator.dev, dest_dev=dest.allocator.dev)
 
 # **************** method cache ****************
 
 method_cache: dict[tuple[str, bytes, tuple[int, ...], bool], CompiledRunner] = {}
-def get_runner(device:str, ast:UOp) -> CompiledRunner:
+# programs that are rendered and compiling in the background, keyed like the base device entries of the method_cache
+pending_compiles: dict[tuple[str, bytes, tuple[int, ...], bool], tuple[ProgramSpec, Future, Optional[int]]] = {}
+
+def _method_cache_keys(device:str, ast:UOp) -> tuple[tuple, tuple]:
   # TODO: this should be all context relevant to rendering
   context = (BEAM.value, NOOPT.value, DEVECTORIZE.value)
-  ckey = (device, ast.key, context, False)
+  return (device, ast.key, context, False), (device.split(":")[0], ast.key, context, True)
+
+# **************** program cache ****************
+
+@functools.cache
+def _codegen_version() -> str:
+  # the programs are keyed on the AST and not the source, any change to the code that made them makes them stale
+  return hashlib.sha256(b"".join(p.read_bytes() for p in sorted(pathlib.Path(__file__).parents[1].rglob("*.py")))).hexdigest()
+
+def _program_cache_key(device:str, ast:UOp) -> dict[str, str]:
+  renderer = Device[device].renderer
+  ctx = (_method_cache_keys(device, ast)[1][2], type(renderer).__name__, renderer.suffix, renderer.global_max, _codegen_version())
+  return {"device": device.split(":")[0], "ast": ast.key.hex(), "ctx": hashlib.sha256(str(ctx).encode()).hexdigest()}
+
+def _on_device(p:ProgramSpec, device:str) -> ProgramSpec:
+  # NOTE: a copy and not a replace, a cached program has no uops to compute the estimates from again
+  (ret:=copy.copy(p)).device = device
+  return ret
+
+def program_cache_get(device:str, ast:UOp) -> Optional[tuple[ProgramSpec, bytes]]:
+  if Device[device].compiler.cachekey is None or (ret:=diskcache_get("program", _program_cache_key(device, ast))) is None: return None
+  return _on_device(ret[0], device), ret[1]
+
+def program_cache_put(device:str, ast:UOp, prg:ProgramSpec, lib:bytes):
+  if Device[device].compiler.cachekey is None: return
+  # the uops aren't stored, the estimates are computed from them before they are dropped
+  _ = prg.estimates
+  (spec:=copy.copy(prg)).uops = None
+  diskcache_put("program", _program_cache_key(device, ast), (spec, lib))
+
+def _tiered(device:str) -> bool: return bool(TIER_UP) and not BEAM and hasattr(Device[device], "fast_compiler")
+
+def compile_async(device:str, ast:UOp) -> tuple[ProgramSpec, Future]:
+  # the program is rendered here and compiled in the background
+  prg = get_program(ast, Device[device].renderer)
+  return prg, _compile_pool(CPU_COUNT.value).submit(Device[device].compiler.compile_cached, prg.src, prg.function_name)
+
+def get_runner(device:str, ast:UOp) -> CompiledRunner:
+  ckey, bkey = _method_cache_keys(device, ast)
   if cret:=method_cache.get(ckey): return cret
-  bkey = (device.split(":")[0], ast.key, context, True)
-  if bret:=method_cache.get(bkey):
-    method_cache[ckey] = ret = CompiledRunner(replace(bret.p, device=device), bret.lib)
+  if hasattr(Device[device], "ast_runtime"): method_cache[ckey] = ret = ASTRunner(get_ast_program(ast, device))
+  elif bret:=method_cache.get(bkey):
+    method_cache[ckey] = ret = CompiledRunner(_on_device(bret.p, device), bret.lib)
+  elif (pending:=pending_compiles.pop(bkey, None)) is not None:
+    prg, fut, idx = pending
+    compiler = Device[device].compiler
+    # the lib is compiled from the canonical source, it's relinked to the kernel
+    if idx is None:
+      lib = compiler.relink(fut.result(), prg.function_name)
+      if compiler.cachekey is not None: diskcache_put(compiler.cachekey, compiler.canonicalize(prg.src, prg.function_name), fut.result())
+    # a batch that failed to compile falls back to compiling the kernel on its own. batched libs aren't cached by source
+    else: lib = compiler.compile_cached(prg.src, prg.function_name) if (libs:=fut.result()) is None else compiler.relink(libs[idx], prg.function_name)
+    program_cache_put(device, ast, prg, lib)
+    method_cache[ckey] = method_cache[bkey] = ret = CompiledRunner(replace(prg, device=device), lib)
+  elif (cached:=program_cache_get(device, ast)) is not None:
+    method_cache[ckey] = method_cache[bkey] = ret = CompiledRunner(*cached)
+  elif _tiered(device):
+    # NOTE: the fast tier isn't in the bkey, a runner made from it would never tier up
+    info = ast.arg if isinstance(ast.arg, KernelInfo) else KernelInfo()
+    prg = get_program(ast.replace(arg=replace(info, opts_to_apply=())), Device[device].renderer)
+    method_cache[ckey] = ret = TieredRunner(replace(prg, device=device), ast)
   else:
     prg: ProgramSpec = get_program(ast, Device[device].renderer)
     method_cache[ckey] = method_cache[bkey] = ret = CompiledRunner(replace(prg, device=device))
+    program_cache_put(device, ast, prg, ret.lib)
   return ret
 
+# **************** parallel compile ****************
+
+@functools.cache
+def _compile_pool(workers:int) -> ThreadPoolExecutor: return ThreadPoolExecutor(workers, thread_name_prefix="compile")
+
+def _compile_batch(compiler:Compiler, prgs:list[ProgramSpec]) -> Optional[list[bytes]]:
+  try: return compiler.compile_batch([p.src for p in prgs], [p.function_name for p in prgs])  # type: ignore[attr-defined]
+  except Exception: return None
+
+def compile_schedule(schedule:list[ScheduleItem]):
+  # render every new AST up front and compile them in the background. the compilers run in subprocesses so the threads run in parallel
+  if not PARALLEL_COMPILE or getenv("ASSERT_COMPILE"): return
+  # with BATCH_COMPILE, up to that many kernels on a device share a compile and an image
+  batch: list[tuple[tuple, ProgramSpec]] = []
+  # kernels with the same canonical source only differ in their name, they share a compile
+  compiling: dict[str, Future] = {}
+  def submit_batch():
+    if not len(batch): return
+    compiler = Device[batch[0][0][0]].compiler
+    srcs: dict[str, ProgramSpec] = {}
+    for _,p in batch: srcs.setdefault(compiler.canonicalize(p.src, p.function_name), p)
+    fut = _compile_pool(CPU_COUNT.value).submit(_compile_batch, compiler, list(srcs.values()))
+    for bkey,p in batch: pending_compiles[bkey] = (p, fut, list(srcs).index(compiler.canonicalize(p.src, p.function_name)))
+    batch.clear()
+  for si in schedule:
+    if si.ast.op is not Ops.SINK or hasattr(Device[si.bufs[0].device], "ast_runtime"): continue
+    ckey, bkey = _method_cache_keys(device:=si.bufs[0].device, si.ast)
+    if ckey in method_cache or bkey in method_cache or bkey in pending_compiles: continue
+    if (cached:=program_cache_get(device, si.ast)) is not None:
+      method_cache[bkey] = CompiledRunner(*cached)
+      continue
+    # tiered kernels start on a fast compile when they're lowered
+    if _tiered(device): continue
+    # NOTE: if this fails, the error is raised when the item is lowered
+    try: prg = get_program(si.ast, Device[device].renderer)
+    except Exception: continue
+    src = (compiler:=Device[device].compiler).canonicalize(prg.src, prg.function_name)
+    if compiler.cachekey is not None and (lib:=diskcache_get(compiler.cachekey, src)) is not None:
+      program_cache_put(device, si.ast, prg, lib:=compiler.relink(lib, prg.function_name))
+      method_cache[bkey] = CompiledRunner(replace(prg, device=device), lib)
+    elif BATCH_COMPILE and hasattr(compiler, "compile_batch"):
+      if len(batch) >= BATCH_COMPILE.value or (len(batch) and batch[0][0][0] != bkey[0]): submit_batch()
+      batch.append((bkey, prg))
+    else:
+      if (fut:=compiling.get(src)) is None: compiling[src] = fut = _compile_pool(CPU_COUNT.value).submit(compiler.compile, src)
+      pending_compiles[bkey] = (prg, fut, None)
+  submit_batch()
+
 # **************** lowering functions ****************
 
 @dataclass(frozen=True)
@@ -166,6 +335,7 @@ class ExecItem:
 si_lowerer = PatternMatcher([
   (UPat(Ops.SINK, name="sink"), lambda ctx,sink: (runner:=get_runner(ctx[0].device, sink), [ctx[x] for x in runner.p.globals])),
   (UPat(Ops.BUFFER_VIEW), lambda ctx: (ViewOp(ctx[0]), list(ctx))),
+  (UPat(Ops.COPY), lambda ctx: (BufferMap(*ctx), list(ctx)) if DISK_MMAP and BufferMap.can_map(*ctx) else None),
   (UPat(Ops.COPY, name="copy"), lambda ctx,copy: ((BufferXfer(ctx[0].nbytes, ctx[0].device, ctx[1].device) \
       if hasattr(Device[ctx[0].device].allocator, '_transfer') and all_same([x.device.split(":")[0] for x in ctx]) \
       else BufferCopy(ctx[0].nbytes, ctx[0].device, ctx[1].device)), list(ctx))),
@@ -174,6 +344,8 @@ def lower_schedule_item(si:ScheduleItem) -> ExecItem:
   return ExecItem(*cast(tuple[Runner,list], si_lowerer.rewrite(si.ast, si.bufs)), si.metadata, si.fixedvars)
 
 def lower_schedule(schedule:list[ScheduleItem]) -> Generator[tuple[ScheduleItem, ExecItem], None, None]:
+  # the items are lowered in order, each one waits only for its own compile
+  compile_schedule(schedule)
   while len(schedule):
     si = schedule.pop(0)
     try: yield (si, lower_schedule_item(si))
@@ -184,12 +356,37 @@ def lower_schedule(schedule:list[ScheduleItem]) -> Generator[tuple[ScheduleItem,
         pprint.pprint(si.metadata, indent=2)
       raise e
 
+def lower_schedule_async(schedule:list[ScheduleItem], depth:int) -> Generator[tuple[ScheduleItem, ExecItem], None, None]:
+  # a thread lowers the items into a bounded queue while the caller runs them. errors are passed through the queue and raised here
+  q: queue.Queue = queue.Queue(depth)
+  stop = threading.Event()
+  def lower():
+    try:
+      for x in lower_schedule(schedule):
+        if stop.is_set(): return
+        q.put(x)
+    except Exception as e: q.put(e)
+    q.put(None)
+  (t:=threading.Thread(target=lower, name="lower_schedule", daemon=True)).start()
+  try:
+    while (x:=q.get()) is not None:
+      if isinstance(x, Exception): raise x
+      yield x
+  finally:
+    # if the caller stopped early, unblock the thread and wait for it
+    stop.set()
+    while t.is_alive():
+      try: q.get(timeout=0.01)
+      except queue.Empty: pass
+
 # **************** main run function ****************
 
 capturing: list = []  # put classes with an add method in here
 
 def run_schedule(schedule:list[ScheduleItem], var_vals:Optional[dict[Variable, int]]=None, do_update_stats=True):
-  for si, ei in lower_schedule(schedule):
+  # symbolic kernels and CPU validation are lowered in this thread
+  lowered = lower_schedule_async(schedule, ASYNC_RUN.value) if ASYNC_RUN and var_vals is None and not VALIDATE_WITH_CPU else lower_schedule(schedule)
+  for si, ei in lowered:
     if len(capturing) and CAPTURING: capturing[0].add(ei)
     if VALIDATE_WITH_CPU and si.ast.op is Ops.SINK:
       # copy in allocated buffers from the GPU
@@ -1,9 +1,11 @@
-from typing import cast
+from __future__ import annotations
+from typing import cast, Optional
 from collections import deque, defaultdict
 from dataclasses import dataclass, field
 from testgrad.helpers import Metadata, merge_dicts
-from testgrad.device import Buffer
-from testgrad.uop.ops import UOp, Variable, Ops
+from testgrad.device import Buffer, BufferSpec
+from testgrad.dtype import DType
+from testgrad.uop.ops import UOp, Variable, Ops, buffers
 
 @dataclass(frozen=True)
 class ScheduleItem:
@@ -44,4 +46,58 @@ def create_schedule_with_vars(sched_sink:UOp):
       in_degree[x] -= 1
       if in_degree[x] == 0: queue.append(x)
 
-  return schedule, merge_dicts(bound_vars_dicts)
\ No newline at end of file
+  return schedule, merge_dicts(bound_vars_dicts)
+# **************** schedule cache ****************
+
+def schedule_cache_key(sink:UOp) -> tuple[Optional[tuple], list[UOp]]:
+  # the structure of the graph with the BUFFERs numbered in toposort order. graphs that only differ in their input buffers have the same key
+  ids: dict[UOp, int] = {}
+  inputs: list[UOp] = []
+  key: list[tuple] = []
+  for u in sink.toposort():
+    # kernelized graphs and multi device buffers aren't cached
+    if u.op in {Ops.KERNEL, Ops.MSELECT, Ops.MSTACK, Ops.MULTI} or (u.op is Ops.DEVICE and isinstance(u.arg, tuple)): return None, []
+    if u.op is Ops.BUFFER: inputs.append(u)
+    key.append((u.op, u.dtype, None if u.op is Ops.UNIQUE else u.arg, u.tag, tuple(ids[s] for s in u.src)))
+    ids[u] = len(ids)
+  return tuple(key), inputs
+
+@dataclass(frozen=True)
+class CachedSchedule:
+  placeholders: tuple[UOp, ...]  # a BUFFER for each input, then one for each buffer the scheduled tensors are left holding
+  outs: tuple[UOp, ...]          # the uops of the scheduled tensors, on the placeholders
+  tmps: tuple[tuple[str, int, DType, Optional[BufferSpec]], ...]  # the intermediate buffers no uop holds
+  items: tuple[tuple[UOp, tuple[tuple[bool, int, Optional[tuple[int, DType, int]]], ...], tuple[Metadata, ...], dict[Variable, int]], ...]
+  var_vals: dict[Variable, int]
+
+  @staticmethod
+  def create(inputs:list[UOp], outs:list[UOp], schedule:list[ScheduleItem], var_vals:dict[Variable, int]) -> Optional[CachedSchedule]:
+    new_bufs = [u for u in UOp.sink(*outs).toposort() if u.op is Ops.BUFFER and u not in (ins:=set(inputs))]
+    slots = {id(b):i for i,u in enumerate(inputs+new_bufs) if (b:=buffers.get(u)) is not None}
+    tmps: dict[int, tuple[int, Buffer]] = {}
+    items = []
+    for si in schedule:
+      specs = []
+      for b in si.bufs:
+        view = None if b._base is None else (b.size, b.dtype, b.offset)
+        if id(b.base) in slots: specs.append((True, slots[id(b.base)], view))
+        else:
+          # an allocated buffer that isn't an input can't be replaced with a new one
+          if b.base.is_allocated(): return None
+          specs.append((False, tmps.setdefault(id(b.base), (len(tmps), b.base))[0], view))
+      items.append((si.ast, tuple(specs), si.metadata, si.fixedvars))
+    # NOTE: the placeholders hold no Buffers, the cache doesn't keep any memory alive
+    placeholders = tuple(UOp(Ops.BUFFER, u.dtype, (UOp(Ops.UNIQUE, arg=-1-i), u.src[1]), u.arg) for i,u in enumerate(inputs+new_bufs))
+    return CachedSchedule(placeholders, UOp.sink(*outs).substitute(dict(zip(inputs+new_bufs, placeholders))).src,
+                          tuple((b.device, b.size, b.dtype, b.options) for _,b in tmps.values()), tuple(items), var_vals)
+
+  def rebind(self, inputs:list[UOp]) -> tuple[tuple[UOp, ...], list[ScheduleItem], dict[Variable, int]]:
+    uops = inputs + [UOp.new_buffer(u.device, u.arg, u.dtype) for u in self.placeholders[len(inputs):]]
+    tmps = [Buffer(device, size, dtype, options=options) for device,size,dtype,options in self.tmps]
+    def buf(from_uop:bool, i:int, view:Optional[tuple[int, DType, int]]) -> Buffer:
+      ret = cast(Buffer, uops[i].buffer) if from_uop else tmps[i]
+      return ret if view is None else ret.view(*view)
+    schedule = [ScheduleItem(ast, tuple(buf(*b) for b in bufs), metadata, fixedvars) for ast,bufs,metadata,fixedvars in self.items]
+    return UOp.sink(*self.outs).substitute(dict(zip(self.placeholders, uops))).src, schedule, self.var_vals
+
+schedule_cache: dict[tuple, CachedSchedule] = {}
@@ -1 +1,2 @@
-def get_kernel_actions(): return []
\ No newline at end of file
+# NOTE: the search lives next to the Kernel it optimizes in testgrad.opt.search
+from testgrad.opt.search import actions, get_kernel_actions, beam_search, bufs_from_lin, optimize_local_size  # noqa: F401
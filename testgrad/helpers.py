@@ -1,6 +1,6 @@
 from __future__ import annotations
 import os, functools, platform, time, re, contextlib, operator, hashlib, pickle, sqlite3, tempfile, pathlib, string, ctypes, sys, gzip, getpass
-import urllib.request, subprocess, shutil, math, types, copyreg, inspect, importlib
+import urllib.request, subprocess, shutil, math, types, copyreg, inspect, importlib, threading
 from dataclasses import dataclass
 from typing import Union, ClassVar, Optional, Iterable, Any, TypeVar, Callable, Sequence, TypeGuard, Iterator, Generic
 
@@ -130,6 +130,15 @@ DONT_REALIZE_EXPAND, DONT_GROUP_REDUCES = ContextVar("DONT_REALIZE_EXPAND", 0),
 QUANTIZE, VALIDATE_WITH_CPU = ContextVar("QUANTIZE", 0), ContextVar("VALIDATE_WITH_CPU", 0)
 CORRECT_DIVMOD_FOLDING, FUSE_OPTIM = ContextVar("CORRECT_DIVMOD_FOLDING", 0), ContextVar("FUSE_OPTIM", 0)
 ALLOW_DEVICE_USAGE, AMD_LLVM = ContextVar("ALLOW_DEVICE_USAGE", 1), ContextVar("AMD_LLVM", 1)
+CPU_COUNT = ContextVar("CPU_COUNT", max(1, len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)))
+PARALLEL_COMPILE, BATCH_COMPILE = ContextVar("PARALLEL_COMPILE", 1), ContextVar("BATCH_COMPILE", 0)
+SCHEDULE_CACHE, ASYNC_RUN = ContextVar("SCHEDULE_CACHE", 256), ContextVar("ASYNC_RUN", 0)
+REWRITE_CACHE, TOPO_CACHE = ContextVar("REWRITE_CACHE", 1<<15), ContextVar("TOPO_CACHE", 1<<20)
+TIER_UP = ContextVar("TIER_UP", 0)
+DISK_READ_DEPTH, DISK_READ_SEGMENT = ContextVar("DISK_READ_DEPTH", 16), ContextVar("DISK_READ_SEGMENT", 1<<20)
+DISK_MMAP, DISK_WRITE_DIRECT = ContextVar("DISK_MMAP", 0), ContextVar("DISK_WRITE_DIRECT", 0)
+DISK_WRITE_DEPTH, DISK_WRITE_SEGMENT = ContextVar("DISK_WRITE_DEPTH", 4), ContextVar("DISK_WRITE_SEGMENT", 1<<24)
+DISK_WRITE_MEM = ContextVar("DISK_WRITE_MEM", 1<<33)
 
 @dataclass(frozen=True)
 class Metadata:
@@ -187,17 +196,17 @@ cache_dir: str = os.path.join(getenv("XDG_CACHE_HOME", os.path.expanduser("~/Lib
 CACHEDB: str = getenv("CACHEDB", os.path.abspath(os.path.join(cache_dir, "cache.db")))
 
 VERSION = 20
-_db_connection = None
+# NOTE: sqlite connections can't be shared between threads, each thread that uses the cache has its own
+_db_local = threading.local()
 def db_connection():
-  global _db_connection
-  if _db_connection is None:
+  if (conn:=getattr(_db_local, "conn", None)) is None:
     os.makedirs(CACHEDB.rsplit(os.sep, 1)[0], exist_ok=True)
-    _db_connection = sqlite3.connect(CACHEDB, timeout=60, isolation_level="IMMEDIATE")
+    conn = _db_local.conn = sqlite3.connect(CACHEDB, timeout=60, isolation_level="IMMEDIATE")
     # another connection has set it already or is in the process of setting it
     # that connection will lock the database
-    with contextlib.suppress(sqlite3.OperationalError): _db_connection.execute("PRAGMA journal_mode=WAL").fetchone()
-    if DEBUG >= 8: _db_connection.set_trace_callback(print)
-  return _db_connection
+    with contextlib.suppress(sqlite3.OperationalError): conn.execute("PRAGMA journal_mode=WAL").fetchone()
+    if DEBUG >= 8: conn.set_trace_callback(print)
+  return conn
 
 def diskcache_clear():
   cur = db_connection().cursor()
@@ -130,6 +130,15 @@ def to_buffer_view(v:UOp):
     if v.arg.size != v.src[0].size or v.arg.views[0].offset != 0 else v.src[0]
   return bv.reshape(v.shape)
 
+def disk_bitcast_to_buffer_view(b:UOp, x:UOp):
+  # DISK can't run kernels, a BITCAST of a contiguous view of a DISK buffer is a BUFFER_VIEW of the new dtype
+  if not isinstance(b.device, str) or not b.device.startswith("DISK"): return None
+  if x.op is Ops.VIEW:
+    if x.src[0].op is not Ops.BUFFER or len(x.arg.views) > 1 or not ShapeTracker.from_shape(x.shape, x.arg.views[0].strides).contiguous: return None
+    buf, offset = x.src[0], x.arg.views[0].offset*x.dtype.itemsize
+  else: buf, offset = x, 0
+  return UOp(Ops.BUFFER_VIEW, b.dtype, (buf,), (x.size*x.dtype.itemsize//b.dtype.itemsize, offset)).reshape(b.shape)
+
 add_gbarrier = merge_views+PatternMatcher([
   # force realize anything in the context
   (UPat(GroupOp.All, name="x"), lambda ctx,x: x.replace(tag=1).gbarrier() if x in ctx and x.tag is None else None),
@@ -140,15 +149,16 @@ def is_constexpr(x:UOp):
   return all([x.op in {Ops.CONST, Ops.VIEW, Ops.DEVICE, Ops.REDUCE_AXIS, *GroupOp.ALU, Ops.CAST, Ops.BITCAST} for x in x.toposort()])
 
 gbarrier_to_buffer = merge_views+PatternMatcher([
-  # delete GBARRIERs on GBARRIERs or BUFFERs
-  (UPat(Ops.GBARRIER, src=(UPat((Ops.GBARRIER, Ops.BUFFER), name="x"),)), lambda x: x),
+  # delete GBARRIERs on GBARRIERs or BUFFERs or realized BUFFER_VIEWs
+  (UPat(Ops.GBARRIER, src=(UPat((Ops.GBARRIER, Ops.BUFFER, Ops.BUFFER_VIEW), name="x"),)), lambda x: x),
   # delete GBARRIERs on constexprs (FUSE_ARANGE)
   (UPat(Ops.GBARRIER, src=(UPat.var("x"),)), lambda x: x if is_constexpr(x) else None),
   # some GBARRIERs can be BUFFER_VIEW or just RESHAPE
   (UPat(Ops.GBARRIER, src=(UPat(Ops.VIEW, src=(UPat((Ops.BUFFER, Ops.GBARRIER)),), name="v"),)), to_buffer_view),
+  (UPat(Ops.GBARRIER, src=(UPat(Ops.BITCAST, src=(UPat((Ops.VIEW, Ops.BUFFER), name="x"),), name="b"),)), disk_bitcast_to_buffer_view),
   # others (worst case) have to be a real BUFFER
   (UPat(Ops.GBARRIER, name="x"), lambda x: UOp.new_buffer(x.device, prod(x.shape), x.dtype).store(x.src[0]).reshape(x.shape)),
-])
+], memoize=False)
 
 early_rules = PatternMatcher([
   # remove STOREs that don't target a BUFFER or another STORE
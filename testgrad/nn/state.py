@@ -1,22 +1,29 @@
-import json, pathlib, zipfile, pickle, tarfile, struct, functools, io
-from collections import OrderedDict
+import json, pathlib, zipfile, pickle, tarfile, struct, functools, io, os, mmap
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 from typing import Union, Optional, Any, Callable, BinaryIO, Iterable
 from testgrad.tensor import Tensor
 from testgrad.dtype import dtypes
+from testgrad.device import Buffer
+from testgrad.uop.ops import Ops
 from testgrad.helpers import prod, argsort, DEBUG, Timing, CI, unwrap, GlobalCounters, tqdm, round_up, T
+from testgrad.helpers import DISK_WRITE_DEPTH, DISK_WRITE_SEGMENT, DISK_WRITE_DIRECT, DISK_WRITE_MEM
 from testgrad.shape.view import strides_for_shape
 
 class TensorIO(io.RawIOBase, BinaryIO):
   def __init__(self, t: Tensor):
     if t.ndim != 1 or t.dtype != dtypes.uint8: raise ValueError("Tensor must be 1d and of dtype uint8!")
     self._position, self._tensor = 0, t
+    # a tensor on a buffer is read from its memory in bulk, not with a copy for every read
+    self._mv = t.uop.buffer.ensure_allocated().as_buffer(allow_zero_copy=True) if t.uop.op is Ops.BUFFER else None
 
   def readable(self) -> bool: return True
   def read(self, size: int = -1) -> bytes:
     if (buf:=super().read(size)) is None: raise ValueError("io.RawIOBase.read returned None") # only happens if readinto returns None (never)
     return buf
   def readinto(self, buffer: Any) -> int:
-    data = self._tensor[self._position:self._position+len(buffer)].data()
+    if self._mv is not None: data = self._mv[self._position:self._position+len(buffer)]
+    else: data = self._tensor[self._position:self._position+len(buffer)].data()
     buffer[:len(data)] = data
     self._position += len(data)
     return len(data)
@@ -61,6 +68,16 @@ def safe_load(fn:Union[Tensor, str, pathlib.Path]) -> dict[str, Tensor]:
   return { k: data[v['data_offsets'][0]:v['data_offsets'][1]].bitcast(safe_dtypes[v['dtype']]).reshape(v['shape'])
           for k, v in metadata.items() if k != "__metadata__" }
 
+def _safe_header(tensors:dict[str, Tensor], metadata:Optional[dict[str, Any]]) -> memoryview:
+  headers, offset = {}, 0
+  if metadata: headers['__metadata__'] = metadata
+  for k,v in tensors.items():
+    headers[k] = {'dtype': inverse_safe_dtypes[v.dtype], 'shape': list(v.shape), 'data_offsets':[offset, offset+v.nbytes()]}
+    offset += v.nbytes()
+  j = json.dumps(headers, separators=(',', ':'))
+  j += "\x20"*(round_up(len(j),8)-len(j))
+  return memoryview(len(j).to_bytes(8, "little") + j.encode('utf-8'))
+
 def safe_save(tensors:dict[str, Tensor], fn:str, metadata:Optional[dict[str, Any]]=None):
   """
   Saves a `state_dict` to disk in a .safetensor file with optional metadata.
@@ -70,18 +87,89 @@ def safe_save(tensors:dict[str, Tensor], fn:str, metadata:Optional[dict[str, Any
   nn.state.safe_save({'t':t}, "test.safetensor")
   ```
   """
-  headers, offset = {}, 0
-  if metadata: headers['__metadata__'] = metadata
-  for k,v in tensors.items():
-    headers[k] = {'dtype': inverse_safe_dtypes[v.dtype], 'shape': list(v.shape), 'data_offsets':[offset, offset+v.nbytes()]}
-    offset += v.nbytes()
-  j = json.dumps(headers, separators=(',', ':'))
-  j += "\x20"*(round_up(len(j),8)-len(j))
-  pathlib.Path(fn).unlink(missing_ok=True)
-  t = Tensor.empty(8+len(j)+offset, dtype=dtypes.uint8, device=f"disk:{fn}")
-  t[0:8].bitcast(dtypes.int64).assign([len(j)])
-  t[8:8+len(j)].assign(list(j.encode('utf-8')))
-  for k,v in safe_load(t).items(): v.assign(tensors[k])
+  _stream_save(fn, [_safe_header(tensors, metadata), *tensors.values()])
+
+_checkpoint_pool = ThreadPoolExecutor(1, thread_name_prefix="safe_save_async")
+_checkpoints, _snapshots = deque[tuple[Future, mmap.mmap]](), list[mmap.mmap]()
+
+def safe_save_async(tensors:dict[str, Tensor], fn:str, metadata:Optional[dict[str, Any]]=None) -> Future:
+  """
+  Copies a `state_dict` to memory and saves it to disk in a .safetensor file in the background, returning a `Future` to wait on.
+  The tensors can be changed as soon as it returns. The copies of the checkpoints being saved take at most DISK_WRITE_MEM bytes,
+  a checkpoint waits for the earlier ones to be saved if it doesn't fit.
+
+  ```python
+  t = Tensor([1, 2, 3])
+  nn.state.safe_save_async({'t':t}, "test.safetensor").result()
+  ```
+  """
+  nbytes = sum(v.nbytes() for v in tensors.values())
+  while _checkpoints and (_checkpoints[0][0].done() or sum(len(m) for _,m in _checkpoints)+nbytes > DISK_WRITE_MEM.value):
+    wait([(ck:=_checkpoints.popleft())[0]])
+    _snapshots.append(ck[1])
+  # the memory of a saved checkpoint is used again, its pages are mapped already and the copy is many times faster
+  mem = next((m for m in _snapshots if len(m) >= nbytes), None) or mmap.mmap(-1, max(nbytes, 1))
+  _snapshots.clear()
+  snapshot, off = memoryview(mem)[:nbytes], 0
+  for v in tensors.values():
+    if v.nbytes() == 0: continue
+    _save_buffer(v).copyout(snapshot[off:off+v.nbytes()])
+    off += v.nbytes()
+  _checkpoints.append((fut:=_checkpoint_pool.submit(_stream_save, fn, [_safe_header(tensors, metadata), snapshot]), mem))
+  return fut
+
+def _save_buffer(v:Tensor) -> Buffer:
+  # DISK can't run kernels and multi tensors have many buffers, they are saved from a copy on CPU
+  if not isinstance(v.device, str) or v.device.startswith("DISK"): v = v.to("CPU")
+  # a realized buffer is read in place, contiguous would copy it
+  buf = v.uop.buffer.ensure_allocated() if v.uop.op is Ops.BUFFER else v.contiguous().realize().uop.base.buffer
+  assert buf.nbytes == v.nbytes(), f"{buf.nbytes=} != {v.nbytes()=}"
+  return buf
+
+def _stream_save(fn:str, srcs:list[Union[memoryview, Tensor]]):
+  # the file is written in big sequential segments by a writer thread while the next segment is copied out of the devices.
+  # at most DISK_WRITE_DEPTH page aligned segments are in memory, with DISK_WRITE_DIRECT they are written past the page cache
+  seg, depth = round_up(DISK_WRITE_SEGMENT.value, mmap.PAGESIZE), max(1, DISK_WRITE_DEPTH.value)
+  flags, fd = os.O_WRONLY|os.O_CREAT|os.O_TRUNC|getattr(os, "O_BINARY", 0), None
+  if DISK_WRITE_DIRECT and hasattr(os, "O_DIRECT"):
+    try: fd = os.open(fn, flags|os.O_DIRECT, 0o644)
+    except OSError: pass # tmpfs doesn't have O_DIRECT
+  direct = fd is not None
+  if fd is None: fd = os.open(fn, flags, 0o644)
+  def write(mem:mmap.mmap, n:int):
+    # O_DIRECT writes whole pages, the file is truncated to its size at the end
+    mv = memoryview(mem)[:round_up(n, mmap.PAGESIZE) if direct else n]
+    while len(mv): mv = mv[os.write(fd, mv):]
+  try:
+    with ThreadPoolExecutor(1) as pool:
+      inflight: deque[tuple[Future, mmap.mmap]] = deque()
+      mem, pos, size = mmap.mmap(-1, seg), 0, 0
+      def flush():
+        nonlocal mem, pos, size
+        inflight.append((pool.submit(write, mem, pos), mem))
+        size, pos = size+pos, 0
+        if len(inflight) < depth: mem = mmap.mmap(-1, seg)
+        else:
+          fut, mem = inflight.popleft()
+          fut.result()
+      for src in srcs:
+        if isinstance(src, Tensor):
+          if src.nbytes() == 0: continue
+          src = _save_buffer(src)
+        off, dest = 0, memoryview(mem)
+        while off < src.nbytes:
+          n = min(src.nbytes-off, seg-pos)
+          if isinstance(src, memoryview): dest[pos:pos+n] = src[off:off+n]
+          elif n == src.nbytes: src.copyout(dest[pos:pos+n])
+          else: src.view(n, dtypes.uint8, off).ensure_allocated().copyout(dest[pos:pos+n])
+          pos, off = pos+n, off+n
+          if pos == seg:
+            flush()
+            dest = memoryview(mem)
+      if pos: flush()
+      for fut,_ in inflight: fut.result()
+    if direct: os.ftruncate(fd, size)
+  finally: os.close(fd)
 
 # state dict
 
@@ -239,12 +327,13 @@ def torch_load(t:Tensor) -> dict[str, Tensor]:
   if passthrough_reset(zipfile.is_zipfile(fobj)): # NOTE: passthrough_reset required to support python < 3.14
     myzip = zipfile.ZipFile(fobj, 'r')
     base_name = myzip.namelist()[0].split('/', 1)[0]
-    for n in myzip.namelist():
-      if n.startswith(f'{base_name}/data/'):
-        with myzip.open(n) as myfile:
-          offsets[n.split("/")[-1]] = myfile._orig_compress_start # type: ignore
-    with myzip.open(f'{base_name}/data.pkl') as myfile:
-      return TorchPickle(myfile).load()
+    # the storages are stored uncompressed after their local file header, whose name and extra field lengths are at 26 and 28
+    for zi in myzip.infolist():
+      if zi.filename.startswith(f'{base_name}/data/'):
+        fobj.seek(zi.header_offset+26)
+        name_len, extra_len = struct.unpack('<HH', fobj.read(4))
+        offsets[zi.filename.split("/")[-1]] = zi.header_offset + 30 + name_len + extra_len
+    return TorchPickle(io.BytesIO(myzip.read(f'{base_name}/data.pkl'))).load()
   elif passthrough_reset(tarfile.is_tarfile(fobj)): # NOTE: passthrough_reset required to support python < 3.11
     with tarfile.open(fileobj=fobj, mode="r") as tar:
       storages_offset = tar.getmember('storages').offset_data
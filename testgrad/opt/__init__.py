@@ -1 +1,26 @@
-def get_optimized_ast(ast, renderer): return ast
\ No newline at end of file
+from testgrad.opt.kernel import Kernel
+from testgrad.opt.heuristic import hand_coded_optimizations
+from testgrad.helpers import NOOPT, BEAM, getenv
+from testgrad.uop.ops import UOp
+from testgrad.renderer import Renderer
+
+def get_optimized_ast(ast:UOp, renderer:Renderer) -> UOp:
+  """
+  Optimize an AST with BEAM search or the hand coded heuristics, or apply the opts in the KernelInfo.
+
+  Args:
+    ast: The Ops.SINK rooted AST
+    renderer: The renderer used to generate the code
+
+  Returns:
+    The Ops.SINK rooted AST with the opts applied and recorded in the KernelInfo.
+  """
+  k = Kernel(ast, opts=renderer)
+  if ast.arg is not None and ast.arg.opts_to_apply is not None: k.apply_opts(ast.arg.opts_to_apply)
+  elif not NOOPT and k.can_opt:
+    if BEAM >= 1:
+      from testgrad.opt.search import beam_search, bufs_from_lin
+      rawbufs = bufs_from_lin(k, allocate=False)
+      k = beam_search(k, rawbufs, BEAM.value, bool(getenv("BEAM_ESTIMATE", 1)))
+    else: k.apply_opts(hand_coded_optimizations(k))
+  return k.get_optimized_ast()
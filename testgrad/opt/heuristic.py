@@ -0,0 +1,57 @@
+import itertools
+from testgrad.opt.kernel import Kernel, Opt, OptOps
+from testgrad.helpers import getenv, prod
+
+def hand_coded_optimizations(k:Kernel) -> list[Opt]:
+  # NOTE: the Clang backend has no locals or groups, everything here is an UPCAST or an UNROLL
+  k = k.copy()
+  def upcast_size() -> int: return prod(k.full_shape[k.first_reduce-k.upcasted:k.first_reduce])
+
+  # vectorize the output over its contiguous axis, this matches the float4 loads and stores of the renderer
+  if k.opts.supports_float4:
+    for axis in k.sts[0].unit_stride_axes():
+      if axis < k.first_reduce-k.upcasted and k.full_shape[axis] % 4 == 0:
+        k.apply_opt(Opt(OptOps.UPCAST, axis, 4))
+        break
+
+  # upcast the axes some buffer is broadcasted over, the loads of that buffer are reused across the upcast
+  upcasted_axis: set[int] = set()
+  while prod(k.full_shape[:k.first_reduce-k.upcasted]) >= 1024 and upcast_size() < getenv("UPCAST_MAX", 32):
+    sts, xb_choices = k.sts, []
+    upcasted_range = range(k.first_reduce-k.upcasted, k.first_reduce)
+    for axis, upcast_amount in itertools.product(range(k.first_reduce-k.upcasted), [3,4]):
+      # if we haven't upcasted it, it mods, and some buffer has stride 0 on axis while having no stride 0 in the upcasted axes
+      if axis in upcasted_axis or k.full_shape[axis] % upcast_amount != 0 or upcast_size()*upcast_amount > getenv("UPCAST_MAX", 32): continue
+      if any(st.views[-1].strides[axis] == 0 and not any(st.views[-1].strides[i] == 0 for i in upcasted_range) for st in sts[1:]):
+        xb_choices.append((sum(st.views[-1].strides[axis]>0 for st in sts), sum(st.views[-1].strides[axis] for st in sts), axis, upcast_amount))
+    if not xb_choices: break
+    _, _, axis, upcast_amount = sorted(xb_choices)[0]
+    shape_len = k.shape_len
+    k.apply_opt(Opt(OptOps.UPCAST, axis, upcast_amount))
+    # a fully upcasted axis is removed from the shape
+    if k.shape_len < shape_len: upcasted_axis = {a if a < axis else a-1 for a in upcasted_axis}
+    else: upcasted_axis.add(axis)
+
+  # unroll small reduces, large reduces are split into 4 accumulators
+  if k.first_reduce < k.shape_len-k.unrolled and upcast_size() < 64:
+    if (s:=k.full_shape[k.shape_len-k.unrolled-1]) <= 32:
+      k.apply_opt(Opt(OptOps.UNROLL, k.shape_len-k.unrolled-1-k.first_reduce, 0))
+      # if it's small, unroll a second reduce dimension too
+      if k.first_reduce < k.shape_len-k.unrolled and s <= 3 and k.full_shape[k.shape_len-k.unrolled-1] <= 3:
+        k.apply_opt(Opt(OptOps.UNROLL, k.shape_len-k.unrolled-1-k.first_reduce, 0))
+    elif s % 4 == 0:
+      k.apply_opt(Opt(OptOps.UNROLL, k.shape_len-k.unrolled-1-k.first_reduce, 4))
+
+  # if nothing at all is upcasted and it's easy to, do an upcast
+  if k.upcasted == 0 and k.first_reduce > 0 and k.full_shape[k.first_reduce-1] % 4 == 0:
+    k.apply_opt(Opt(OptOps.UPCAST, k.first_reduce-1, 4))
+
+  # split the first global axis that divides across the cores, each thread should get about 128K elements
+  if k.opts.has_threads and k.opts.global_max is not None:
+    for threads in [64,32,24,16,12,8,6,5,4,3,2]:
+      if threads > k.opts.global_max[0] or prod(k.full_shape) // (128 << 10) < threads: continue
+      if (axis:=next((i for i in range(k.first_reduce-k.upcasted) if k.full_shape[i] % threads == 0), None)) is not None:
+        k.apply_opt(Opt(OptOps.THREAD, axis, threads))
+        break
+
+  return k.applied_opts
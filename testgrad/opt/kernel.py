@@ -0,0 +1,171 @@
+from __future__ import annotations
+import functools
+from dataclasses import replace
+from typing import Optional
+from testgrad.uop.ops import UOp, Ops, KernelInfo
+from testgrad.device import Device
+from testgrad.renderer import Renderer, Opt, OptOps, ProgramSpec
+from testgrad.shape.shapetracker import ShapeTracker
+from testgrad.helpers import colored, ansilen, prod, dedup
+
+class KernelOptError(Exception): pass
+
+def check(cond:bool, msg:str=""):
+  if not cond: raise KernelOptError(msg)
+
+def _shift_to(shape:tuple, axis:int, amount:int, insert_before:int, top:bool=False) -> tuple[tuple, list[int]]:
+  # split axis into (s//amount, amount) and move amount before the axis insert_before. views without the axis are unchanged
+  # with top, the split is (amount, s//amount) and the outer amount is moved
+  if axis >= len(shape): return shape, list(range(len(shape)))
+  new_shape = shape[:axis] + ((amount, shape[axis]//amount) if top else (shape[axis]//amount, amount)) + shape[axis+1:]
+  moved = axis if top else axis+1
+  others = [i for i in range(len(new_shape)) if i != moved]
+  ib = min(insert_before, len(shape))
+  return new_shape, others[:ib] + [moved] + others[ib:]
+
+def _apply_transform(st:ShapeTracker, t:tuple) -> ShapeTracker:
+  if t[0] == "shift":
+    new_shape, perm = _shift_to(st.shape, *t[1:])
+    return st.reshape(new_shape).permute(tuple(perm)) if new_shape != st.shape else st
+  if t[0] == "squeeze": return st.reshape(st.shape[:t[1]]+st.shape[t[1]+1:]) if t[1] < len(st.shape) else st
+  # swap is a permute of the leading axes
+  return st.permute(t[1]+tuple(range(len(t[1]), len(st.shape))))
+
+class Kernel:
+  """
+  The optimizable view of a kernel AST.
+
+  The full shape is the output axes followed by the reduce axes. The last `upcasted` output axes and the last `unrolled` reduce axes
+  are lowered to UNROLLs instead of RANGEs. If the kernel is threaded, the first axis is the core_id of size `threads`. Kernels with nested reduces can't be optimized and only support the empty list of opts.
+  """
+  def __init__(self, ast:UOp, opts:Optional[Renderer]=None):
+    assert ast.op is Ops.SINK and all(x.op is Ops.STORE for x in ast.src), f"Kernel must be a SINK of STOREs, got {ast.op}"
+    self.ast, self.opts = ast, opts if opts is not None else Device[Device.DEFAULT].renderer
+    reduceops = [x for x in ast.toposort() if x.op is Ops.REDUCE_AXIS]
+    # the views of the buffers, the outputs are first
+    self.bufs: list[UOp] = sorted(dedup([x for x in ast.toposort() if x.op is Ops.VIEW and len(x.src) and x.src[0].op is Ops.DEFINE_GLOBAL]),
+                                  key=lambda x: x.src[0].arg)
+    self.first_reduce = len(ast.src[0].src[0].arg.shape)
+    self.full_shape: tuple[int, ...] = reduceops[0].src[0].shape if len(reduceops) else ast.src[0].src[0].arg.shape
+    self.can_opt = len(reduceops) <= 1 and all(len(x.arg.shape) in {self.first_reduce, len(self.full_shape)} for x in ast.toposort()
+                                                if x.op is Ops.VIEW) and all(isinstance(s, int) for s in self.full_shape)
+    self.upcasted, self.unrolled, self.threads = 0, 0, 0
+    self.applied_opts: list[Opt] = []
+    # NOTE: the transforms are data and not closures so the Kernel can be pickled to the BEAM workers
+    self.transforms: list[tuple] = []
+
+  def copy(self) -> Kernel:
+    ret = type(self).__new__(type(self))
+    ret.__dict__.update(self.__dict__)
+    ret.applied_opts, ret.transforms = self.applied_opts[:], self.transforms[:]
+    return ret
+
+  @property
+  def shape_len(self) -> int: return len(self.full_shape)
+  @property
+  def global_start(self) -> int: return int(self.threads > 0)
+  @property
+  def sts(self) -> list[ShapeTracker]: return [functools.reduce(_apply_transform, self.transforms, x.arg) for x in self.bufs]
+  @property
+  def name(self) -> str: return self.ast.arg.name if isinstance(self.ast.arg, KernelInfo) else "test"
+
+  def colors(self) -> list[str]:
+    # green is threads, blue is global, red is reduce, yellow is upcasted, magenta is unrolled
+    return ["yellow" if i >= self.first_reduce-self.upcasted else "green" if i < self.global_start else "blue" for i in range(self.first_reduce)] + \
+           ["magenta" if i >= self.shape_len-self.unrolled else "red" for i in range(self.first_reduce, self.shape_len)]
+  def colored_shape(self, pad:Optional[int]=None) -> str:
+    ret = ' '.join(colored(f"{s:4d}", color) for s,color in zip(self.full_shape, self.colors()))
+    return ret + ' '*(pad-ansilen(ret)) if pad is not None else ret
+
+  # ******************** apply optimizations ********************
+
+  def real_axis(self, opt:Opt) -> int:
+    check(opt.axis is not None, f"{opt.op} needs an axis")
+    assert opt.axis is not None
+    return opt.axis + (self.first_reduce if opt.op is OptOps.UNROLL else 0)
+
+  def shift_to(self, axis:int, amount:int, insert_before:int, top:bool=False):
+    new_shape, perm = _shift_to(self.full_shape, axis, amount, insert_before, top)
+    self.full_shape = tuple(new_shape[i] for i in perm)
+    self.transforms.append(("shift", axis, amount, insert_before, top))
+    # a fully shifted axis leaves a 1 behind, remove it so it doesn't become a RANGE
+    if self.full_shape[left:=axis+int(insert_before <= axis)] == 1:
+      self.full_shape = self.full_shape[:left] + self.full_shape[left+1:]
+      self.transforms.append(("squeeze", left))
+      if left < self.first_reduce: self.first_reduce -= 1
+
+  def apply_opt(self, opt:Opt, append_opt:bool=True):
+    check(self.can_opt, "kernel can't be optimized")
+    if opt.op is OptOps.SWAP:
+      check(opt.axis is not None and isinstance(opt.arg, int), "swap needs two axes")
+      a0, a1 = opt.axis, opt.arg
+      assert a0 is not None and isinstance(a1, int)
+      check(self.global_start <= a0 < a1 < self.first_reduce-self.upcasted, "swap is only for non upcasted global axes")
+      perm = list(range(self.first_reduce))
+      perm[a0], perm[a1] = perm[a1], perm[a0]
+      full_perm = tuple(perm) + tuple(range(self.first_reduce, self.shape_len))
+      self.full_shape = tuple(self.full_shape[i] for i in full_perm)
+      self.transforms.append(("swap", tuple(perm)))
+    elif opt.op in {OptOps.UPCAST, OptOps.UNROLL, OptOps.THREAD}:
+      axis = self.real_axis(opt)
+      check(axis < self.shape_len, f"invalid axis on {axis=} {opt=} {self.shape_len=}")
+      amt = opt.arg if opt.arg != 0 else self.full_shape[axis]
+      check(isinstance(amt, int) and amt != 1, f"shift/padto of {amt=}, 1 or symbolic amount is meaningless")
+      assert isinstance(amt, int)
+      check(self.full_shape[axis] % amt == 0, f"no longer valid shift {self.full_shape[axis]=}, {amt=}")
+      if opt.op is OptOps.THREAD:
+        check(self.opts.has_threads and self.opts.global_max is not None, f"{type(self.opts).__name__} doesn't support threads")
+        assert self.opts.global_max is not None
+        check(self.threads == 0, "only one axis can be threaded")
+        check(axis < self.first_reduce-self.upcasted, "threads are for non upcasted global axes")
+        check(amt <= self.opts.global_max[0], f"too many threads {amt=} > {self.opts.global_max[0]}")
+        # the chunks are contiguous, core_id is the outer part of the axis
+        self.shift_to(axis, amt, insert_before=0, top=True)
+        self.first_reduce += 1
+        self.threads = amt
+      elif opt.op is OptOps.UPCAST:
+        check(self.global_start <= axis < self.first_reduce-self.upcasted, "upcast is for non upcasted global axes")
+        check(amt <= 16, "don't upcast more than 16")
+        self.shift_to(axis, amt, insert_before=self.first_reduce)
+        self.first_reduce += 1
+        self.upcasted += 1
+      else:
+        check(axis < self.shape_len-self.unrolled, "can't unroll an unrolled axis")
+        check(amt <= 32, "don't unroll more than 32")
+        self.shift_to(axis, amt, insert_before=self.shape_len)
+        self.unrolled += 1
+      check(prod(self.full_shape[self.first_reduce-self.upcasted:self.first_reduce])*prod(self.full_shape[self.shape_len-self.unrolled:]) <= 1024,
+            "too many upcasted and unrolled elements")
+    else: raise KernelOptError(f"{opt.op} isn't supported by {type(self.opts).__name__}")
+    if append_opt: self.applied_opts.append(opt)
+
+  def apply_opts(self, opts:tuple[Opt, ...]|list[Opt]):
+    for opt in opts: self.apply_opt(opt)
+    return self
+
+  # **** kernel outputs ****
+
+  def get_optimized_ast(self, name_override:Optional[str]=None) -> UOp:
+    @functools.cache
+    def fixup_st(st:ShapeTracker) -> ShapeTracker: return functools.reduce(_apply_transform, self.transforms, st)
+    reduce_axes = tuple(range(self.first_reduce, self.shape_len))
+    # NOTE: this is rebuilt in toposort order instead of with graph_rewrite, the transforms are not idempotent
+    replaces: dict[UOp, UOp] = {}
+    for u in self.ast.toposort():
+      if u.op is Ops.VIEW: arg = fixup_st(u.arg)
+      # a kernel with nested reduces has no opts, its reduces keep their axes
+      elif u.op is Ops.REDUCE_AXIS and self.can_opt: arg = (u.arg[0], reduce_axes)
+      else: arg = u.arg
+      src = tuple(replaces[x] for x in u.src)
+      replaces[u] = u if src == u.src and arg == u.arg else u.replace(src=src, arg=arg)
+    info = self.ast.arg if isinstance(self.ast.arg, KernelInfo) else KernelInfo()
+    return replaces[self.ast].replace(arg=replace(info, name=info.name if name_override is None else name_override, upcasted=self.upcasted,
+                                                  unrolled=self.unrolled, threads=self.threads, applied_opts=tuple(self.applied_opts),
+                                                  opts_to_apply=None))
+
+  def to_program(self, name_override:Optional[str]=None) -> ProgramSpec:
+    from testgrad.engine.realize import get_program
+    info = self.ast.arg if isinstance(self.ast.arg, KernelInfo) else KernelInfo()
+    # get_program applies the opts again, this is the same path kernels from the schedule take
+    return get_program(self.ast.replace(arg=replace(info, name=info.name if name_override is None else name_override,
+                                                    opts_to_apply=tuple(self.applied_opts))), self.opts)
@@ -2,7 +2,7 @@ from typing import Literal, Callable, cast
 import os, math, sys
 from collections import defaultdict, Counter
 from testgrad.uop.ops import GroupOp, Ops, UOp, PatternMatcher, UPat
-from testgrad.helpers import strip_parens, getenv, prod, dedup, AMX
+from testgrad.helpers import strip_parens, getenv, prod, dedup, AMX, CPU_COUNT
 from testgrad.dtype import ImageDType, dtypes, DType, PtrDType
 from testgrad.renderer import Renderer, TensorCore
 from testgrad.codegen.devectorizer import no_vectorized_alu
@@ -184,7 +184,12 @@ class ClangRenderer(CStyleLanguage):
   float4_style = ('{', '}')
   gep_arr_threshold = 0
   has_local = False
-  global_max = None
+  # the first global axis is split across CPU_COUNT threads, every thread runs the kernel with its core_id
+  has_threads = bool(getenv("THREADS", 1))
+  code_for_workitem = {"g": lambda _: "core_id"}
+  extra_args = ["const int core_id"] if has_threads else []
+  @property
+  def global_max(self): return (CPU_COUNT.value, 0, 0) if self.has_threads else None
   infinity = "__builtin_inff()"
   nan = '__builtin_nanf("")'
   amx_tc = [TensorCore(dims=(sz,sz,1), threads=1, elements_per_thread=(sz,sz,sz*sz), dtype_in=dt, dtype_out=dt, swizzle=(None,((),(4,5,6,7,0,1,2,3))),
@@ -0,0 +1,157 @@
+# mypy: ignore-errors
+# -*- coding: utf-8 -*-
+#
+# the structs and constants of linux/io_uring.h and liburing.h that ops_disk uses, laid out like the clang2py output
+#
+import ctypes
+
+
+class struct_io_sqring_offsets(ctypes.Structure):
+    pass
+
+struct_io_sqring_offsets._pack_ = 1 # source:False
+struct_io_sqring_offsets._fields_ = [
+    ('head', ctypes.c_uint32),
+    ('tail', ctypes.c_uint32),
+    ('ring_mask', ctypes.c_uint32),
+    ('ring_entries', ctypes.c_uint32),
+    ('flags', ctypes.c_uint32),
+    ('dropped', ctypes.c_uint32),
+    ('array', ctypes.c_uint32),
+    ('resv1', ctypes.c_uint32),
+    ('user_addr', ctypes.c_uint64),
+]
+
+class struct_io_cqring_offsets(ctypes.Structure):
+    pass
+
+struct_io_cqring_offsets._pack_ = 1 # source:False
+struct_io_cqring_offsets._fields_ = [
+    ('head', ctypes.c_uint32),
+    ('tail', ctypes.c_uint32),
+    ('ring_mask', ctypes.c_uint32),
+    ('ring_entries', ctypes.c_uint32),
+    ('overflow', ctypes.c_uint32),
+    ('cqes', ctypes.c_uint32),
+    ('flags', ctypes.c_uint32),
+    ('resv1', ctypes.c_uint32),
+    ('user_addr', ctypes.c_uint64),
+]
+
+class struct_io_uring_params(ctypes.Structure):
+    pass
+
+struct_io_uring_params._pack_ = 1 # source:False
+struct_io_uring_params._fields_ = [
+    ('sq_entries', ctypes.c_uint32),
+    ('cq_entries', ctypes.c_uint32),
+    ('flags', ctypes.c_uint32),
+    ('sq_thread_cpu', ctypes.c_uint32),
+    ('sq_thread_idle', ctypes.c_uint32),
+    ('features', ctypes.c_uint32),
+    ('wq_fd', ctypes.c_uint32),
+    ('resv', ctypes.c_uint32 * 3),
+    ('sq_off', struct_io_sqring_offsets),
+    ('cq_off', struct_io_cqring_offsets),
+]
+
+class struct_io_uring_sqe(ctypes.Structure):
+    pass
+
+struct_io_uring_sqe._pack_ = 1 # source:False
+struct_io_uring_sqe._fields_ = [
+    ('opcode', ctypes.c_ubyte),
+    ('flags', ctypes.c_ubyte),
+    ('ioprio', ctypes.c_uint16),
+    ('fd', ctypes.c_int32),
+    ('off', ctypes.c_uint64),
+    ('addr', ctypes.c_uint64),
+    ('len', ctypes.c_uint32),
+    ('rw_flags', ctypes.c_int32),
+    ('user_data', ctypes.c_uint64),
+    ('buf_index', ctypes.c_uint16),
+    ('personality', ctypes.c_uint16),
+    ('splice_fd_in', ctypes.c_int32),
+    ('addr3', ctypes.c_uint64),
+    ('__pad2', ctypes.c_uint64 * 1),
+]
+
+class struct_io_uring_cqe(ctypes.Structure):
+    pass
+
+struct_io_uring_cqe._pack_ = 1 # source:False
+struct_io_uring_cqe._fields_ = [
+    ('user_data', ctypes.c_uint64),
+    ('res', ctypes.c_int32),
+    ('flags', ctypes.c_uint32),
+]
+
+class struct_io_uring_sq(ctypes.Structure):
+    pass
+
+struct_io_uring_sq._pack_ = 1 # source:False
+struct_io_uring_sq._fields_ = [
+    ('khead', ctypes.POINTER(ctypes.c_uint32)),
+    ('ktail', ctypes.POINTER(ctypes.c_uint32)),
+    ('kring_mask', ctypes.POINTER(ctypes.c_uint32)),
+    ('kring_entries', ctypes.POINTER(ctypes.c_uint32)),
+    ('kflags', ctypes.POINTER(ctypes.c_uint32)),
+    ('kdropped', ctypes.POINTER(ctypes.c_uint32)),
+    ('array', ctypes.POINTER(ctypes.c_uint32)),
+    ('sqes', ctypes.POINTER(struct_io_uring_sqe)),
+    ('sqe_head', ctypes.c_uint32),
+    ('sqe_tail', ctypes.c_uint32),
+    ('ring_sz', ctypes.c_uint64),
+    ('ring_ptr', ctypes.POINTER(None)),
+    ('ring_mask', ctypes.c_uint32),
+    ('ring_entries', ctypes.c_uint32),
+    ('pad', ctypes.c_uint32 * 2),
+]
+
+class struct_io_uring_cq(ctypes.Structure):
+    pass
+
+struct_io_uring_cq._pack_ = 1 # source:False
+struct_io_uring_cq._fields_ = [
+    ('khead', ctypes.POINTER(ctypes.c_uint32)),
+    ('ktail', ctypes.POINTER(ctypes.c_uint32)),
+    ('kring_mask', ctypes.POINTER(ctypes.c_uint32)),
+    ('kring_entries', ctypes.POINTER(ctypes.c_uint32)),
+    ('kflags', ctypes.POINTER(ctypes.c_uint32)),
+    ('koverflow', ctypes.POINTER(ctypes.c_uint32)),
+    ('cqes', ctypes.POINTER(struct_io_uring_cqe)),
+    ('ring_sz', ctypes.c_uint64),
+    ('ring_ptr', ctypes.POINTER(None)),
+    ('ring_mask', ctypes.c_uint32),
+    ('ring_entries', ctypes.c_uint32),
+    ('pad', ctypes.c_uint32 * 2),
+]
+
+class struct_io_uring(ctypes.Structure):
+    pass
+
+struct_io_uring._pack_ = 1 # source:False
+struct_io_uring._fields_ = [
+    ('sq', struct_io_uring_sq),
+    ('cq', struct_io_uring_cq),
+    ('flags', ctypes.c_uint32),
+    ('ring_fd', ctypes.c_int32),
+    ('features', ctypes.c_uint32),
+    ('enter_ring_fd', ctypes.c_int32),
+    ('int_flags', ctypes.c_ubyte),
+    ('pad', ctypes.c_ubyte * 3),
+    ('pad2', ctypes.c_uint32),
+]
+
+# the syscall numbers are the same on x86_64 and the generic table of arm64
+NR_io_uring_setup = 425
+NR_io_uring_enter = 426
+IORING_OFF_SQ_RING = 0
+IORING_OFF_CQ_RING = 0x8000000
+IORING_OFF_SQES = 0x10000000
+IORING_OP_READ = 22
+IORING_ENTER_GETEVENTS = 1
+
+__all__ = ['IORING_ENTER_GETEVENTS', 'IORING_OFF_CQ_RING', 'IORING_OFF_SQES', 'IORING_OFF_SQ_RING', 'IORING_OP_READ', 'NR_io_uring_enter',
+    'NR_io_uring_setup', 'struct_io_cqring_offsets', 'struct_io_sqring_offsets', 'struct_io_uring', 'struct_io_uring_cq', 'struct_io_uring_cqe',
+    'struct_io_uring_params', 'struct_io_uring_sq', 'struct_io_uring_sqe']
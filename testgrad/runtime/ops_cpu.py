@@ -1,22 +1,42 @@
-import platform, subprocess, sys
+import platform, subprocess, sys, re
 from testgrad.helpers import capstone_flatdump, getenv
 from testgrad.device import Compiled, Compiler, MallocAllocator, CPUProgram
-from testgrad.runtime.support.elf import jit_loader
+from testgrad.runtime.support.elf import jit_loader, jit_loader_batch, pack_batch, unpack_batch, BATCH_MAGIC
 from testgrad.renderer.cstyle import ClangRenderer
 
 class ClangJITCompiler(Compiler):
-  def __init__(self, cachekey="compile_clang_jit"): super().__init__(cachekey)
+  def __init__(self, cachekey="compile_clang_jit", opt_level=2):
+    self.opt_level = opt_level
+    super().__init__(cachekey)
 
-  def compile(self, src:str) -> bytes:
+  def _compile_obj(self, src:str) -> bytes:
     # -fno-math-errno is required for __builtin_sqrt to become an instruction instead of a function call
     # x18 is a reserved platform register. It is clobbered on context switch in macos and is used to store TEB pointer in windows on arm, don't use it
     target = 'x86_64' if sys.platform == 'win32' else platform.machine()
-    args = ['-march=native', f'--target={target}-none-unknown-elf', '-O2', '-fPIC', '-ffreestanding', '-fno-math-errno', '-nostdlib', '-fno-ident']
+    args = ['-march=native', f'--target={target}-none-unknown-elf', f'-O{self.opt_level}', '-fPIC', '-ffreestanding', '-fno-math-errno', '-nostdlib',
+            '-fno-ident']
     arch_args = ['-ffixed-x18'] if target == 'arm64' else []
-    obj = subprocess.check_output([getenv("CC", 'clang'), '-c', '-x', 'c', *args, *arch_args, '-', '-o', '-'], input=src.encode('utf-8'))
-    return jit_loader(obj)
+    return subprocess.check_output([getenv("CC", 'clang'), '-c', '-x', 'c', *args, *arch_args, '-', '-o', '-'], input=src.encode('utf-8'))
+
+  def compile(self, src:str) -> bytes: return jit_loader(self._compile_obj(src))
+
+  def compile_batch(self, srcs:list[str], names:list[str]) -> list[bytes]:
+    # the kernels share one translation unit and one image. each one is renamed, kernels with the same name don't collide
+    image, syms = jit_loader_batch(self._compile_obj("\n".join(f"#define {n} {n}_b{i}\n{src}\n#undef {n}" for i,(src,n) in enumerate(zip(srcs, names)))))
+    return [pack_batch(image, {n:syms[f"{n}_b{i}"]}) for i,n in enumerate(names)]
+
+  def canonicalize(self, src:str, name:str) -> str: return re.sub(rf"\b{name}\b", "kernel", src)
+  def relink(self, lib:bytes, name:str) -> bytes:
+    # a lib is entered at its start and has no names, a batched lib has the entry point under the name
+    if not lib.startswith(BATCH_MAGIC): return lib
+    image, entries = unpack_batch(lib)
+    assert len(entries) == 1, "can't relink a lib with many entry points"
+    return pack_batch(bytes(image), {name:next(iter(entries.values()))})
 
   def disassemble(self, lib:bytes): return capstone_flatdump(lib)
 
 class CPUDevice(Compiled):
-  def __init__(self, device:str): super().__init__(device, MallocAllocator, ClangRenderer(), ClangJITCompiler(), CPUProgram)
+  def __init__(self, device:str):
+    super().__init__(device, MallocAllocator, ClangRenderer(), ClangJITCompiler(), CPUProgram)
+    # with TIER_UP, kernels start on an -O0 compile without opts
+    self.fast_compiler = ClangJITCompiler("compile_clang_jit_O0", opt_level=0)
@@ -1,6 +1,6 @@
 import os, sys, mmap, io, ctypes, ctypes.util, contextlib
 from typing import Optional, Generator, Callable
-from testgrad.helpers import OSX, round_up
+from testgrad.helpers import OSX, round_up, round_down, DISK_READ_DEPTH, DISK_READ_SEGMENT
 from testgrad.device import Compiled, Allocator
 with contextlib.suppress(ImportError):
   import _posixshmem
@@ -14,7 +14,7 @@ class DiskDevice(Compiled):
 
     self.size: Optional[int] = None
     self.fd: Optional[int] = None
-    self.count = 0
+    self.direct, self.count = False, 0
     super().__init__(device, DiskAllocator(self), None, None, None)
   def _might_open(self, size:int):
     assert self.size is None or size <= self.size, f"can't reopen Disk tensor with larger size, opened with {self.size}, tried to open with {size}"
@@ -29,8 +29,8 @@ class DiskDevice(Compiled):
       self.mem = mmap.mmap(fd, self.size, mmap.MAP_SHARED | MAP_POPULATE | MAP_LOCKED)
       os.close(fd)
     else:
-      try: self.fd = os.open(filename, os.O_RDWR|os.O_CREAT|getattr(os, "O_DIRECT", 0))
-      except OSError: self.fd = os.open(filename, os.O_RDWR|os.O_CREAT)
+      try: self.fd, self.direct = os.open(filename, os.O_RDWR|os.O_CREAT|getattr(os, "O_DIRECT", 0)), hasattr(os, "O_DIRECT")
+      except OSError: self.fd, self.direct = os.open(filename, os.O_RDWR|os.O_CREAT), False
       if os.fstat(self.fd).st_size < self.size: os.ftruncate(self.fd, self.size)
       self.mem = mmap.mmap(self.fd, self.size)
     if hasattr(self.mem, 'madvise') and (hp := getattr(mmap, "MADV_HUGEPAGE", None)) is not None:
@@ -100,19 +100,11 @@ class DiskAllocator(Allocator):
 
     while next_read_offset < total_copy_size or len(reqs) != processed_reqs_cnt:
       if next_read_offset < total_copy_size and (copy_batch := _get_free_buf()) is not None:
-        # Prepare sqe
-        sqe_index = (tail:=DiskDevice.io_uring.sq.ktail[0]) & DiskDevice.io_uring.sq.kring_mask[0]
-        sqe = DiskDevice.io_uring.sq.sqes[sqe_index]
-        sqe.opcode, sqe.fd, sqe.off = io_uring.IORING_OP_READ, self.dev.fd, fd_offset + next_read_offset
-        sqe.addr, sqe.len, sqe.user_data = copy_batch[0], min(seg_len, total_copy_size - next_read_offset), len(reqs)
-
-        # Send sqe
-        DiskDevice.io_uring.sq.array[sqe_index] = sqe_index
-        DiskDevice.io_uring.sq.ktail[0] = tail + 1
+        self._submit_read(copy_batch[0], fd_offset + next_read_offset, read_len:=min(seg_len, total_copy_size - next_read_offset), len(reqs))
         libc.syscall(io_uring.NR_io_uring_enter, DiskDevice.io_uring.ring_fd, 1, 1, io_uring.IORING_ENTER_GETEVENTS)
 
-        reqs.append((copy_batch, copied_in, minor_offset, real_copy_size:=min(sqe.len - minor_offset, size - copied_in)))
-        next_read_offset += sqe.len
+        reqs.append((copy_batch, copied_in, minor_offset, real_copy_size:=min(read_len - minor_offset, size - copied_in)))
+        next_read_offset += read_len
         copied_in += real_copy_size
         minor_offset = 0
 
@@ -123,4 +115,37 @@ class DiskAllocator(Allocator):
         DiskDevice.io_uring.cq.khead[0] = head + 1 # advance
         processed_reqs_cnt += 1
 
+  def _submit_read(self, addr:int, offset:int, size:int, user_data:int):
+    sqe_index = (tail:=DiskDevice.io_uring.sq.ktail[0]) & DiskDevice.io_uring.sq.kring_mask[0]
+    sqe = DiskDevice.io_uring.sq.sqes[sqe_index]
+    sqe.opcode, sqe.fd, sqe.off, sqe.addr, sqe.len, sqe.user_data = io_uring.IORING_OP_READ, self.dev.fd, offset, addr, size, user_data
+    DiskDevice.io_uring.sq.array[sqe_index] = sqe_index
+    DiskDevice.io_uring.sq.ktail[0] = tail + 1
+
+  def _copyout_direct(self, addr:int, src:DiskBuffer, size:int):
+    # reads size bytes at src to addr in segments, with up to DISK_READ_DEPTH of them in flight. with O_DIRECT it all has to be page aligned
+    assert hasattr(DiskDevice, 'io_uring'), "function requires io uring support"
+    seg_len = round_up(DISK_READ_SEGMENT.value, mmap.PAGESIZE)
+    todo = [(addr+off, src.offset+off, min(seg_len, size-off)) for off in reversed(range(0, size, seg_len))]
+    inflight: dict[int, tuple[int, int, int]] = {}
+    reqs_cnt = 0
+    while len(todo) or len(inflight):
+      submitted = 0
+      while len(todo) and len(inflight) < DISK_READ_DEPTH.value:
+        self._submit_read(*(req:=todo.pop()), reqs_cnt)
+        inflight[reqs_cnt], reqs_cnt, submitted = req, reqs_cnt + 1, submitted + 1
+      libc.syscall(io_uring.NR_io_uring_enter, DiskDevice.io_uring.ring_fd, submitted, 1, io_uring.IORING_ENTER_GETEVENTS)
+      while (head:=DiskDevice.io_uring.cq.khead[0]) != DiskDevice.io_uring.cq.ktail[0]:
+        cqe = DiskDevice.io_uring.cq.cqes[head & DiskDevice.io_uring.cq.kring_mask[0]]
+        (dest, offset, read_len), res = inflight.pop(cqe.user_data), cqe.res
+        DiskDevice.io_uring.cq.khead[0] = head + 1
+        if res <= 0: raise RuntimeError(f"read from disk failed, err: {res}")
+        # a short read is submitted again for the rest
+        if res < read_len: todo.append((dest+res, offset+res, read_len-res))
+
+  def _map_private(self, buf:DiskBuffer) -> tuple[mmap.mmap, int]:
+    # a copy on write mapping of the buffer, its pages are the ones in the page cache until they're written
+    offset = round_down(buf.offset, mmap.ALLOCATIONGRANULARITY)
+    return mmap.mmap(self.dev.fd, buf.size + buf.offset - offset, flags=mmap.MAP_PRIVATE, offset=offset), buf.offset - offset
+
   def _offset(self, buf:DiskBuffer, size:int, offset:int): return DiskBuffer(buf.device, size, offset)
@@ -1,11 +1,144 @@
+import time
+from typing import Callable
 import numpy as np
-from testgrad.helpers import flat_mv
+from numpy.lib.stride_tricks import as_strided
+from testgrad.helpers import flat_mv, prod
+from testgrad.dtype import DType, truncate, _to_np_dtype
+from testgrad.uop.ops import Ops, UOp, Variable, sym_infer
+from testgrad.shape.view import View
 from testgrad.device import Compiled, Allocator
 
+# *** the kernel AST on whole arrays ***
+
+def _cdiv(x:np.ndarray, y:np.ndarray) -> np.ndarray:
+  # C division truncates toward zero
+  q = np.floor_divide(x, y)
+  return q + ((np.remainder(x, y) != 0) & ((x < 0) != (y < 0))).astype(q.dtype)
+
+def _pow(b:np.ndarray, e:np.ndarray) -> np.ndarray:
+  # xpow from uop/transcendental.py, a negative base is nan with a non integer exponent and 0 ** 0 is 1
+  ret = np.exp2(np.log2(np.abs(b)) * e)
+  adj = np.where(e != np.trunc(e), np.nan, np.where(np.abs(e) % 2 == 1, -1, 1))
+  return np.where((b == 0) & (e == 0), 1, ret * np.where(b < 0, adj, 1))
+
+def _threefry(x:np.ndarray, key:np.ndarray) -> np.ndarray:
+  # threefry2x32 from uop/symbolic.py
+  x0, x1 = (x & np.uint64(0xffffffff)).astype(np.uint32), (x >> np.uint64(32)).astype(np.uint32)
+  key0, key1 = (key & np.uint64(0xffffffff)).astype(np.uint32), (key >> np.uint64(32)).astype(np.uint32)
+  rotations = [[13, 15, 26, 6], [17, 29, 16, 24]]
+  ks = [key1, key0 ^ key1 ^ np.uint32(0x1BD11BDA), key0]
+  xr = [x0 + ks[-1], x1 + ks[0]]
+  for i in range(5):
+    for r in rotations[i % 2]: xr[0], xr[1] = (x0 := xr[0] + xr[1]), x0 ^ ((xr[1] << np.uint32(r)) | (xr[1] >> np.uint32(32 - r)))
+    xr = [(xr[0] + ks[i % 3]), (xr[1] + ks[(i + 1) % 3] + np.uint32(i + 1))]
+  return (xr[1].astype(np.uint64) << np.uint64(32)) | xr[0].astype(np.uint64)
+
+numpy_alu: dict[Ops, Callable] = {
+  Ops.LOG2: np.log2, Ops.EXP2: np.exp2, Ops.SQRT: np.sqrt, Ops.RECIP: np.reciprocal, Ops.SIN: np.sin, Ops.POW: _pow,
+  Ops.NEG: lambda x: np.logical_not(x) if x.dtype == np.bool_ else np.negative(x), Ops.ADD: np.add, Ops.SUB: np.subtract, Ops.MUL: np.multiply,
+  Ops.CMPNE: np.not_equal, Ops.CMPLT: np.less, Ops.XOR: np.bitwise_xor, Ops.OR: np.bitwise_or, Ops.AND: np.bitwise_and, Ops.SHR: np.right_shift,
+  Ops.SHL: np.left_shift, Ops.MAX: np.maximum, Ops.MOD: np.fmod, Ops.IDIV: _cdiv, Ops.FDIV: np.divide, Ops.MULACC: lambda x,y,z: (x*y)+z,
+  Ops.WHERE: np.where, Ops.THREEFRY: _threefry}
+numpy_reduce: dict[Ops, np.ufunc] = {Ops.ADD: np.add, Ops.MUL: np.multiply, Ops.MAX: np.maximum}
+
+def _resolve(v:View, var_vals:dict[Variable, int]):
+  return tuple(sym_infer(s, var_vals) for s in v.shape), tuple(sym_infer(st, var_vals) for st in v.strides), sym_infer(v.offset, var_vals), \
+    None if v.mask is None else tuple((sym_infer(l, var_vals), sym_infer(r, var_vals)) for l,r in v.mask)
+
+def _strided(flat:np.ndarray, shape:tuple[int, ...], strides:tuple[int, ...], offset:int) -> np.ndarray:
+  # NOTE: a flipped view starts at its last element, the negative strides read back from there
+  return as_strided(flat[offset:], shape, tuple(st*flat.itemsize for st in strides))
+
+def _index(views:tuple[View, ...], var_vals:dict[Variable, int]) -> tuple[np.ndarray, np.ndarray]:
+  # the flat index and valid of each element, the views before the last are unraveled like views_to_indexed_uops
+  idx, valid = None, np.True_
+  for v in reversed(views):
+    shape, strides, offset, mask = _resolve(v, var_vals)
+    if idx is None: idxs = [np.arange(s).reshape((s,)+(1,)*(len(shape)-i-1)) for i,s in enumerate(shape)]
+    else: idxs = [(idx // prod(shape[i+1:])) % s for i,s in enumerate(shape)]
+    idx = sum((i*st for i,st in zip(idxs, strides) if st != 0), np.int64(offset))
+    for i,(l,r) in zip(idxs, mask or ()): valid = valid & (i >= l) & (i < r)
+  return idx, valid
+
+def _load(flat:np.ndarray, views:tuple[View, ...], var_vals:dict[Variable, int]) -> np.ndarray:
+  shape, strides, offset, mask = _resolve(views[-1], var_vals)
+  if prod(shape) == 0: return np.zeros(shape, flat.dtype)
+  if len(views) == 1:
+    if mask is None: return _strided(flat, shape, strides, offset)
+    if any(l >= r for l,r in mask): return np.zeros(shape, flat.dtype)
+    # the valid box is read strided and padded with zeros
+    inner = _strided(flat, tuple(r-l for l,r in mask), strides, offset+sum(l*st for (l,_),st in zip(mask, strides)))
+    return np.pad(inner, [(l, s-r) for (l,r),s in zip(mask, shape)])
+  idx, valid = _index(views, var_vals)
+  return np.broadcast_to(np.where(valid, flat[np.where(valid, idx, 0)], np.zeros((), flat.dtype)), shape)
+
+def _view(x:np.ndarray, views:tuple[View, ...], var_vals:dict[Variable, int]) -> np.ndarray:
+  # a VIEW of a CONST is the value broadcast to the shape, it's 0 where the view isn't valid
+  shape = _resolve(views[-1], var_vals)[0]
+  if all(v.mask is None for v in views) or prod(shape) == 0: return np.broadcast_to(x, shape)
+  return np.where(np.broadcast_to(_index(views, var_vals)[1], shape), x, np.zeros((), x.dtype))
+
+def _store(flat:np.ndarray, views:tuple[View, ...], var_vals:dict[Variable, int], val:np.ndarray):
+  shape, strides, offset, mask = _resolve(views[-1], var_vals)
+  if prod(shape) == 0: return
+  if len(views) == 1 and mask is None: _strided(flat, shape, strides, offset)[...] = val
+  else:
+    idx, valid, val = np.broadcast_arrays(*_index(views, var_vals), val)
+    flat[idx[valid]] = val[valid]
+
+def _flat(buf:np.ndarray, dtype:DType, write:bool) -> np.ndarray:
+  if write and not buf.flags.c_contiguous: raise RuntimeError("NPY can't store to a non contiguous numpy array")
+  return np.require(buf, requirements='C').reshape(-1).view(np.uint8).view(_to_np_dtype(dtype))
+
+class NpyProgram:
+  def __init__(self, name:str, ast:UOp):
+    self.name, toposort = name, list(ast.toposort())
+    self.globals = sorted([u for u in toposort if u.op is Ops.DEFINE_GLOBAL], key=lambda u: u.arg)
+    # NOTE: the vars of the shapes are in the ShapeTrackers
+    self.vars = sorted(set(u for u in toposort if u.op is Ops.DEFINE_VAR).union(*[u.arg.vars() for u in toposort if u.op is Ops.VIEW]),
+                       key=lambda v: v.arg)
+    self.outs = {u.src[0].src[0].arg for u in toposort if u.op is Ops.STORE}
+    # the VIEWs of the buffers are read with their LOAD or STORE
+    self.uops = [u for u in toposort if u.op not in {Ops.SINK, Ops.DEFINE_GLOBAL} and not (u.op is Ops.VIEW and u.src[0].op is Ops.DEFINE_GLOBAL)]
+
+  def __call__(self, *bufs:np.ndarray, vals:tuple[int, ...]=(), wait=False):
+    st, var_vals = time.perf_counter(), dict(zip(self.vars, vals))
+    flats = {g.arg:_flat(b, g.dtype.base, g.arg in self.outs) for g,b in zip(self.globals, bufs)}
+    v: dict[UOp, np.ndarray] = {}
+    stores: list[tuple[UOp, np.ndarray]] = []
+    with np.errstate(all="ignore"):
+      for u in self.uops:
+        if u.op is Ops.CONST: v[u] = np.array(truncate.get(u.dtype, lambda x: x)(u.arg), _to_np_dtype(u.dtype))
+        elif u.op is Ops.DEFINE_VAR: v[u] = np.array(var_vals[u], _to_np_dtype(u.dtype))
+        elif u.op is Ops.LOAD: v[u] = _load(flats[u.src[0].src[0].arg], u.src[0].arg.views, var_vals)
+        elif u.op is Ops.VIEW: v[u] = _view(v[u.src[0]], u.arg.views, var_vals)
+        elif u.op is Ops.REDUCE_AXIS:
+          kwargs = {"initial": u.dtype.min} if u.arg[0] is Ops.MAX else {}
+          v[u] = numpy_reduce[u.arg[0]].reduce(v[u.src[0]], axis=u.arg[1], dtype=_to_np_dtype(u.dtype), **kwargs)
+        elif u.op is Ops.CAST: v[u] = v[u.src[0]].astype(_to_np_dtype(u.dtype))
+        elif u.op is Ops.BITCAST:
+          x = v[u.src[0]] if u.dtype.itemsize == u.src[0].dtype.itemsize else np.ascontiguousarray(v[u.src[0]])
+          v[u] = x.view(_to_np_dtype(u.dtype))
+        elif u.op is Ops.STORE: stores.append((u.src[0], v[u.src[1]]))
+        elif u.op in numpy_alu: v[u] = numpy_alu[u.op](*[v[x] for x in u.src]).astype(_to_np_dtype(u.dtype), copy=False)
+        else: raise RuntimeError(f"NPY can't run {u.op} in {self.name}")
+      # every value is computed before the first store, a value that's a view of an output is copied
+      if len(stores) > 1: stores = [(b, x.copy() if any(np.may_share_memory(x, flats[o]) for o in self.outs) else x) for b,x in stores]
+      for b,x in stores: _store(flats[b.src[0].arg], b.arg.views, var_vals, x)
+    if wait: return time.perf_counter() - st
+
+# *** device ***
+
 class NpyAllocator(Allocator['NpyDevice']):
   def _alloc(self, size:int, options=None) -> np.ndarray: return np.empty(size, dtype=np.uint8)
   def _as_buffer(self, src:np.ndarray) -> memoryview: return flat_mv(np.require(src, requirements='C').data)
+  def _copyin(self, dest:np.ndarray, src:memoryview): self._as_buffer(dest)[:] = src
   def _copyout(self, dest:memoryview, src:np.ndarray): dest[:] = self._as_buffer(src)
+  def _offset(self, buf:np.ndarray, size:int, offset:int) -> np.ndarray:
+    return np.require(buf, requirements='C').reshape(-1).view(np.uint8)[offset:offset+size]
 
 class NpyDevice(Compiled):
-  def __init__(self, device:str): super().__init__(device, NpyAllocator(self), None, None, None)
+  def __init__(self, device:str):
+    super().__init__(device, NpyAllocator(self), None, None, None)
+    # the kernel ASTs run on whole arrays, they aren't rendered or compiled
+    self.ast_runtime = NpyProgram
@@ -5,11 +5,13 @@
 from typing import Optional, Any, TYPE_CHECKING
 import pickle, base64, itertools, time, struct, sys
 from testgrad.dtype import DType, dtypes, ImageDType, PtrDType, truncate
-from testgrad.helpers import all_same, getenv, flatten, get_single_element
+from testgrad.helpers import all_same, getenv, flatten, get_single_element, prod
 from testgrad.device import Compiled, Compiler, Allocator
-from testgrad.uop.ops import exec_alu, Ops, UOp, GroupOp
+from testgrad.uop.ops import exec_alu, python_alu, Ops, UOp, GroupOp
 from testgrad.renderer import Renderer
 from testgrad.renderer.cstyle import CUDARenderer, MetalRenderer, AMDRenderer, IntelRenderer, ClangRenderer
+try: import numpy as np
+except ImportError: np = None
 
 def _load(m, i):
   if i is None: return 0.0
@@ -24,11 +26,164 @@ def _store(m, i, v):
   if i < 0 or i >= len(m): raise IndexError(f"store out of bounds, size is {len(m)}, access is {i}, value is {v}")
   m[i] = v
 
+# *** the numpy engine: every uop runs for all the threads at once, and so do all the iterations of the RANGEs without a loop carried dependency ***
+# a value is an array that broadcasts to the lanes, axis 0 is the launch grid and each vectorized RANGE has its own axis after that
+# ints are computed as int64 and floats as float64 like the python values exec_alu uses, then the result is truncated to the dtype
+
+class _Fallback(Exception): pass
+VOID_OPS = {Ops.STORE, Ops.ENDRANGE, Ops.BARRIER, Ops.IF, Ops.ENDIF, Ops.SINK}
+MAX_LANES = 1 << 16  # past this a vectorized RANGE runs its iterations one by one, the values of every uop in scope are kept
+
+def _cdiv(x, y):
+  q = np.abs(x) // np.where(y == 0, 1, np.abs(y))
+  return np.where(y == 0, 0, np.where((x < 0) != (y < 0), -q, q))
+numpy_alu = {**python_alu, Ops.LOG2: lambda x: np.log2(x), Ops.EXP2: lambda x: np.exp2(x), Ops.SQRT: lambda x: np.sqrt(x),
+  Ops.RECIP: lambda x: 1/x, Ops.SIN: lambda x: np.sin(x), Ops.POW: lambda x,y: np.where((x == 0) & (y < 0), np.inf, np.power(x, y)),
+  Ops.MAX: lambda x,y: np.where(y > x, y, x), Ops.MOD: lambda x,y: x-_cdiv(x,y)*y, Ops.IDIV: _cdiv}
+
+def _np_type(dtype:DType): return np.float64 if dtypes.is_float(dtype) else np.uint64 if dtype == dtypes.uint64 else np.int64
+def _np_alu(op:Ops, dtype:DType, inp:list, dtp:list[DType]):
+  if op is Ops.WHERE: return np.where(inp[0], *[np.asarray(x).astype(_np_type(dtype)) for x in inp[1:]]).astype(dtype.fmt)
+  return np.asarray(numpy_alu[op](*[np.asarray(x).astype(_np_type(dtp[0])) for x in inp])).astype(dtype.fmt)
+def _np_cast(x, dtype:DType):
+  x = np.asarray(x)
+  if dtypes.is_float(dtype): return x.astype(np.float64).astype(dtype.fmt)
+  return x.astype(dtype.fmt) if dtype == dtypes.bool else x.astype(np.int64).astype(dtype.fmt)
+
+def _np_load(m:np.ndarray, o, g, alt):
+  if g is None or alt is None:
+    if ((o < 0) | (o >= len(m))).any(): raise IndexError(f"load out of bounds, size is {len(m)} and access is {o[(o < 0) | (o >= len(m))].flat[0]}")
+    return m[o]
+  o, g = np.broadcast_arrays(o, g)
+  if (bad:=g & ((o < 0) | (o >= len(m)))).any(): raise IndexError(f"load out of bounds, size is {len(m)} and access is {o[bad][0]}")
+  return np.where(g, m[np.where(g, o, 0)], alt) if g.any() else np.broadcast_to(alt, o.shape)
+
+def _np_store(m:np.ndarray, written:Optional[np.ndarray], o, g, v):
+  o, v, g = np.broadcast_arrays(o, v, True if g is None else g)
+  o, v = o[g], v[g]
+  if ((o < 0) | (o >= len(m))).any(): raise IndexError(f"store out of bounds, size is {len(m)}, access is {o[(o < 0) | (o >= len(m))][0]}")
+  # when the lanes write the same element, or one that was written before in the vectorized RANGEs, the order of the stores matters
+  if written is not None:
+    if written[o].any() or len(np.unique(o)) != len(o): raise _Fallback
+    written[o] = True
+  m[o] = v
+
+def _index(uops:list[tuple[Ops, Optional[DType], list[int], Any]], i:int):
+  # the INDEX a LOAD or a STORE is at, through the CAST to a vector pointer
+  return uops[uops[i][2][0]] if uops[i][0] is Ops.CAST else uops[i]
+
+def _vectorized_ranges(uops:list[tuple[Ops, Optional[DType], list[int], Any]]) -> Optional[dict[int, int]]:
+  # the RANGEs that run all their iterations at once with the lane axis of each, or None if the kernel only runs in the scalar interpreter
+  if np is None or not getenv("PYTHON_NUMPY", 1): return None
+  accesses: dict[int, set[tuple]] = {}
+  ends, last_use, loaded, stored = {}, {}, set(), set()
+  for i,(u,dtype,idp,_) in enumerate(uops):
+    if u in {Ops.WMMA, Ops.DEFINE_LOCAL} or isinstance(dtype, ImageDType): return None
+    if dtype is not None and dtype != dtypes.void and (dtype.base if isinstance(dtype, PtrDType) else dtype).scalar().fmt is None: return None
+    if (u in GroupOp.ALU or u is Ops.CONST) and dtype.count > 1: return None
+    if u is Ops.ASSIGN and uops[idp[0]][0] is not Ops.DEFINE_REG: return None
+    if u is Ops.ENDRANGE: ends[idp[0]] = i
+    if u not in VOID_OPS:
+      for v in idp: last_use[v] = i
+    if u in {Ops.LOAD, Ops.STORE}:
+      if (idx:=_index(uops, idp[0]))[0] is not Ops.INDEX or uops[buf:=idx[2][0]][0] is not Ops.DEFINE_GLOBAL: return None
+      # a gated load without an alt value ignores the gate
+      gate_ignored = len(idx[2]) == 3 and len(idp) == 1
+      accesses.setdefault(buf, set()).add((tuple(idx[2][1:]), dtype.count if u is Ops.LOAD else uops[idp[1]][1].count, gate_ignored))
+      (loaded if u is Ops.LOAD else stored).add(buf)
+  # a buffer that's loaded and stored is only accessed at the same index, so no lane loads an element another lane stores
+  if any(len(accesses[b]) > 1 or any(x[2] for x in accesses[b]) for b in loaded & stored): return None
+  # a RANGE is vectorized when no register is carried over its iterations, nothing after it uses a value from inside it
+  # and it's only in vectorized RANGEs
+  vec: dict[int, int] = {}
+  stack: list[int] = []
+  for i,(u,_,idp,_) in enumerate(uops):
+    if u is Ops.RANGE:
+      carried = any(uops[j][0] is Ops.ASSIGN and uops[j][2][0] < i for j in range(i+1, ends[i]))
+      if not carried and all(last_use.get(j, 0) <= ends[i] for j in range(i+1, ends[i])) and all(r in vec for r in stack): vec[i] = len(vec)+1
+      stack.append(i)
+    elif u is Ops.ENDRANGE: stack.pop()
+  return vec
+
 class PythonProgram:
   def __init__(self, name:str, lib:bytes):
     self.uops: list[tuple[Ops, Optional[DType], list[int], Any]] = pickle.loads(lib)
+    self.vectorized = _vectorized_ranges(self.uops)
+    self.stored = {_index(self.uops, idp[0])[2][0] for uop,_,idp,_ in self.uops if uop is Ops.STORE}
+    self.srcs = [[v for v in (idp[:1] if uop is Ops.DEFINE_REG else idp) if self.uops[v][0] not in VOID_OPS] for uop,_,idp,_ in self.uops]
+
+  def _run_numpy(self, bufs, global_size:tuple[int,int,int], local_size:tuple[int,int,int], vals:tuple[int, ...]) -> bool:
+    assert self.vectorized is not None
+    globs = [i for i,u in enumerate(self.uops) if u[0] is Ops.DEFINE_GLOBAL]
+    views = {i:np.frombuffer(b, self.uops[i][1].fmt) for i,b in zip(globs, bufs)}
+    # the order of the stores is only kept in the buffers, a buffer that shares memory with a stored one runs in the scalar interpreter
+    spans = sorted((v.ctypes.data, v.ctypes.data+v.nbytes, i in self.stored) for i,v in views.items() if v.nbytes)
+    if any(a[1] > b[0] and (a[2] or b[2]) for j,a in enumerate(spans) for b in spans[j+1:]): return False
+    saved = {i:views[i].copy() for i in self.stored}
+    lanes = prod(global_size)*prod(local_size)
+    grid = np.unravel_index(np.arange(lanes), (*global_size[::-1], *local_size[::-1]))
+    nd, ul, written, pvals = 1+len(self.vectorized), {}, {}, list(vals)
+    loop_ends: dict[int, int] = {}
+    running: dict[int, int] = {}  # the RANGEs that are running vectorized, with their sizes
+    i = 0
+    try:
+      with np.errstate(all="ignore"):
+        while i < len(self.uops):
+          uop, dtype, idp, arg = self.uops[i]
+          inp, dtp = [ul[v] for v in self.srcs[i]], [self.uops[v][1] for v in self.srcs[i]]
+          if uop is Ops.STORE:
+            (b, o, g), val = inp
+            if (running or lanes > 1) and b not in written: written[b] = np.zeros(len(views[b]), dtype=bool)
+            for j,v in enumerate(val if dtp[1].count > 1 else [val]): _np_store(views[b], written.get(b), o+j, g, v)
+          elif uop is Ops.ENDRANGE:
+            if idp[0] not in running:
+              loop_ends[idp[0]] = i
+              i = idp[0]
+              continue
+            del running[idp[0]], ul[idp[0]]
+            # with one thread, everything in the outermost vectorized RANGE happens before anything after it
+            if not running and lanes == 1: written.clear()
+          elif uop in (Ops.BARRIER, Ops.IF, Ops.ENDIF, Ops.SINK): pass
+          elif uop is Ops.DEFINE_GLOBAL: ul[i] = i
+          elif uop is Ops.DEFINE_VAR: ul[i] = np.asarray(pvals.pop(0))
+          elif uop is Ops.SPECIAL: ul[i] = grid[(2 if arg[0][0] == 'g' else 5)-int(arg[0][-1])].reshape((lanes,)+(1,)*(nd-1))
+          elif uop is Ops.CONST: ul[i] = np.asarray(arg & 0xFFFFFFFFFFFFFFFF if dtype == dtypes.uint64 else arg, _np_type(dtype))
+          elif uop is Ops.DEFINE_REG: ul[i] = [inp[0]]*dtype.count if dtype.count > 1 else inp[0]
+          elif uop is Ops.INDEX: ul[i] = (inp[0], inp[1], inp[2] if len(inp) == 3 else None)
+          elif uop is Ops.CAST and isinstance(dtype, PtrDType): ul[i] = inp[0]
+          elif uop is Ops.RANGE:
+            if (bound:=inp[0]).min() != bound.max(): raise _Fallback
+            if i in ul:
+              ul[i] = ul[i] + 1
+              if ul[i] == bound.max():
+                del ul[i]
+                i = loop_ends[i] + 1
+                continue
+            elif i in self.vectorized and lanes*prod(running.values())*(n:=int(bound.max())) <= MAX_LANES:
+              ul[i] = np.arange(n).reshape(tuple(n if ax == self.vectorized[i] else 1 for ax in range(nd)))
+              running[i] = n
+            else: ul[i] = np.asarray(0)
+          elif uop is Ops.VECTORIZE: ul[i] = inp
+          elif uop is Ops.BITCAST: ul[i] = np.asarray(inp[0]).astype(dtp[0].fmt).view(dtype.fmt)
+          elif uop is Ops.CAST: ul[i] = _np_cast(inp[0], dtype)
+          elif uop is Ops.LOAD:
+            (b, o, g), alt = inp[0], inp[1] if len(inp) == 2 else None
+            if dtype.count > 1:
+              ul[i] = [_np_load(views[b], o+j, g, alt[j] if alt is not None and dtp[1].count > 1 else alt) for j in range(dtype.count)]
+            else: ul[i] = _np_load(views[b], o, g, alt)
+          elif uop is Ops.ASSIGN: ul[idp[0]] = ul[i] = inp[1]
+          elif uop is Ops.GEP: ul[i] = inp[0][get_single_element(arg)]
+          elif uop in GroupOp.ALU: ul[i] = _np_alu(uop, dtype, inp, dtp)
+          else: raise _Fallback
+          i += 1
+    except _Fallback:
+      for j,v in saved.items(): views[j][:] = v
+      return False
+    return True
+
   def __call__(self, *bufs, global_size:tuple[int,int,int]=(1,1,1), local_size:tuple[int,int,int]=(1,1,1), vals:tuple[int, ...]=(), wait=False):
     st = time.perf_counter()
+    if self.vectorized is not None and self._run_numpy(bufs, global_size, local_size, vals): return time.perf_counter() - st
     warp = list(itertools.product(*[range(x) for x in local_size[::-1]]))
     warp_size = len(warp)
     for idxs in itertools.product(*[range(x) for x in global_size[::-1]]):
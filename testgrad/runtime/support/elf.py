@@ -55,9 +55,38 @@ def relocate(instr: int, ploc: int, tgt: int, r_type: int):
     case libc.R_AARCH64_LDST128_ABS_LO12_NC: return instr | (getbits(tgt, 4, 11) << 10)
   raise NotImplementedError(f"Encountered unknown relocation type {r_type}")
 
-def jit_loader(obj: bytes) -> bytes:
-  image, _, relocs = elf_loader(obj)
+def _jit_link(obj: bytes) -> tuple[memoryview, list[ElfSection]]:
+  image, sections, relocs = elf_loader(obj)
   # This is needed because we have an object file, not a .so that has all internal references (like loads of constants from .rodata) resolved.
   for ploc,tgt,r_type,r_addend in relocs:
     image[ploc:ploc+4] = struct.pack("<I", relocate(struct.unpack("<I", image[ploc:ploc+4])[0], ploc, tgt+r_addend, r_type))
-  return bytes(image)
+  return image, sections
+
+def jit_loader(obj: bytes) -> bytes: return bytes(_jit_link(obj)[0])
+
+# **************** batched images ****************
+
+# a batched lib is an image shared by many kernels, the header has the entry points into it
+BATCH_MAGIC = b"\x7fTGBATCH"
+
+def jit_loader_batch(obj: bytes) -> tuple[bytes, dict[str, int]]:
+  image, sections = _jit_link(obj)
+  symtab_sh = next(sh for sh in sections if sh.header.sh_type == libc.SHT_SYMTAB)
+  strtab = sections[symtab_sh.header.sh_link].content
+  syms = [(strtab[sym.st_name:strtab.find(b'\x00', sym.st_name)], sections[sym.st_shndx].header.sh_addr + sym.st_value)
+          for sym in (libc.Elf64_Sym * (symtab_sh.header.sh_size // symtab_sh.header.sh_entsize)).from_buffer_copy(symtab_sh.content)
+          if libc.ELF64_ST_TYPE(sym.st_info) == libc.STT_FUNC and libc.ELF64_ST_BIND(sym.st_info) == libc.STB_GLOBAL]
+  return bytes(image), {name.decode():off for name,off in syms}
+
+def pack_batch(image: bytes, entries: dict[str, int]) -> bytes:
+  header = struct.pack("<I", len(entries)) + b''.join(struct.pack("<QH", off, len(name)) + name.encode() for name,off in entries.items())
+  return BATCH_MAGIC + header + image
+
+def unpack_batch(lib: bytes) -> tuple[memoryview, dict[str, int]]:
+  assert lib.startswith(BATCH_MAGIC), "not a batched lib"
+  entries, ptr = {}, len(BATCH_MAGIC)+4
+  for _ in range(struct.unpack_from("<I", lib, len(BATCH_MAGIC))[0]):
+    off, name_len = struct.unpack_from("<QH", lib, ptr)
+    entries[lib[ptr+10:ptr+10+name_len].decode()] = off
+    ptr += 10+name_len
+  return memoryview(lib)[ptr:], entries
@@ -2,38 +2,47 @@
 from __future__ import annotations
 import time, math, itertools, functools, struct, sys, inspect, pathlib, string, hashlib, weakref, contextvars
 from contextlib import ContextDecorator
-from typing import Callable, ClassVar, Sequence, cast, get_args, Literal, SupportsIndex, ParamSpec, TypeVar, Optional
+from typing import Callable, ClassVar, Sequence, cast, get_args, Literal, SupportsIndex, ParamSpec, TypeVar, Optional, Iterable
 from testgrad.dtype import DType, DTypeLike, dtypes, ImageDType, ConstType, least_upper_float, least_upper_dtype, sum_acc_dtype, to_dtype, truncate
 from testgrad.dtype import _from_np_dtype, _to_np_dtype
 from testgrad.helpers import argfix, make_tuple, flatten, prod, all_int, round_up, merge_dicts, argsort, getenv, all_same, fully_flatten, dedup
-from testgrad.helpers import IMAGE, WINO, Metadata, TRACEMETA, ceildiv, fetch, polyN, unwrap, DEBUG
+from testgrad.helpers import IMAGE, WINO, Metadata, TRACEMETA, ceildiv, fetch, polyN, unwrap, DEBUG, SCHEDULE_CACHE
 from testgrad.gradient import compute_gradient
 from testgrad.uop.ops import smax, smin, resolve, UOp, Ops, sint, Variable, MathTrait, identity_element, all_metadata
 from testgrad.uop.spec import tensor_uop_spec, type_verify
 from testgrad.device import Device, Buffer
 from testgrad.engine.realize import run_schedule
 from testgrad.engine.memory import memory_planner
-from testgrad.engine.schedule import ScheduleItem, create_schedule_with_vars
+from testgrad.engine.schedule import ScheduleItem, create_schedule_with_vars, schedule_cache_key, schedule_cache, CachedSchedule
 from testgrad.kernelize.kernelize import get_kernelize_map
 
-# *** all in scope Tensors are here. this gets relevant UOps ***
+# *** all in scope Tensors are here, indexed by their UOp. this gets relevant UOps ***
 
-all_tensors: set[weakref.ref[Tensor]] = set()
-def _find_all_tensors_for_uops(all_uops: set[UOp]) -> list[Tensor]:
-  return [t for tref in all_tensors if (t:=tref()) is not None and t.uop in all_uops]
+uop_tensors: dict[UOp, set[weakref.ref[Tensor]]] = {}
+def _untrack_tensor(u:UOp, tref:weakref.ref[Tensor]):
+  if (trefs:=uop_tensors.get(u)) is not None:
+    trefs.discard(tref)
+    if not trefs: del uop_tensors[u]
+def _find_all_tensors_for_uops(all_uops: Iterable[UOp]) -> list[Tensor]:
+  # NOTE: the sets are copied, a Tensor can be collected while this runs
+  return [t for u in all_uops if (trefs:=uop_tensors.get(u)) is not None for tref in tuple(trefs) if (t:=tref()) is not None]
 
-def _apply_map_to_tensors(applied_map:dict[UOp, UOp], name:str|None=None) -> None:
-  # get all children of keys in applied_map
+def _find_all_children(uops:list[UOp]) -> set[UOp]:
   all_uops: set[UOp] = set()
-  search_uops = list(applied_map)
+  search_uops = uops
   while len(search_uops):
     x = search_uops.pop()
     if x in all_uops: continue
     all_uops.add(x)
     search_uops.extend([u for c in x.children if (u:=c()) is not None])
+  return all_uops
+
+def _apply_map_to_tensors(applied_map:dict[UOp, UOp], name:str|None=None) -> None:
+  # get all children of keys in applied_map. the keys that map to themselves (like the DEVICE) don't change any Tensor
+  applied_map = {k:v for k,v in applied_map.items() if k is not v}
+  all_uops = _find_all_children(list(applied_map))
 
   # link the found UOps back to Tensors. exit early if there's no Tensors to realize
-  # NOTE: this uses all_tensors, but it's fast
   if len(fixed_tensors := _find_all_tensors_for_uops(all_uops)):
     # potentially rewrite all the discovered Tensors
     sink = UOp.sink(*[t.uop for t in fixed_tensors])
@@ -44,6 +53,19 @@ def _apply_map_to_tensors(applied_map:dict[UOp, UOp], name:str|None=None) -> Non
       if s is ns: continue
       t.uop = ns
 
+def _schedule_cache_key(roots:tuple[Tensor, ...]) -> tuple[Optional[tuple], list[UOp], list[Tensor]]:
+  # kernelize also rewrites the other unrealized Tensors in the graph, they are cached with the roots
+  # Tensors that are built on the graph can't be rebound, if there are any the schedule isn't cached
+  topo = {u:i for i,u in enumerate(UOp.sink(*[x.uop for x in roots]).toposort())}
+  others: list[Tensor] = []
+  # the leaves are shared with every Tensor on the device, only the Tensors on the computed uops are rewritten
+  for t in _find_all_tensors_for_uops(_find_all_children([u for u in topo if u.op not in {Ops.DEVICE, Ops.UNIQUE, Ops.BUFFER, Ops.CONST}])):
+    if any(t is r for r in roots) or t.uop.base.op in {Ops.BUFFER, Ops.CONST}: continue
+    if t.uop not in topo: return None, [], []
+    others.append(t)
+  tensors = list(roots) + sorted(others, key=lambda t: topo[t.uop])
+  return *schedule_cache_key(UOp.sink(*[t.uop for t in tensors])), tensors
+
 # **** Tensor helper functions ****
 
 # this tracks the tensor.py METADATA
@@ -119,7 +141,7 @@ class Tensor(MathTrait):
   np.set_printoptions(precision=4)
   ```
   """
-  __slots__ = "uop", "requires_grad", "grad"
+  __slots__ = "_uop", "requires_grad", "grad"
   training: ClassVar[bool] = False
 
   def __init__(self, data:ConstType|bytes|list|tuple|UOp|'np.ndarray'|pathlib.Path|None,  # type: ignore [name-defined] # noqa: F821
@@ -165,16 +187,25 @@ class Tensor(MathTrait):
     if not isinstance(data, UOp): raise RuntimeError(f"can't create Tensor from {data!r} with type {type(data)}")
 
     # data might be on a different device
-    if isinstance(device, str): self.uop:UOp = data if data.device == device else data.copy_to_device(device)
+    if isinstance(device, str): self.uop = data if data.device == device else data.copy_to_device(device)
     # if device is a tuple, we should have/construct a MultiLazyBuffer
     elif isinstance(data.device, str): self.uop = Tensor(data).shard(device).uop
     else:
       assert data.device == device, f"MultiLazyBuffer device mismatch, {data.device} != {device}"
       self.uop = data
 
-    # add to all_tensors after construction succeeds
-    all_tensors.add(weakref.ref(self))
-  def __del__(self): all_tensors.discard(weakref.ref(self))
+  def __del__(self):
+    if (u:=getattr(self, "_uop", None)) is not None: _untrack_tensor(u, weakref.ref(self))
+
+  # the Tensor is indexed by its uop once it's assigned, that's after construction succeeds
+  @property
+  def uop(self) -> UOp: return self._uop
+  @uop.setter
+  def uop(self, uop:UOp):
+    tref = weakref.ref(self)
+    if (old:=getattr(self, "_uop", None)) is not None: _untrack_tensor(old, tref)
+    self._uop = uop
+    uop_tensors.setdefault(uop, set()).add(tref)
 
   def _apply_uop(self, fxn:Callable, *x:Tensor, **kwargs) -> Tensor:
     new_uop: UOp = fxn(*[t.uop for t in (self,)+x], **kwargs)
@@ -245,15 +276,28 @@ class Tensor(MathTrait):
     NOTE: A Tensor can only be scheduled once.
     """
     st = time.perf_counter()
-    self.kernelize(*lst)
-    sink = UOp.sink(*[x.uop for x in (self,)+lst])
-
-    # remove all ASSIGNs, after scheduling, the tensors are just buffers
-    remove_assign_map = {u:u.buf_uop for u in sink.toposort() if u.op is Ops.STORE}
-    _apply_map_to_tensors(remove_assign_map, name="Remove Assigns")
-
-    # create the schedule
-    schedule, var_vals = create_schedule_with_vars(sink)
+    # graphs with the same structure as one scheduled before reuse its schedule on their own buffers
+    key, inputs, tensors = _schedule_cache_key((self,)+lst) if SCHEDULE_CACHE else (None, [], [])
+    if key is not None and (cached:=schedule_cache.get(key)) is not None:
+      outs, schedule, var_vals = cached.rebind(inputs)
+      for t,u in zip(tensors, outs): t.uop = u
+    else:
+      self.kernelize(*lst)
+      sink = UOp.sink(*[x.uop for x in (self,)+lst])
+
+      # remove all ASSIGNs, after scheduling, the tensors are just buffers
+      remove_assign_map = {u:u.buf_uop for u in sink.toposort() if u.op is Ops.STORE}
+      _apply_map_to_tensors(remove_assign_map, name="Remove Assigns")
+
+      # create the schedule
+      schedule, var_vals = create_schedule_with_vars(sink)
+      if key is not None and (entry:=CachedSchedule.create(inputs, [x.uop for x in tensors], schedule, var_vals)) is not None:
+        # SCHEDULE_CACHE is the number of graphs that are kept, the oldest one is dropped
+        if len(schedule_cache) >= SCHEDULE_CACHE.value: schedule_cache.pop(next(iter(schedule_cache)))
+        schedule_cache[key] = entry
+      del sink, remove_assign_map
+    # NOTE: the kernel graph is freed first, after this only the buffers held by Tensors have a uop_refcount
+    del inputs
     schedule = memory_planner(schedule)
     if DEBUG >= 1 and len(schedule) >= 10: print(f"scheduled {len(schedule)} kernels in {(time.perf_counter()-st)*1000:.2f} ms")
     return schedule, var_vals
@@ -947,9 +991,7 @@ class Tensor(MathTrait):
     print(t.grad.numpy())
     ```
     """
-    all_uops = self.uop.toposort()
-    tensors_need_grad: list[Tensor] = [t for tref in all_tensors if (t:=tref()) is not None and \
-                                       t.uop in all_uops and t.requires_grad]
+    tensors_need_grad: list[Tensor] = [t for t in _find_all_tensors_for_uops(self.uop.toposort()) if t.requires_grad]
     # clear contexts
     for t,g in zip(tensors_need_grad, self.gradient(*tensors_need_grad, gradient=gradient, materialize_grads=True)):
       assert g.shape == t.shape, f"grad shape must match tensor shape, {g.shape!r} != {t.shape!r}"
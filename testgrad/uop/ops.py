@@ -1,12 +1,13 @@
 from __future__ import annotations
 from typing import Any, Optional, Union, Callable, cast, TYPE_CHECKING, Type, Sequence
-import sys, time, functools, itertools, math, operator, hashlib, os, types, pickle, pathlib, inspect, weakref
+import sys, time, functools, itertools, math, operator, hashlib, os, types, pickle, pathlib, inspect, weakref, collections
 from dataclasses import dataclass, field
 from testgrad.uop import Ops, GroupOp
 from testgrad.uop.mathtraits import MathTrait
 from testgrad.dtype import ConstType, ImageDType, dtypes, DType, truncate
 from testgrad.helpers import ContextVar, all_int, prod, getenv, all_same, Context, partition, temp, unwrap, T, argfix, Metadata, flatten
-from testgrad.helpers import PICKLE_BUFFERS, PROFILE, dedup, cdiv, cmod, diskcache_put, to_function_name
+from testgrad.helpers import PICKLE_BUFFERS, PROFILE, dedup, cdiv, cmod, diskcache_put, to_function_name, REWRITE_CACHE, CORRECT_DIVMOD_FOLDING
+from testgrad.helpers import TOPO_CACHE
 if TYPE_CHECKING:
   from testgrad.shape.shapetracker import ShapeTracker
   from testgrad.device import Buffer, MultiBuffer
@@ -52,7 +53,12 @@ class UOpMetaClass(type):
                metadata:tuple[Metadata,...]|None=None, _buffer:Buffer|None=None):
     if (wret:=UOpMetaClass.ucache.get(key:=(op, dtype, src, arg, tag), None)) is not None and (ret:=wret()) is not None: return ret
     UOpMetaClass.ucache[key] = ref = weakref.ref(created:=super().__call__(*key))
-    for s in src: s.children.add(ref)
+    # the key is shared with the ucache. children are tracked lazily, most UOps have one or none
+    created._key = key
+    for s in src:
+      if (c:=s._children) is None: s._children = ref
+      elif type(c) is set: c.add(ref)
+      else: s._children = {c, ref} if c() is not None else ref
     if metadata is not None: all_metadata[created] = metadata
     # NOTE: this value is set by pickle when pickling a realized tensor
     if _buffer is not None:
@@ -64,6 +70,24 @@ class UOpMetaClass(type):
 buffers:weakref.WeakKeyDictionary[UOp, Buffer|MultiBuffer] = weakref.WeakKeyDictionary() # this maps BUFFER uops to their device Buffers
 all_metadata:weakref.WeakKeyDictionary[UOp, tuple[Metadata, ...]] = weakref.WeakKeyDictionary() # TODO: should this be here?
 
+class ParentsCache:
+  """
+  The parents of the UOps that were toposorted, in topological order. They're kept on the UOp, they don't keep it alive, and toposorts of
+  bigger graphs reuse them. The cache holds at most TOPO_CACHE parents in total, the oldest UOps are dropped first.
+  """
+  def __init__(self):
+    self.refs: collections.deque[tuple[weakref.ref[UOp], int]] = collections.deque()
+    self.size = 0
+  def add(self, u:UOp, parents:dict[UOp, None]):
+    u._parents = parents
+    self.refs.append((weakref.ref(u), len(parents)))
+    self.size += len(parents)
+    while self.size > TOPO_CACHE.value and len(self.refs) > 1:
+      ref, size = self.refs.popleft()
+      self.size -= size
+      if (old:=ref()) is not None: old._parents = None
+parents_cache = ParentsCache()
+
 # NOTE: this should be frozen, but frozen is slower
 @dataclass(eq=False, slots=True)
 class UOp(MathTrait, metaclass=UOpMetaClass):
@@ -72,14 +96,21 @@ class UOp(MathTrait, metaclass=UOpMetaClass):
   src:tuple[UOp, ...] = tuple()
   arg:Any = None
   tag:Any = None
-  children:set[weakref.ref[UOp]] = field(default_factory=set)
+  _key:tuple = field(init=False, repr=False)
+  _children:weakref.ref[UOp]|set[weakref.ref[UOp]]|None = field(default=None, init=False, repr=False)
+  _parents:dict[UOp, None]|None = field(default=None, init=False, repr=False)
   def __del__(self):
     if Ops is not None and self.op is Ops.BUFFER and (buffer:=buffers.get(self)) is not None: buffer.ref(-1)
     try:
-      if (ref:=UOpMetaClass.ucache.get(k:=(self.op, self.dtype, self.src, self.arg, self.tag))) is not None:
-        for s in self.src: s.children.discard(ref)
-        del UOpMetaClass.ucache[k]
+      if (ref:=UOpMetaClass.ucache.pop(self._key, None)) is not None:
+        for s in self.src:
+          if s._children is ref: s._children = None
+          elif type(c:=s._children) is set: c.discard(ref)
     except AttributeError: pass
+  @property
+  def children(self) -> set[weakref.ref[UOp]]:
+    if (c:=self._children) is None or type(c) is set: return c or set()
+    return {c} if c() is not None else set()
   def __reduce__(self):
     args = [self.op, self.dtype, self.src, self.arg, self.tag, self.metadata]
     if self.op is Ops.BUFFER and self.realized is not None and PICKLE_BUFFERS: args.append(self.realized)
@@ -98,22 +129,29 @@ class UOp(MathTrait, metaclass=UOpMetaClass):
   def argstr(self): return f'({", ".join(map(str, self.arg))})' if self.op is Ops.REDUCE_AXIS else repr(self.arg)
   def tagstr(self): return f", tag={self.tag}" if self.tag is not None else ""
 
-  @functools.cached_property
+  @property
   def parents(self:UOp) -> dict[UOp, None]:
-    ret = {s:None for s in self.src}
-    for s in self.src: ret.update(s.parents)
+    if (ret:=self._parents) is None:
+      ret = self._toposort()
+      del ret[self]
+      if TOPO_CACHE: parents_cache.add(self, ret)
     return ret
   @property
   def sparents(self:UOp) -> dict[UOp, None]: return {self:None, **self.parents}
 
-  def toposort(self, gate:Callable|None=None) -> dict[UOp, None]:
+  def toposort(self, gate:Callable|None=None) -> dict[UOp, None]: return {**self.parents, self:None} if gate is None else self._toposort(gate)
+  def _toposort(self, gate:Callable|None=None) -> dict[UOp, None]:
     ret: dict[UOp, None] = {}
     stack: list[tuple[UOp, bool]] = [(self, False)] # each stack entry is (node, visited_flag)
     while stack:
       node, visited = stack.pop()
       if node in ret: continue
       if not visited:
-        if gate is None or gate(node):
+        # the cached parents of a node are in the same order this would visit them, everything visited is already in ret with its parents
+        if gate is None and (parents:=node._parents) is not None:
+          ret.update(parents)
+          ret[node] = None
+        elif gate is None or gate(node):
           stack.append((node, True))  # push node back on stack to process after its parents
           for parent in reversed(node.src): stack.append((parent, False)) # push parents on the stack
       else: ret[node] = None # second time i'm seeing this node, add it to returned toposort
@@ -538,6 +576,8 @@ class KernelInfo:
   name: str = "test"            # name of the kernel
   local_dims: int = 0           # number of local dimensions  (this is remapping RANGE to SPECIAL)
   upcasted: int = 0             # count that are upcasted     (this is remapping RANGE to UNROLL)
+  unrolled: int = 0             # count of reduce axes that are unrolled (this is remapping the reduce RANGE to UNROLL+CONTRACT)
+  threads: int = 0              # size of the first axis that is split across cores (this is remapping RANGE to SPECIAL)
   dont_use_locals: bool = False # don't use local indexing
   applied_opts: tuple = tuple()
   opts_to_apply: tuple|None = None
@@ -712,8 +752,7 @@ def upat_interpret(p:UPat, fxn:Callable) -> Callable:
   return universal_match
 
 class PatternMatcher:
-  def __init__(self, patterns:Sequence[tuple[UPat, Callable|tuple]], compiled=bool(getenv("UPAT_COMPILE", 1))):
-    if compiled: from testgrad.uop.upat import upat_compile
+  def __init__(self, patterns:Sequence[tuple[UPat, Callable|tuple]], compiled=bool(getenv("UPAT_COMPILE", 1)), memoize=True):
     # if this comes from a pickle, we reconstruct the lambda functions here
     self.patterns:list[tuple[UPat, Callable]] = [(p,types.FunctionType(*fxn) if isinstance(fxn, tuple) else fxn) for p,fxn in patterns]
     # NOTE: use of DefaultDict here is very dangerous! all keys will live for the lifetime of the PatternMatcher!
@@ -721,16 +760,32 @@ class PatternMatcher:
     # uop is required, arg is optional
     for p,fxn in self.patterns:
       assert p.op is not None
-      if compiled and (match:=upat_compile(p, fxn)) is not None: pass # pylint: disable=E0606
-      else: match = upat_interpret(p, fxn)
-      for uop in p.op: self.pdict.setdefault(uop, []).append((p, match, p.early_reject))
+      for uop in p.op: self.pdict.setdefault(uop, []).append((p, upat_interpret(p, fxn), p.early_reject))
+    # if compiled, all the patterns for an Op are compiled into one function the first time that Op is rewritten
+    self.compiled, self.dispatch = compiled, cast(dict[Ops, Callable], {})
+    # the rewrites without a ctx are memoized across graph_rewrite calls. matchers with rules that create new UOps (like a new BUFFER) opt out
+    self.memoize = memoize
+    self.rewrite_caches: dict[tuple[bool, int], RewriteCache] = {}
 
-  def __reduce__(self): return PatternMatcher, ([(x,deconstruct_function(fxn) if fxn.__name__ == "<lambda>" else fxn) for x,fxn in self.patterns],)
+  def __reduce__(self):
+    return PatternMatcher, ([(x,deconstruct_function(fxn) if fxn.__name__ == "<lambda>" else fxn) for x,fxn in self.patterns], True, self.memoize)
 
   @functools.cache  # pylint: disable=method-cache-max-size-none
-  def __add__(self, more:PatternMatcher): return PatternMatcher(self.patterns+more.patterns)
+  def __add__(self, more:PatternMatcher): return PatternMatcher(self.patterns+more.patterns, memoize=self.memoize and more.memoize)
+
+  def rewrite_cache(self, bottom_up:bool) -> RewriteCache|None:
+    if not self.memoize or not REWRITE_CACHE or TRACK_MATCH_STATS: return None
+    # NOTE: CORRECT_DIVMOD_FOLDING is the only context var the rules read while rewriting
+    if (cache:=self.rewrite_caches.get(key:=(bottom_up, CORRECT_DIVMOD_FOLDING.value))) is None: cache = self.rewrite_caches[key] = RewriteCache()
+    return cache
+
+  def compile_op(self, op:Ops) -> Callable:
+    from testgrad.uop.upat import pm_compile
+    self.dispatch[op] = ret = pm_compile([(p,fxn) for p,fxn in self.patterns if op in unwrap(p.op)], f"match_{op.name}")
+    return ret
 
   def rewrite(self, uop:UOp, ctx=None) -> UOp|None:
+    if self.compiled: return (self.dispatch.get(uop.op) or self.compile_op(uop.op))(uop, ctx)
     ler = {u.op for u in uop.src}
     for _,match,early_reject in self.pdict.get(uop.op, []):
       if not early_reject.issubset(ler): continue
@@ -865,6 +920,30 @@ if TRACK_MATCH_STATS or PROFILE:
 
 # *** simple graph rewrite engine ***
 
+rewrite_cache_stats = {"hits": 0, "misses": 0}
+class RewriteCache:
+  """
+  The results of a PatternMatcher rewriting UOps without a ctx, they are reused across graph_rewrite calls.
+
+  UOps without a device (kernel ASTs and their index math) are kept alive, so the same subgraph in the next kernel is a hit. Tensor graphs are
+  only weakly referenced, the cache never holds on to a BUFFER or adds children to the Tensor UOps. Each half has at most REWRITE_CACHE
+  entries, the oldest half is dropped when it's full.
+  """
+  def __init__(self):
+    self.kept: dict[UOp, UOp] = {}
+    self.weak: dict[int, tuple[weakref.ReferenceType[UOp], weakref.ReferenceType[UOp]]] = {}
+  def get(self, u:UOp) -> UOp|None:
+    if (ret:=self.kept.get(u)) is None: ret = c[1]() if (c:=self.weak.get(id(u))) is not None and c[0]() is u else None
+    if ret is not None: rewrite_cache_stats["hits"] += 1
+    return ret
+  def put(self, u:UOp, ret:UOp):
+    rewrite_cache_stats["misses"] += 1
+    if u._device is not None: d, k, v = cast(dict, self.weak), id(u), (weakref.ref(u), weakref.ref(ret))
+    else: d, k, v = self.kept, u, ret
+    d[k] = v
+    if len(d) > REWRITE_CACHE.value:
+      for x in list(itertools.islice(d, len(d)//2)): del d[x]
+
 class RewriteContext:
   def __init__(self, pm, ctx=None):
     self.pm: PatternMatcher = pm
@@ -873,9 +952,14 @@ class RewriteContext:
 
   def unified_rewrite(self, root:UOp, bottom_up=False) -> UOp:
     stack: list[tuple[UOp, int, UOp]] = [(root, 0, root)]
+    # a rewrite with a ctx isn't pure, only the ones without are memoized
+    cache = self.pm.rewrite_cache(bottom_up) if self.ctx is None else None
     while stack:
       n, stage, new_n = stack.pop()
       if n in self.replace: continue  # skip any nodes we have seen
+      if cache is not None and stage == 0 and (ret:=cache.get(n)) is not None:
+        self.replace[n] = ret
+        continue
       if stage == 0:
         # if bottom up, we rewrite this node early. in both cases, we add its parents to the stack
         if bottom_up: new_n = self.pm.fixed_point_rewrite(new_n, self.ctx)
@@ -886,6 +970,7 @@ class RewriteContext:
           # if top down, do the rewrite. if no rewrite or bottom up, we are done rewriting this node so we add it to the dict
           if bottom_up or (new_src_n:=self.pm.rewrite(new_n, self.ctx)) is None:
             self.replace[n] = new_n
+            if cache is not None: cache.put(n, new_n)
             continue
         else:
           # if srcs changed from rewrites, construct a new UOp with the new srcs
@@ -896,6 +981,7 @@ class RewriteContext:
       else:
         # in stage 2, we link the result of new_n to the result of n
         self.replace[n] = self.replace[new_n]
+        if cache is not None: cache.put(n, self.replace[n])
     return self.replace[root]
 
 @track_matches
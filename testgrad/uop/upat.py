@@ -1,7 +1,7 @@
 from typing import Any, Callable
-import itertools, inspect, functools, types
-from testgrad.helpers import partition, dedup, Context
-from testgrad.uop.ops import UPat, UPatAny, UOp, Ops, PatternMatcher, graph_rewrite, deconstruct_function
+import itertools, functools, types, hashlib, pathlib, pickle, marshal, sys
+from testgrad.helpers import partition, dedup, Context, diskcache_get, diskcache_put
+from testgrad.uop.ops import UPat, UPatAny, UOp, Ops, PatternMatcher, graph_rewrite, deconstruct_function, upat_interpret
 
 class UPatCompileError(Exception): pass
 
@@ -47,60 +47,48 @@ def _get_clause(self:UPat, base:UOp, depth=0) -> UOp:
 def do_process_and(a:UOp) -> UOp|None:
   found = False
   new_src:list[UOp] = []
-  or_clause:list[UOp] = []
 
-  # remove any nested ANDs, extract or clauses
+  # remove any nested ANDs. the OR clauses stay where they are, they become paths in _get_paths
   for x in a.src:
     if x.op is Ops.AND:
       new_src.extend(x.src)
       found = True
-    elif x.op is Ops.OR: or_clause.append(x)
     else: new_src.append(x)
 
-  # too big to compile
-  if len(or_clause) >= 4: raise UPatCompileError("too big to compile")
-
-  # one or clause max
-  if len(or_clause) > 1:
-    # need the product of the or clauses
-    or_clause = [UOp(Ops.OR, src=tuple([UOp(Ops.AND, src=x) for x in itertools.product(*[x.src for x in or_clause])]))]
-    found = True
-
   # handle assigns
   assigns, new_src = partition(new_src, lambda x: x.op is Ops.ASSIGN)
-  if len(assigns):
-    if len(or_clause):
-      # push assigns to the top if we have an or_clause
-      assert len(or_clause) == 1 and all(x.op is Ops.AND for x in or_clause[0].src)
-      or_clause = [UOp(Ops.OR, src=tuple([x.replace(src=x.src+tuple(assigns)) for x in or_clause[0].src]))]
+  dict_assigns: dict[UOp, UOp] = {}
+  for a in assigns:
+    if a.src[0] in dict_assigns:
+      # duplicate assign is a compare
+      new_src.append(UOp(Ops.CMPNE, src=(dict_assigns[a.src[0]], a.src[1])))
       found = True
     else:
-      # check for duplicate assigns
-      dict_assigns: dict[UOp, UOp] = {}
-      for a in assigns:
-        if a.src[0] in dict_assigns:
-          # duplicate assign is a compare
-          new_src.append(UOp(Ops.CMPNE, src=(dict_assigns[a.src[0]], a.src[1])))
-          found = True
-        else:
-          dict_assigns[a.src[0]] = a.src[1]
-      # put the assigns back
-      for k,v in dict_assigns.items(): new_src.append(UOp(Ops.ASSIGN, src=(k,v)))
+      dict_assigns[a.src[0]] = a.src[1]
+  # put the assigns back
+  for k,v in dict_assigns.items(): new_src.append(UOp(Ops.ASSIGN, src=(k,v)))
 
   # reassemble, if there's any deduping to do, do it
-  if len(dretand:=dedup(new_src+or_clause)) != len(new_src)+len(or_clause): found = True
+  if len(dretand:=dedup(new_src)) != len(new_src): found = True
   return UOp(Ops.AND, src=tuple(dretand)) if found else None
 
 # processor
 pm_proc = PatternMatcher([(UPat(Ops.AND, name="a"), do_process_and)], compiled=False)
 
-# renderer
-def wrap(ctx, x) -> UOp:
-  ctx[ret:=f"a{len(ctx)}"] = x.arg
-  return UOp(Ops.NOOP, arg=ret)
+# the values the generated code compares against are globals, equal values share a name so the tests on them can be shared
+_const_names: dict[Any, str] = {}
+_const_values: dict[str, Any] = {}
+def _const(x:Any) -> str:
+  try: hash(key:=(type(x), x))
+  except TypeError: key = None
+  if key is not None and (name:=_const_names.get(key)) is not None: return name
+  _const_values[name:=f"_c{len(_const_values)}"] = x
+  if key is not None: _const_names[key] = name
+  return name
 
+# renderer
 pm_renderer = PatternMatcher([
-  (UPat(Ops.BIND, name="x"), wrap),
+  (UPat(Ops.BIND, name="x"), lambda x: UOp(Ops.NOOP, arg=_const(x.arg))),
 
   # CMPNE is actually equal
   (UPat(Ops.CMPNE, name="x"), lambda x: UOp(Ops.CUSTOM, src=x.src, arg="{0} is {1}")),
@@ -113,51 +101,118 @@ pm_renderer = PatternMatcher([
   (UPat(Ops.GEP, src=UPat(Ops.NOOP, name="x"), name="g"), lambda x,g: x.replace(arg=x.arg+f".src[{g.arg[0]}]"))
 ], compiled=False)
 
-def _final_render(x:UOp, has_ctx:bool, depth=1) -> list[str]:
-  assert x.op is Ops.AND
-  and_pieces, assign_pieces = [], []
-  or_pieces: list[str] = []
+def _paths(x:UOp) -> list[tuple[list[str], list[tuple[str, str]]]]:
+  # each path is a list of tests and the assigns if they pass. the paths are tried in order, an OR is a fork of the paths
+  if x.op is not Ops.AND: raise UPatCompileError(f"can't compile this {x}")
+  ret: list[tuple[list[str], list[tuple[str, str]]]] = [([], [])]
   for s in x.src:
-    if s.op is Ops.OR:
-      assert len(or_pieces) == 0 and len(s.src) >= 1
-      for ss in s.src: or_pieces.extend(_final_render(ss, has_ctx, depth+1))
+    if s.op is Ops.OR: alts = [p for ss in s.src for p in _paths(ss)]
     elif s.op is Ops.ASSIGN:
       assert s.src[0].op is Ops.DEFINE_VAR and s.src[1].op is Ops.NOOP
-      assign_pieces.append(f"{s.src[0].arg}={s.src[1].arg}")
-    elif s.op is Ops.NOOP: and_pieces.append(s.arg)
+      alts = [([], [(s.src[0].arg, s.src[1].arg)])]
+    elif s.op is Ops.NOOP: alts = [([s.arg], [])]
     else: raise UPatCompileError(f"can't compile this {s}")
-  # if we have an or, render it
-  if len(or_pieces):
-    assert len(assign_pieces) == 0
-    and_clause = ' and '.join(and_pieces)
-    return [f"{'  '*depth}if {and_clause if len(and_clause) else 'True'}:"] + or_pieces
-  # if we don't, this is a final return
-  assign_clause = ', '.join((["ctx=ctx"] if has_ctx else [])+assign_pieces)
-  and_clause = ' and '.join(and_pieces + [f"(_ret:=_fxn({assign_clause})) is not None"])
-  return [f"{'  '*depth}if {and_clause}: return _ret"]
-
-def _get_code(self:UPat, has_ctx:bool):
-  ret = _get_clause(self, UOp(Ops.NOOP, arg="uop"))
+    ret = [(c0+c1, a0+a1) for c0,a0 in ret for c1,a1 in alts]
+    if len(ret) > 256: raise UPatCompileError("too big to compile")
+  return ret
+
+# shallow tests go first so the accesses are guarded by the len tests, tests on the op are the most selective
+def _test_order(t:str) -> tuple[int, int]: return (t.count(".src["), 0 if ".op ==" in t or ".op in" in t else 1 if t.startswith("len(") else 2)
+
+@functools.cache
+def _get_paths(self:UPat) -> list[tuple[tuple[str, ...], tuple[tuple[str, str], ...]]]|None:
   try:
     # TODO: this should be tracked in a "system" rewrite, not untracked or tracked with kernel
     with Context(TRACK_MATCH_STATS=0):
-      ret = graph_rewrite(ret, pm_proc, name="process UPat")
-      dyn_lookup: dict[str, Any] = {}
-      out = graph_rewrite(ret, pm_renderer, ctx=dyn_lookup, name="compile UPat")
-      rendered = _final_render(out, has_ctx)
+      ret = graph_rewrite(_get_clause(self, UOp(Ops.NOOP, arg="uop")), pm_proc, name="process UPat")
+      out = graph_rewrite(ret, pm_renderer, name="compile UPat")
+      paths = _paths(out)
   except UPatCompileError:
     #print("FAILED", self, self.location)
     return None
-  return '\n'.join([f"# match for {self.location}", "def compiled_match(uop, ctx):"] + rendered + ["  return None"]), dyn_lookup
+  ret_paths = []
+  for tests, assigns in paths:
+    # the PatternMatcher dispatches on the op of the root. a name that's assigned twice is an identity test
+    tests, binds = [t for t in tests if not t.startswith("uop.op ")], {}
+    for k,v in assigns:
+      if k not in binds: binds[k] = v
+      elif binds[k] != v: tests.append(f"{binds[k]} is {v}")
+    ret_paths.append((tuple(sorted(tests, key=_test_order)), tuple(binds.items())))
+  return ret_paths
+
+def _render(paths:list[tuple[tuple[str, ...], str]], depth=1) -> list[str]:
+  # consecutive paths that start with the same test share it, this builds a decision tree without changing the order of the patterns
+  lines: list[str] = []
+  i = 0
+  while i < len(paths):
+    tests, call = paths[i]
+    j = i+1
+    if len(tests):
+      while j < len(paths) and len(paths[j][0]) and paths[j][0][0] == tests[0]: j += 1
+    if j-i > 1: lines += [f"{'  '*depth}if {tests[0]}:"] + _render([(t[1:], c) for t,c in paths[i:j]], depth+1)
+    else: lines.append(f"{'  '*depth}if {' and '.join(tests+(f'(_ret:={call}) is not None and _ret is not uop',))}: return _ret")
+    i = j
+  return lines
+
+def _has_ctx(fxn:Callable) -> bool: return 'ctx' in (code:=fxn.__code__).co_varnames[:code.co_argcount+code.co_kwonlyargcount]
+
+def _render_matcher(patterns:list[tuple[UPat, Callable]], name:str) -> str:
+  paths: list[tuple[tuple[str, ...], str]] = []
+  for i,(p,fxn) in enumerate(patterns):
+    # NOTE: a custom early_reject is a test that isn't in the UPat
+    early_reject = (f"{_const(p.early_reject)} <= ler",) if p.custom_early_reject is not None else ()
+    if (upat_paths:=_get_paths(p)) is None:
+      paths.append((early_reject, f"_match{i}(uop, ctx)"))
+      continue
+    has_ctx = _has_ctx(fxn)
+    for tests, assigns in upat_paths:
+      paths.append((early_reject+tests, f"_fxn{i}({', '.join((['ctx=ctx'] if has_ctx else [])+[f'{k}={v}' for k,v in assigns])})"))
+  code = [f"def {name}(uop, ctx):"] + (["  ler = {u.op for u in uop.src}"] if any(p.custom_early_reject is not None for p,_ in patterns) else [])
+  return '\n'.join(code + _render(paths) + ["  return None"])
+
+# *** compiled matcher cache ***
 
 @functools.cache
-def upat_compile(self:UPat, fxn) -> Callable|None:
-  real_fxn = types.FunctionType(*deconstruct_function(fxn))
-  code = _get_code(self, 'ctx' in inspect.signature(real_fxn).parameters)
-  if code is None: return None
-  code_str, dyn_lookup = code
-  globs = dyn_lookup.copy()
-  globs["_fxn"] = real_fxn
+def _compiler_version() -> bytes:
+  # the code objects are marshaled, they're only loaded by the same python and the same compiler
+  return sys.version.encode() + b"".join(pathlib.Path(__file__).with_name(f).read_bytes() for f in ["ops.py", "upat.py"])
+
+@functools.cache
+def _upat_key(p:UPat) -> tuple:
+  src = p._in_src
+  src_key = tuple(_upat_key(s) for s in src) if isinstance(src, (tuple, list)) else _upat_key(src) if isinstance(src, UPat) else None
+  early_reject = None if p.custom_early_reject is None else sorted(int(x) for x in p.custom_early_reject)
+  return (type(p).__name__, p.op, p.dtype, p.arg, p.name, p.strict_length, p.location, type(src).__name__, src_key, early_reject)
+
+def _code_names(code:types.CodeType) -> set[str]:
+  return set(code.co_names).union(*[_code_names(c) for c in code.co_consts if isinstance(c, types.CodeType)])
+
+def pm_compile(patterns:list[tuple[UPat, Callable]], name="compiled_match") -> Callable:
+  """
+  Compile a list of patterns into one function that returns the first rewrite that isn't None or `uop`.
+
+  The tests on the dtype, arg, number of sources and source ops are shared by consecutive patterns. Patterns that can't be compiled are
+  interpreted in their place. The compiled code and the constants it tests against are cached on disk, keyed by the location and the structure
+  of the patterns.
+  """
+  key = hashlib.sha256(_compiler_version() + repr((name, [(_upat_key(p), _has_ctx(fxn)) for p,fxn in patterns])).encode())
+  if (cached:=diskcache_get("pm_compile", key.hexdigest())) is not None: code, consts = marshal.loads(cached[0]), cached[1]
+  else:
+    code = compile(_render_matcher(patterns, name), f"<{name}>", "exec")
+    # each matcher has its own globals, the names of the constants only have to match in this code
+    consts = {n:_const_values[n] for n in _code_names(code) if n in _const_values}
+    # NOTE: a constant that can't be pickled (like a lambda in an arg) isn't cached
+    try: diskcache_put("pm_compile", key.hexdigest(), pickle.dumps((marshal.dumps(code), consts)), prepickled=True)
+    except (pickle.PicklingError, TypeError, AttributeError): pass
+  globs: dict[str, Any] = {}
+  names = _code_names(code)
+  for i,(p,fxn) in enumerate(patterns):
+    if f"_fxn{i}" in names: globs[f"_fxn{i}"] = types.FunctionType(*deconstruct_function(fxn))
+    if f"_match{i}" in names: globs[f"_match{i}"] = upat_interpret(p, fxn)
   namespace: dict = {}
-  exec(code_str, globs, namespace)  # pylint: disable=W0122
-  return namespace["compiled_match"]
+  exec(code, consts | globs, namespace)  # pylint: disable=W0122
+  return namespace[name]
+
+@functools.cache
+def upat_compile(self:UPat, fxn) -> Callable|None:
+  return pm_compile([(self, fxn)]) if _get_paths(self) is not None else None